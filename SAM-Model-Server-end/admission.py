@@ -0,0 +1,107 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Requests whose image embedding is already stored only run the mask decoder,
+# so they go ahead of requests that need the image encoder.
+PRIORITY_DECODER_ONLY = 0
+PRIORITY_ENCODE = 1
+
+
+class Rejected(Exception):
+    """
+    Raised when a request is not admitted, with the HTTP status to answer with
+    and how many seconds the client should wait before retrying.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounds the inference work the server runs at once. At most max_in_flight
+    requests hold a slot; up to max_queue more wait for one, served by priority
+    and then in arrival order. Beyond that, requests are turned away with 429
+    straight away instead of piling up and slowing everyone down. A request
+    whose deadline passes while it waits is dropped with 503 before it reaches
+    the model.
+    """
+
+    # Weight of the newest measurement in the estimate of how long a slot is held
+    service_time_smoothing = 0.2
+
+    def __init__(self, max_in_flight=1, max_queue=8):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.service_time = None
+        self._waiting = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def retry_after(self):
+        """
+        Estimates, in whole seconds, when a slot is likely to be free for a new
+        request, from the current queue and the average time a slot is held.
+        """
+        service_time = self.service_time if self.service_time is not None else 1.0
+        waves = (len(self._waiting) + self.in_flight) / self.max_in_flight
+        return max(1, math.ceil(service_time * waves))
+
+    @contextmanager
+    def admit(self, priority=PRIORITY_ENCODE, deadline=None):
+        """
+        Waits for a slot and holds it for the duration of the with block.
+
+        :param priority: PRIORITY_DECODER_ONLY or PRIORITY_ENCODE; lower goes first
+        :param deadline: time.monotonic() value after which the request is no longer
+            worth serving, or None to wait as long as it takes
+        :raises Rejected: If the queue is full or the deadline passes before a slot frees up
+        """
+        with self._cond:
+            entry = (priority, next(self._counter))
+            if self.in_flight >= self.max_in_flight or self._waiting:
+                if len(self._waiting) >= self.max_queue:
+                    raise Rejected("Server is busy, too many queued requests", 429, self.retry_after())
+                heapq.heappush(self._waiting, entry)
+                try:
+                    while self.in_flight >= self.max_in_flight or self._waiting[0] != entry:
+                        timeout = None if deadline is None else deadline - time.monotonic()
+                        if timeout is not None and timeout <= 0:
+                            raise Rejected("Request deadline passed while queued", 503, self.retry_after())
+                        self._cond.wait(timeout)
+                finally:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    # The head of the queue may have changed
+                    self._cond.notify_all()
+            if deadline is not None and time.monotonic() >= deadline:
+                raise Rejected("Request deadline passed while queued", 503, self.retry_after())
+            self.in_flight += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._record_service_time(time.monotonic() - start)
+                self._cond.notify_all()
+
+    def _record_service_time(self, seconds):
+        if self.service_time is None:
+            self.service_time = seconds
+        else:
+            self.service_time += self.service_time_smoothing * (seconds - self.service_time)
@@ -1,15 +1,55 @@
+import json
+import os
+import threading
+import time
+import psutil
 import torch
 import numpy as np
-from flask import Flask, render_template, request, jsonify
-from PIL import Image
+from flask import Flask, Response, g, render_template, request, jsonify
 import io
 import base64
 import matplotlib.pyplot as plt
-from segment_anything import sam_model_registry, SamAutomaticMaskGenerator, SamPredictor
+from admission import AdmissionController, Rejected, PRIORITY_DECODER_ONLY, PRIORITY_ENCODE
+from metrics import MetricsRegistry, instrument_model
+from model_registry import ModelRegistry
+from leaf_pipeline import LeafClassifier, LeafDiagnoser, decode_full_image
+from severity import SeverityEstimator, leaf_reports
+from segment_anything.utils.amg import batched_mask_to_box, mask_to_rle_pytorch
+from segment_anything.utils.embedding_store import EmbeddingStore
 
-# Load the SAM model
-sam_checkpoint = "./sam_vit_h_4b8939.pth"  # Make sure the path to the model checkpoint is correct
-model_type = "vit_h"
+# The SAM models to serve, as comma-separated <model_type>=<checkpoint> entries.
+# A published checkpoint (e.g. sam_vit_h_4b8939.pth) that is not found at its
+# path is fetched into the shared model store, see artifacts.py
+model_spec = os.environ.get("SAM_MODELS", "vit_h=./sam_vit_h_4b8939.pth")
+
+# Model used when a request names neither a model nor a latency budget.
+# Defaults to the fastest configured model, which suits interactive boxes
+default_model = os.environ.get("SAM_DEFAULT_MODEL") or None
+
+# Run a dummy image through the models once they are loaded, so the first real
+# request does not pay for allocating the encoder and decoder buffers
+warmup_enabled = os.environ.get("SAM_WARMUP", "1") == "1"
+
+# Directory of the on-disk embedding store, so that images seen before (also
+# before a restart) skip the image encoder. Disabled if unset
+embedding_store_dir = os.environ.get("SAM_EMBEDDING_STORE")
+embedding_store_mb = int(os.environ.get("SAM_EMBEDDING_STORE_MB", "2048"))
+
+# Admission control: how many requests may run inference at once, how many more
+# may wait for a turn (beyond that they get 429), and how long a request may wait
+# in total before it is dropped (clients can lower it with X-Request-Deadline-Ms).
+# The wait is counted from the X-Request-Start header if a proxy in front sets
+# one, and otherwise from when the app starts handling the request, so time spent
+# in a proxy's or the listen socket's queue before that is not counted
+max_in_flight = int(os.environ.get("SAM_MAX_IN_FLIGHT", "1"))
+max_queue = int(os.environ.get("SAM_MAX_QUEUE", "8"))
+request_deadline_ms = float(os.environ.get("SAM_REQUEST_DEADLINE_MS", "60000"))
+
+# The PlantDis classifier used by /diagnose to diagnose each leaf SAM finds, as a
+# Keras .h5 or TFLite .tflite file (pdorft_efficientnetb2_3.h5 is fetched into
+# the model store). /diagnose is disabled if unset. It is loaded on the first
+# /diagnose request, so the server only needs TensorFlow or a TFLite runtime then
+leaf_classifier_path = os.environ.get("PLANTDIS_CLASSIFIER")
 
 # Check if GPU is available
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -17,17 +57,425 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # Log the device being used
 print(f"Using device: {device}")
 
-# Load the SAM model onto the selected device
-sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-sam.to(device=device)
+# The models are loaded in the background so the server can bind its port and
+# answer health checks straight away; /readyz reports when it can serve
+registry = ModelRegistry(model_spec, device, default=default_model)
+embedding_store = (
+    EmbeddingStore(embedding_store_dir, max_bytes=embedding_store_mb * 1024 * 1024)
+    if embedding_store_dir else None
+)
+admission = AdmissionController(max_in_flight=max_in_flight, max_queue=max_queue)
+model_ready = threading.Event()
+model_error = None
+
+# Metrics served at /metrics. Stages: decode, preprocess, image_encoder,
+# prompt_encoder, mask_decoder, postprocess_masks, render (drawing the overlay and
+# writing the PNG) and encode (building the response)
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    'sam_stage_seconds', 'Time spent in each stage of handling a request.', ('stage', 'model'))
+request_seconds = metrics.histogram(
+    'sam_request_seconds', 'Time to answer a request, by endpoint.', ('endpoint',))
+requests_total = metrics.counter(
+    'sam_requests_total', 'Requests answered, by endpoint and HTTP status.', ('endpoint', 'status'))
+queue_wait_seconds = metrics.histogram(
+    'sam_queue_wait_seconds', 'Time requests waited for admission.')
+embedding_lookups = metrics.counter(
+    'sam_embedding_store_lookups_total', 'Embedding store lookups, by hit or miss.', ('result',))
+decoder_batch_size = metrics.histogram(
+    'sam_decoder_batch_size', 'Prompts decoded together in one mask decoder call.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+metrics.gauge('sam_in_flight', 'Requests currently running inference.',
+              function=lambda: admission.in_flight)
+metrics.gauge('sam_queued', 'Requests waiting for admission.',
+              function=lambda: admission.queued)
+metrics.gauge('sam_embedding_store_bytes', 'Size of the embedding store.',
+              function=lambda: embedding_store.total_bytes if embedding_store is not None else None)
+metrics.gauge('process_resident_memory_bytes', 'Resident memory of this process.',
+              function=lambda: psutil.Process().memory_info().rss)
+metrics.gauge('sam_cuda_memory_allocated_bytes', 'GPU memory held by tensors.',
+              function=lambda: torch.cuda.memory_allocated() if torch.cuda.is_available() else None)
+metrics.gauge('sam_cuda_max_memory_allocated_bytes', 'Peak GPU memory held by tensors.',
+              function=lambda: torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None)
+
+
+def load_model():
+    """
+    Loads the configured SAM models onto the selected device.
+    Models that have already been loaded are skipped.
+    """
+    registry.load()
+
+
+def initialize_model():
+    """
+    Loads (and optionally warms up) the models, then marks the server ready.
+    Failures are recorded so that the health endpoints can report them.
+    """
+    global model_error
+    try:
+        load_model()
+        if warmup_enabled:
+            registry.warmup()
+        # Instrumented after warmup so that only real requests are measured
+        for model in registry.models.values():
+            instrument_model(model.sam, stage_seconds, model=model.name)
+        model_ready.set()
+    except Exception as e:
+        model_error = str(e)
+        print(f"Model initialization failed: {e}")
+
+
+def start_model_initialization():
+    """
+    Initializes the models on a background thread.
+    """
+    threading.Thread(target=initialize_model, name="model-init", daemon=True).start()
+
+
+if os.environ.get("SAM_PREFORK") == "1":
+    # Under gunicorn's preload the master loads the weights before forking so
+    # that the workers share them; each worker warms up after the fork
+    # (see post_fork in gunicorn.conf.py)
+    load_model()
+else:
+    start_model_initialization()
+
+# pyplot keeps a single current figure, so rendering requests take turns
+plot_lock = threading.Lock()
+
+leaf_classifier = None
+leaf_diagnosers = {}
+severity_estimators = {}
+leaf_classifier_lock = threading.Lock()
+
+
+def show_box(box, ax):
+    x0, y0 = box[0], box[1]
+    w, h = box[2] - box[0], box[3] - box[1]
+    ax.add_patch(plt.Rectangle((x0, y0), w, h, edgecolor='green', facecolor=(0, 0, 0, 0), lw=2))
+
+
+def show_mask(mask, ax, random_color=False, offset=(0, 0)):
+    if random_color:
+        color = np.concatenate([np.random.random(3), np.array([0.6])], axis=0)
+    else:
+        color = np.array([30 / 255, 144 / 255, 255 / 255, 0.6])
+    h, w = mask.shape[-2:]
+    mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
+    # Place the mask at its offset in image pixel coordinates
+    x0, y0 = offset
+    ax.imshow(mask_image, extent=(x0 - 0.5, x0 + w - 0.5, y0 + h - 0.5, y0 - 0.5))
+
+
+def render_masks(image_np, masks, boxes, offsets=None, original_size=None):
+    """
+    Draws masks and their prompt boxes over the image.
+
+    :param image_np: The image in HWC format
+    :param masks: Binary masks, each HxW, covering the whole image or a region of it
+    :param boxes: Boxes in XYXY format to outline (may be empty)
+    :param offsets: (x, y) position of each mask's top left corner in the image,
+        for masks that cover only a region; masks cover the whole image if omitted
+    :param original_size: (H, W) of the original image if image_np is a downscaled
+        copy of it; masks, boxes and offsets are in original image coordinates
+    :return: The rendered PNG image, base64 encoded
+    """
+    if offsets is None:
+        offsets = [(0, 0)] * len(masks)
+    with plot_lock:
+        plt.cla()
+        # Stretch a downscaled image over the original pixel coordinates
+        h, w = original_size if original_size is not None else image_np.shape[:2]
+        plt.imshow(image_np, extent=(-0.5, w - 0.5, h - 0.5, -0.5))
+        for mask, offset in zip(masks, offsets):
+            show_mask(mask, plt.gca(), random_color=len(masks) > 1, offset=offset)
+        for box in boxes:
+            show_box(box, plt.gca())
+        # Drawing a region resets the view to it, so restore the full image
+        plt.xlim(-0.5, w - 0.5)
+        plt.ylim(h - 0.5, -0.5)
+        plt.axis('off')
+
+        # Save the image to a byte stream with tight bounding box
+        buf = io.BytesIO()
+        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
+        buf.seek(0)
+
+    # Encode the image in base64 format
+    return base64.b64encode(buf.getvalue()).decode('utf-8')
+
+
+def decode_image(model, data):
+    """
+    Decodes an uploaded image straight to the model's input size. Phone photos are
+    far larger than the 1024 pixels the encoder sees, so JPEGs are downscaled
+    while decoding rather than decoded at full resolution and resized afterwards.
+
+    :param model: The LoadedModel the image is for
+    :param data: The uploaded (encoded) image file contents
+    :return: The downscaled image in HWC format and the original (H, W)
+    """
+    with stage_seconds.time(stage='decode', model=model.name):
+        return model.predictor.transform.decode_image(data)
+
+
+def embedding_key(model, data):
+    """
+    :param model: The LoadedModel the image is for
+    :param data: The uploaded (encoded) image file contents
+    :return: The key of the image's embedding in the store, or None if there is no store
+    """
+    if embedding_store is None:
+        return None
+    return EmbeddingStore.make_key(data, model.model_id)
+
+
+def request_priority(key):
+    """
+    Requests whose embedding is already stored skip the image encoder and only
+    need a few milliseconds of decoder time, so they are served first.
+
+    :param key: The key from embedding_key
+    :return: The admission priority of the request
+    """
+    if key is not None and key in embedding_store:
+        return PRIORITY_DECODER_ONLY
+    return PRIORITY_ENCODE
+
+
+def request_age():
+    """
+    Works out how long ago the current request reached the front proxy, from the
+    X-Request-Start header as set by nginx (t=${msec}) or Heroku: a Unix time in
+    seconds, milliseconds or microseconds, optionally prefixed with "t=".
+
+    :return: The age in seconds, 0 if the header is missing or malformed
+    """
+    value = request.headers.get('X-Request-Start', '').strip()
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return 0.0
+    # Tell the units apart by magnitude
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, time.time() - started)
+
+
+def request_deadline():
+    """
+    Works out when the current request stops being worth serving, from the
+    X-Request-Deadline-Ms header (capped by the server default). The deadline is
+    counted from the request's arrival at the front proxy if it sent
+    X-Request-Start, see request_age.
+
+    :return: The deadline as a time.monotonic() value, or None if there is none
+    """
+    deadline_ms = request.headers.get('X-Request-Deadline-Ms', type=float)
+    if deadline_ms is None or (request_deadline_ms > 0 and deadline_ms > request_deadline_ms):
+        deadline_ms = request_deadline_ms
+    if deadline_ms <= 0:
+        return None
+    return time.monotonic() + deadline_ms / 1000 - request_age()
+
+
+def set_image(model, key, image_np, original_size):
+    """
+    Sets the image on the model's predictor, reusing the stored embedding if this
+    exact image was encoded by this model before. Must be called with model.lock held.
+
+    :param model: The LoadedModel to use
+    :param key: The key from embedding_key
+    :param image_np: The image from decode_image, in HWC format
+    :param original_size: The original (H, W) of the image
+    :return: True if the embedding came from the store
+    """
+    if key is None:
+        model.predictor.set_image(image_np, original_image_size=original_size)
+        return False
+    stored = embedding_store.get(key)
+    embedding_lookups.inc(result='miss' if stored is None else 'hit')
+    if stored is not None:
+        model.predictor.set_embedding(*stored)
+        return True
+    model.predictor.set_image(image_np, original_image_size=original_size)
+    embedding_store.put(
+        key,
+        model.predictor.get_image_embedding(),
+        model.predictor.original_size,
+        model.predictor.input_size,
+    )
+    return False
+
+
+def is_out_of_memory(e):
+    """
+    :param e: An exception raised while running the model
+    :return: True if it was raised because the GPU or host ran out of memory
+    """
+    if isinstance(e, MemoryError):
+        return True
+    cuda_oom = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if cuda_oom is not None and isinstance(e, cuda_oom):
+        return True
+    message = str(e)
+    return 'out of memory' in message or "can't allocate memory" in message
+
+
+def error_response(e):
+    """
+    Turns an error raised while running the model into a JSON response. Running out
+    of memory is usually a sign of load rather than of a bad request, so the client
+    is told to retry rather than given a generic 500.
+
+    :param e: The RuntimeError or MemoryError
+    :return: Flask response tuple
+    """
+    if is_out_of_memory(e):
+        print(f"Out of memory: {e}")
+        return (jsonify({'error': 'Server ran out of memory, try again later'}), 503,
+                {'Retry-After': str(admission.retry_after())})
+    print(f"Runtime error: {e}")
+    return jsonify({'error': str(e)}), 500
+
+
+def select_model():
+    """
+    Picks the model for the current request from the optional 'model' form field
+    or X-Latency-Budget-Ms header.
+
+    :return: The LoadedModel to use
+    :raises KeyError: If the requested model is not configured
+    """
+    return registry.select(
+        request.form.get('model'),
+        request.headers.get('X-Latency-Budget-Ms', type=float),
+    )
+
+
+def get_leaf_diagnoser(model):
+    """
+    Returns the leaf diagnoser for a model, loading the classifier on first use.
+
+    :param model: The LoadedModel to find leaves with
+    :return: A LeafDiagnoser running on the model's predictor
+    """
+    global leaf_classifier
+    with leaf_classifier_lock:
+        if leaf_classifier is None:
+            leaf_classifier = LeafClassifier(leaf_classifier_path)
+        if model.name not in leaf_diagnosers:
+            leaf_diagnosers[model.name] = LeafDiagnoser(model.predictor, leaf_classifier)
+        return leaf_diagnosers[model.name]
+
+
+def get_severity_estimator(model):
+    """
+    :param model: The LoadedModel to find lesions with
+    :return: A SeverityEstimator running on the model's predictor
+    """
+    with leaf_classifier_lock:
+        if model.name not in severity_estimators:
+            severity_estimators[model.name] = SeverityEstimator(model.predictor)
+        return severity_estimators[model.name]
+
+
+def box_is_valid(box):
+    """
+    Whether a box has finite coordinates and a positive area.
+
+    :param box: Array of shape (4,) in [x1, y1, x2, y2] format
+    :return: True if x1 < x2 and y1 < y2
+    """
+    return bool(np.all(np.isfinite(box)) and box[0] < box[2] and box[1] < box[3])
+
+
+def parse_prompts(prompts):
+    """
+    Validates the prompts of a batch request and groups them so that each group
+    can be run as a single batched prediction. Prompts in a group share the same
+    kinds of input (box and/or points) and the same number of points.
+
+    :param prompts: List of dicts with an optional 'box' ([x1, y1, x2, y2]) and
+        optional 'points' ([[x, y], ...]) with matching 'labels' (1 for foreground,
+        0 for background, all foreground if omitted)
+    :return: Dict mapping a group key to (prompt indices, point coords, point labels, boxes)
+    :raises ValueError: If a prompt is malformed
+    """
+    if not isinstance(prompts, list) or len(prompts) == 0:
+        raise ValueError("'prompts' must be a non-empty list")
+    groups = {}
+    for i, prompt in enumerate(prompts):
+        if not isinstance(prompt, dict):
+            raise ValueError(f"Prompt {i} must be an object")
+        box = prompt.get('box')
+        points = prompt.get('points')
+        if box is None and points is None:
+            raise ValueError(f"Prompt {i} needs a 'box' or 'points'")
+        if box is not None:
+            try:
+                box = np.asarray(box, dtype=float)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Prompt {i}: 'box' must be [x1, y1, x2, y2] ({e})")
+            if box.shape != (4,):
+                raise ValueError(f"Prompt {i}: 'box' must be [x1, y1, x2, y2]")
+            if not box_is_valid(box):
+                raise ValueError(f"Prompt {i}: 'box' must have x1 < x2 and y1 < y2")
+        labels = None
+        if points is not None:
+            try:
+                points = np.asarray(points, dtype=float)
+                labels = np.asarray(prompt.get('labels', [1] * len(points)), dtype=int)
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"Prompt {i}: 'points' must be a list of [x, y] pairs with "
+                                 f"matching 'labels' ({e})")
+            if points.ndim != 2 or points.shape[0] == 0 or points.shape[1] != 2:
+                raise ValueError(f"Prompt {i}: 'points' must be a list of [x, y] pairs")
+            if labels.shape != (len(points),):
+                raise ValueError(f"Prompt {i}: 'labels' must have one entry per point")
+        key = (box is not None, 0 if points is None else len(points))
+        indices, coords, point_labels, boxes = groups.setdefault(key, ([], [], [], []))
+        indices.append(i)
+        if points is not None:
+            coords.append(points)
+            point_labels.append(labels)
+        if box is not None:
+            boxes.append(box)
+    return groups
 
-# Initialize the automatic mask generator
-predictor = SamPredictor(sam)
 
 # Initialize the Flask application
 app = Flask(__name__, template_folder='templates', static_folder='static', static_url_path='/static')
 
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    requests_total.inc(endpoint=endpoint, status=str(response.status_code))
+    return response
+
+
+@app.errorhandler(Rejected)
+def rejected(e):
+    """
+    Answers requests turned away by admission control.
+
+    :return: JSON error with HTTP 429 or 503 and a Retry-After header
+    """
+    return jsonify({'error': str(e)}), e.status, {'Retry-After': str(e.retry_after)}
+
+
 @app.route('/')
 def index():
     """
@@ -39,14 +487,68 @@ def index():
 
 
 
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness probe. The process is alive as long as it answers, unless the
+    model failed to load, in which case restarting it is the only remedy.
+
+    :return: JSON status, with HTTP 500 if model initialization failed
+    """
+    if model_error is not None:
+        return jsonify({'status': 'error', 'error': model_error}), 500
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness probe. Reports ready once the models are loaded (and warmed up,
+    if warmup is enabled).
+
+    :return: JSON status, with HTTP 503 while the model is still initializing
+    """
+    if not model_ready.is_set():
+        return jsonify({'status': 'loading'}), 503
+    return jsonify({
+        'status': 'ready',
+        'models': registry.names,
+        'default_model': registry.default,
+        'device': str(device),
+        'in_flight': admission.in_flight,
+        'queued': admission.queued
+    })
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    Serves the metrics of this process in the Prometheus text format.
+
+    :return: The metrics as plain text
+    """
+    return Response(metrics.render(), content_type=metrics.content_type)
+
+
 @app.route('/predict', methods=['POST'])
 def predict():
     """
     Handles the image upload, processes the image with the SAM model, generates a mask,
     and returns the processed image along with device and GPU information as a JSON response.
 
-    :return: JSON response with the processed image and device/GPU information
+    The model is chosen by the optional 'model' form field (e.g. 'vit_h' for offline
+    batch jobs) or, failing that, by the optional X-Latency-Budget-Ms header, which
+    selects the most accurate model expected to answer within the budget.
+
+    Requests that cannot get a turn soon are rejected with 429 or 503 and a
+    Retry-After header (see admission.py).
+
+    :return: JSON response with the processed image, the model used and device/GPU information
     """
+    if not model_ready.is_set():
+        return jsonify({'error': 'Model is still loading'}), 503, {'Retry-After': '5'}
+    deadline = request_deadline()
+
     try:
         # Check if a file has been uploaded
         if 'file' not in request.files:
@@ -58,69 +560,64 @@ def predict():
         y2 = request.form.get('y2', type=float)
 
         print(f"Received coordinates: x1={x1}, y1={y1}, x2={x2}, y2={y2}")
+        if None in (x1, y1, x2, y2):
+            return jsonify({'error': 'x1, y1, x2 and y2 must all be numbers'}), 400
 
         bbox_prompt = np.array([[x1, y1, x2, y2]])  # Bounding Box
+        if not box_is_valid(bbox_prompt[0]):
+            return jsonify({'error': 'The box must have x1 < x2 and y1 < y2'}), 400
+
+        # Pick the model for this request
+        try:
+            model = select_model()
+        except KeyError as e:
+            return jsonify({'error': f'Unknown model {e.args[0]}, available models: {registry.names}'}), 400
 
         # Get the device being used (GPU or CPU)
         device_used = "GPU" if torch.cuda.is_available() else "CPU"
 
-        # Load the uploaded image
-        file = request.files['file']
-        image = Image.open(file.stream).convert("RGB")
-        image_np = np.array(image)
+        data = request.files['file'].read()
+        key = embedding_key(model, data)
 
         # Log the device information
-        print(f"Running on: {device_used}")
-
-        # Generate masks using the SAM model
-        predictor.set_image(image_np)
-        masks, _, _ = predictor.predict(
-            point_coords=None,
-            point_labels=None,
-            box=bbox_prompt,
-            multimask_output=False,
-        )
-
-        plt.cla()
+        print(f"Running on: {device_used} with {model.name}")
 
-        def show_box(box, ax):
-            x0, y0 = box[0], box[1]
-            w, h = box[2] - box[0], box[3] - box[1]
-            ax.add_patch(plt.Rectangle((x0, y0), w, h, edgecolor='green', facecolor=(0, 0, 0, 0), lw=2))
-
-        def show_mask(mask, ax, random_color=False):
-            if random_color:
-                color = np.concatenate([np.random.random(3), np.array([0.6])], axis=0)
-            else:
-                color = np.array([30 / 255, 144 / 255, 255 / 255, 0.6])
-            h, w = mask.shape[-2:]
-            mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-            ax.imshow(mask_image)
-
-        plt.imshow(image_np)
-        show_mask(masks[0], plt.gca())
-        show_box(bbox_prompt[0], plt.gca())
-        plt.axis('off')
+        # Wait for a turn, then load the uploaded image and generate masks using the
+        # SAM model. The predictor holds the current image, so requests for the same
+        # model also take turns on it
+        queued_at = time.perf_counter()
+        with admission.admit(request_priority(key), deadline):
+            queue_wait_seconds.observe(time.perf_counter() - queued_at)
+            image_np, original_size = decode_image(model, data)
+            with model.lock:
+                start = time.perf_counter()
+                from_store = set_image(model, key, image_np, original_size)
+                # Only the area around the box is upsampled to full resolution
+                decoder_batch_size.observe(1)
+                masks, _, _, offset = model.predictor.predict_in_box(
+                    box=bbox_prompt[0],
+                    multimask_output=False,
+                )
+                # Requests answered from the embedding store skip the encoder, so
+                # their time says nothing about what a new image would take
+                if not from_store:
+                    model.record_latency((time.perf_counter() - start) * 1000)
 
-        # Save the image to a byte stream with tight bounding box
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', bbox_inches='tight', pad_inches=0)
-        buf.seek(0)
-
-        # Encode the image in base64 format
-        img_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
+        with stage_seconds.time(stage='render', model=model.name):
+            img_base64 = render_masks(image_np, masks, bbox_prompt, offsets=[offset], original_size=original_size)
 
         # Return the processed image and GPU information as JSON
-        return jsonify({
-            'image': img_base64,
-            'gpu': torch.cuda.is_available(),
-            'device': device_used
-        })
+        with stage_seconds.time(stage='encode', model=model.name):
+            return jsonify({
+                'image': img_base64,
+                'gpu': torch.cuda.is_available(),
+                'device': device_used,
+                'model': model.name
+            })
 
-    except RuntimeError as e:
+    except (RuntimeError, MemoryError) as e:
         # Handle runtime errors, such as GPU out of memory (OOM) errors
-        print(f"Runtime error: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
     finally:
         # Ensure GPU memory is cleared after task completion, whether successful or not
@@ -129,6 +626,187 @@ def predict():
             print("GPU cache cleared.")
 
 
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Segments several objects in one uploaded image. The 'prompts' form field holds a
+    JSON list of prompts, each with a 'box' and/or 'points' (see parse_prompts). The
+    image is encoded once and prompts of the same shape are decoded together in a
+    single batched call. The model is chosen, and the request admitted, as for /predict.
+
+    :return: JSON response with an image showing all masks, and per prompt (in request
+        order) the mask as an uncompressed RLE, its bounding box and predicted quality
+    """
+    if not model_ready.is_set():
+        return jsonify({'error': 'Model is still loading'}), 503, {'Retry-After': '5'}
+    deadline = request_deadline()
+
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        try:
+            groups = parse_prompts(json.loads(request.form.get('prompts', '')))
+        except ValueError as e:
+            return jsonify({'error': f'Invalid prompts: {e}'}), 400
+
+        try:
+            model = select_model()
+        except KeyError as e:
+            return jsonify({'error': f'Unknown model {e.args[0]}, available models: {registry.names}'}), 400
+
+        data = request.files['file'].read()
+        key = embedding_key(model, data)
+        n_prompts = sum(len(indices) for indices, _, _, _ in groups.values())
+        print(f"Running {n_prompts} prompts in {len(groups)} batches with {model.name}")
+
+        masks = [None] * n_prompts
+        scores = [None] * n_prompts
+        queued_at = time.perf_counter()
+        with admission.admit(request_priority(key), deadline):
+            queue_wait_seconds.observe(time.perf_counter() - queued_at)
+            image_np, original_size = decode_image(model, data)
+            with model.lock:
+                start = time.perf_counter()
+                from_store = set_image(model, key, image_np, original_size)
+                for indices, coords, labels, boxes in groups.values():
+                    decoder_batch_size.observe(len(indices))
+                    group_masks, group_scores, _ = model.predictor.predict_batch(
+                        point_coords=np.stack(coords) if coords else None,
+                        point_labels=np.stack(labels) if labels else None,
+                        boxes=np.stack(boxes) if boxes else None,
+                        multimask_output=False,
+                    )
+                    for i, mask, score in zip(indices, group_masks[:, 0], group_scores[:, 0]):
+                        masks[i] = mask
+                        scores[i] = float(score)
+                # Store hits skip the encoder and would skew the estimate, see /predict
+                if not from_store:
+                    model.record_latency((time.perf_counter() - start) * 1000)
+
+        prompt_boxes = [box for _, _, _, boxes in groups.values() for box in boxes]
+        with stage_seconds.time(stage='render', model=model.name):
+            img_base64 = render_masks(image_np, masks, prompt_boxes, original_size=original_size)
+
+        with stage_seconds.time(stage='encode', model=model.name):
+            masks_torch = torch.from_numpy(np.stack(masks))
+            rles = mask_to_rle_pytorch(masks_torch)
+            mask_boxes = batched_mask_to_box(masks_torch).tolist()
+            return jsonify({
+                'image': img_base64,
+                'masks': [
+                    {'rle': rle, 'bbox': bbox, 'score': score}
+                    for rle, bbox, score in zip(rles, mask_boxes, scores)
+                ],
+                'gpu': torch.cuda.is_available(),
+                'device': "GPU" if torch.cuda.is_available() else "CPU",
+                'model': model.name
+            })
+
+    except (RuntimeError, MemoryError) as e:
+        # Handle runtime errors, such as GPU out of memory (OOM) errors
+        return error_response(e)
+
+    finally:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+@app.route('/diagnose', methods=['POST'])
+def diagnose():
+    """
+    Finds the leaves in an uploaded photo and diagnoses each with the PlantDis
+    classifier (see leaf_pipeline.py). Leaves are found automatically, or given by
+    the optional 'boxes' form field, a JSON list of [x1, y1, x2, y2] boxes. The
+    image is encoded once (or its embedding taken from the store) and all leaves
+    are classified in one batch. With the optional 'severity' form field set to 1,
+    lesions are segmented on the leaves too and measured (see severity.py). The
+    model is chosen, and the request admitted, as for /predict.
+
+    :return: JSON response with, per leaf, its mask as an uncompressed RLE at the
+        size the image was decoded to, its bounding box in the original image,
+        its predicted quality and the predicted plant and disease with the most
+        likely classes, and with 'severity' its lesion coverage, lesion count and
+        lesion size histogram over 'lesion_bin_edges' (fractions of the leaf area)
+    """
+    if leaf_classifier_path is None:
+        return jsonify({'error': 'Leaf diagnosis is not enabled, set PLANTDIS_CLASSIFIER'}), 404
+    if not model_ready.is_set():
+        return jsonify({'error': 'Model is still loading'}), 503, {'Retry-After': '5'}
+    deadline = request_deadline()
+
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file uploaded'}), 400
+        boxes = None
+        if request.form.get('boxes'):
+            try:
+                boxes = np.asarray(json.loads(request.form['boxes']), dtype=float)
+            except (TypeError, ValueError) as e:
+                return jsonify({'error': f'Invalid boxes: {e}'}), 400
+            if boxes.ndim != 2 or boxes.shape[0] == 0 or boxes.shape[1] != 4:
+                return jsonify({'error': "Invalid boxes: 'boxes' must be a list of [x1, y1, x2, y2]"}), 400
+            if not all(box_is_valid(box) for box in boxes):
+                return jsonify({'error': 'Invalid boxes: each box must have x1 < x2 and y1 < y2'}), 400
+
+        try:
+            model = select_model()
+        except KeyError as e:
+            return jsonify({'error': f'Unknown model {e.args[0]}, available models: {registry.names}'}), 400
+        diagnoser = get_leaf_diagnoser(model)
+        estimator = get_severity_estimator(model) if request.form.get('severity') == '1' else None
+
+        data = request.files['file'].read()
+        key = embedding_key(model, data)
+
+        queued_at = time.perf_counter()
+        with admission.admit(request_priority(key), deadline):
+            queue_wait_seconds.observe(time.perf_counter() - queued_at)
+            image_np, original_size = decode_image(model, data)
+            # Leaves are cropped for the classifier from the full-resolution photo
+            with stage_seconds.time(stage='decode', model=model.name):
+                full_image = decode_full_image(data)
+            with model.lock:
+                start = time.perf_counter()
+                from_store = set_image(model, key, image_np, original_size)
+                # Only the encoder time goes into the latency estimate: finding and
+                # classifying leaves takes far longer than a /predict decode, and
+                # embedding store hits skip the encoder altogether
+                if not from_store:
+                    model.record_latency((time.perf_counter() - start) * 1000)
+                leaves = diagnoser.diagnose(image_np, boxes=boxes, image_is_set=True,
+                                            original_size=original_size, full_image=full_image)
+                severity = None
+                if estimator is not None:
+                    severity = estimator.estimate(
+                        image_np, leaf_masks=[leaf['segmentation'] for leaf in leaves],
+                        image_is_set=True, original_size=original_size)
+                    for leaf, report in zip(leaves, leaf_reports(severity)):
+                        leaf['severity'] = report
+        print(f"Diagnosed {len(leaves)} leaves with {model.name}")
+
+        with stage_seconds.time(stage='encode', model=model.name):
+            rles = []
+            if leaves:
+                rles = mask_to_rle_pytorch(torch.from_numpy(np.stack([leaf.pop('segmentation') for leaf in leaves])))
+            response = {
+                'leaves': [dict(leaf, rle=rle) for leaf, rle in zip(leaves, rles)],
+                'gpu': torch.cuda.is_available(),
+                'device': "GPU" if torch.cuda.is_available() else "CPU",
+                'model': model.name
+            }
+            if severity is not None:
+                response['lesion_bin_edges'] = severity['bin_edges'].tolist()
+            return jsonify(response)
+
+    except (RuntimeError, MemoryError) as e:
+        # Handle runtime errors, such as GPU out of memory (OOM) errors
+        return error_response(e)
+
+    finally:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
 if __name__ == '__main__':
     # Start the Flask app on port 5000
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,331 @@
+# Model artifact store
+#
+# Downloads model files once into a single cache directory shared by every
+# working directory and process on the host, instead of next to wherever a
+# command happens to run. Downloads go to a temporary file that is renamed
+# into place once complete, so a crash never leaves a truncated model behind,
+# and a lock file keeps concurrent processes from downloading the same file
+# twice. Downloads shorter than their Content-Length are rejected, and each
+# file's SHA-256 (and, for SAM checkpoints, the MD5 prefix in the file name)
+# is checked against its published digest, including for files found already
+# in place. A file with no published digest is only checked for its size, and
+# its SHA-256 is recorded on the first download so later corruption is
+# detected. Offline hosts can point the store at a local mirror directory
+# holding the files.
+#
+# This module is kept with the SAM server and also used by the mlhub package,
+# which MLHUB.yaml installs it into as mlhub/artifacts.py.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+default_cache_dir = os.environ.get('PLANTDIS_MODEL_CACHE') \
+    or os.path.join(os.path.expanduser('~'), '.cache', 'plantdis', 'models')
+default_mirror = os.environ.get('PLANTDIS_MODEL_MIRROR') or None
+
+chunk_bytes = 1 << 20
+
+
+class Artifact:
+    """
+    A model file that can be downloaded.
+
+    :param name: File name in the store
+    :param urls: Where to download it from, tried in order
+    :param sha256: Published hex digest, or None to record it on first download
+    :param md5_prefix: Leading hex digits of the file's MD5, e.g. as published in
+        the SAM checkpoint names
+    :param min_bytes: Smaller files are treated as failed downloads, e.g. the
+        HTML page a file host answers with instead of the file
+    """
+
+    def __init__(self, name, urls, sha256=None, md5_prefix=None, min_bytes=0, description=''):
+        self.name = name
+        self.urls = list(urls)
+        self.sha256 = sha256
+        self.md5_prefix = md5_prefix
+        self.min_bytes = min_bytes
+        self.description = description
+
+
+# The models used by this repository, by file name. The SAM checkpoints are
+# named after the first digits of their MD5
+ARTIFACTS = dict((a.name, a) for a in [
+    Artifact(
+        'pdorft_efficientnetb2_3.h5',
+        # right click on drive file to getlink(view only); the id in that
+        # link goes here. The file has no published digest
+        ['https://drive.google.com/uc?id=1mAxgMNJZ2c_5c16YdAaQWZ5H06BuBAF9'],
+        min_bytes=10 * 1000 * 1000,
+        description='PlantDis EfficientNetB2 classifier (130 MB)',
+    ),
+    Artifact(
+        'sam_vit_h_4b8939.pth',
+        ['https://dl.fbaipublicfiles.com/segment_anything/sam_vit_h_4b8939.pth'],
+        sha256='a7bf3b02f3ebf1267aba913ff637d9a2d5c33d3173bb679e46d9f338c26f262e',
+        md5_prefix='4b8939',
+        min_bytes=100 * 1000 * 1000,
+        description='SAM ViT-H checkpoint (2.4 GB)',
+    ),
+    Artifact(
+        'sam_vit_l_0b3195.pth',
+        ['https://dl.fbaipublicfiles.com/segment_anything/sam_vit_l_0b3195.pth'],
+        sha256='3adcc4315b642a4d2101128f611684e8734c41232a17c648ed1693702a49a622',
+        md5_prefix='0b3195',
+        min_bytes=100 * 1000 * 1000,
+        description='SAM ViT-L checkpoint (1.2 GB)',
+    ),
+    Artifact(
+        'sam_vit_b_01ec64.pth',
+        ['https://dl.fbaipublicfiles.com/segment_anything/sam_vit_b_01ec64.pth'],
+        sha256='ec2df62732614e57411cdcf32a23ffdf28910380d03139ee0f4fcbe91eb8c912',
+        md5_prefix='01ec64',
+        min_bytes=100 * 1000 * 1000,
+        description='SAM ViT-B checkpoint (375 MB)',
+    ),
+])
+
+
+class VerificationError(Exception):
+    """
+    Raised when a model file does not match its expected digest.
+    """
+
+
+def hash_file(path):
+    # The SHA-256 and MD5 hex digests of a file, from one read of it
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def verify(artifact, sha256, md5):
+    """
+    :raises VerificationError: If the digests of a file do not match the artifact's
+    """
+    if artifact.sha256 is not None and sha256 != artifact.sha256:
+        raise VerificationError(f"SHA-256 is {sha256}, expected {artifact.sha256}")
+    if artifact.md5_prefix is not None and not md5.startswith(artifact.md5_prefix):
+        raise VerificationError(f"MD5 is {md5}, expected {artifact.md5_prefix}...")
+
+
+@contextmanager
+def _locked(path):
+    # An exclusive lock held for the duration of the with block, released by
+    # the OS if the process dies
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ArtifactStore:
+    """
+    The cache directory holding downloaded model files.
+
+    Next to each file, <name>.sha256 records its digest along with the size
+    and modification time it had when hashed, so an unchanged file is not
+    hashed again on every start.
+    """
+
+    def __init__(self, cache_dir=None, mirror=None):
+        self.cache_dir = cache_dir or default_cache_dir
+        self.mirror = mirror if mirror is not None else default_mirror
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def fetch(self, artifact, candidates=(), before_download=None):
+        """
+        Returns the path of a verified copy of the artifact in the store,
+        getting it first if needed: from one of the candidate paths (e.g. a
+        copy downloaded by an older version to another directory), from the
+        mirror, or else from its URLs.
+
+        :param artifact: The Artifact, or its name in ARTIFACTS
+        :param candidates: Existing files that may hold the artifact
+        :param before_download: Called with 'missing' or 'corrupt' right
+            before downloading, e.g. to tell or ask the user
+        :raises VerificationError: If no source gives the expected file
+        """
+        if isinstance(artifact, str):
+            artifact = ARTIFACTS[artifact]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(artifact.name)
+
+        with _locked(path + '.lock'):
+            # Another process may have fetched it while this one waited
+            status = self.check(artifact)
+            if status == 'ok':
+                return path
+
+            sources = list(candidates)
+            if self.mirror:
+                sources.append(os.path.join(self.mirror, artifact.name))
+            for source in sources:
+                if os.path.isfile(source) and os.path.abspath(source) != os.path.abspath(path):
+                    try:
+                        self._install(artifact, lambda tmp: self._copy(source, tmp))
+                        return path
+                    except (OSError, VerificationError) as e:
+                        print(f"Not using {source}: {e}", file=sys.stderr)
+
+            if before_download is not None:
+                before_download(status)
+            errors = []
+            for url in artifact.urls:
+                try:
+                    self._install(artifact, lambda tmp: self._download(url, tmp))
+                    return path
+                except (OSError, VerificationError) as e:
+                    errors.append(f"{url}: {e}")
+            raise VerificationError(f"Could not get {artifact.name}: " + '; '.join(errors))
+
+    def check(self, artifact):
+        """
+        Returns 'ok' if the store holds a good copy of the artifact, 'missing'
+        if it holds none, or 'corrupt' if its copy is too small or its digest
+        does not match. A copy placed by hand is held to the published
+        digests like a download; one of a file without them is trusted, and
+        its digest recorded.
+        """
+        path = self.path(artifact.name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return 'missing'
+        if st.st_size < artifact.min_bytes:
+            return 'corrupt'
+        recorded = self._read_digest(path, st)
+        if recorded is None:
+            # Placed by hand, or changed since it was recorded
+            previous = self._read_digest(path)
+            digest, md5 = hash_file(path)
+            if previous is not None and previous != digest:
+                return 'corrupt'
+            try:
+                verify(artifact, digest, md5)
+            except VerificationError:
+                return 'corrupt'
+            self._write_digest(path, digest)
+            recorded = digest
+        if artifact.sha256 is not None and recorded != artifact.sha256:
+            return 'corrupt'
+        return 'ok'
+
+    def _install(self, artifact, write):
+        # Writes the artifact to a temporary file in the cache directory with
+        # write(tmp_path), verifies it and renames it into place
+        path = self.path(artifact.name)
+        fd, tmp = tempfile.mkstemp(prefix=artifact.name + '.', suffix='.partial',
+                                   dir=self.cache_dir)
+        os.close(fd)
+        try:
+            write(tmp)
+            size = os.path.getsize(tmp)
+            if size < artifact.min_bytes:
+                raise VerificationError(f"got {size} bytes, expected at least {artifact.min_bytes}")
+            digest, md5 = hash_file(tmp)
+            verify(artifact, digest, md5)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self._write_digest(path, digest)
+
+    @staticmethod
+    def _copy(source, tmp):
+        shutil.copyfile(source, tmp)
+
+    @staticmethod
+    def _download(url, tmp):
+        print(f"Downloading {url}", file=sys.stderr)
+        if 'drive.google.com' in url:
+            # Google Drive asks for confirmation on large files, which gdown handles
+            import gdown
+            if gdown.download(url, tmp, quiet=False) is None:
+                raise OSError('download failed')
+            return
+        with urllib.request.urlopen(url, timeout=60) as r, open(tmp, 'wb') as f:
+            total = int(r.headers.get('Content-Length') or 0)
+            done = 0
+            last = time.monotonic()
+            for chunk in iter(lambda: r.read(chunk_bytes), b''):
+                f.write(chunk)
+                done += len(chunk)
+                if time.monotonic() - last > 5:
+                    last = time.monotonic()
+                    progress = f" of {total / 1e6:.0f}" if total else ''
+                    print(f"  {done / 1e6:.0f}{progress} MB", file=sys.stderr)
+        # A connection closed early ends the read without an error
+        if total and done != total:
+            raise OSError(f"got {done} of {total} bytes")
+
+    @staticmethod
+    def _read_digest(path, st=None):
+        # The recorded digest, or None if there is none or, given the file's
+        # stat, the file changed since it was recorded
+        try:
+            with open(path + '.sha256') as f:
+                digest, size, mtime_ns = f.read().split()
+        except (OSError, ValueError):
+            return None
+        if st is not None and (int(size), int(mtime_ns)) != (st.st_size, st.st_mtime_ns):
+            return None
+        return digest
+
+    @staticmethod
+    def _write_digest(path, digest):
+        st = os.stat(path)
+        tmp = f"{path}.sha256.{os.getpid()}"
+        with open(tmp, 'w') as f:
+            f.write(f"{digest} {st.st_size} {st.st_mtime_ns}\n")
+        os.replace(tmp, path + '.sha256')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fetch model files into the model store, e.g. ahead of deployment')
+    parser.add_argument('names', nargs='+', choices=sorted(ARTIFACTS))
+    parser.add_argument('--cache-dir', default=None,
+                        help='store directory (default: $PLANTDIS_MODEL_CACHE or ~/.cache/plantdis/models)')
+    parser.add_argument('--mirror', default=None,
+                        help='directory holding the files, for offline hosts (default: $PLANTDIS_MODEL_MIRROR)')
+    args = parser.parse_args()
+    store = ArtifactStore(args.cache_dir, args.mirror)
+    for name in args.names:
+        print(store.fetch(name))
@@ -0,0 +1,77 @@
+# Gunicorn configuration for serving the SAM Flask app with several workers.
+#
+# The master binds the port and forks the workers straight away. Each worker
+# imports the app, which loads the model on a background thread, so health
+# probes are answered while the checkpoint loads (or downloads). The weights
+# are memory-mapped from the checkpoint where its format allows (see
+# segment_anything/utils/checkpoint.py), so the workers share the file's pages
+# in the page cache rather than each holding a copy. Start the server with:
+#
+#     gunicorn -c gunicorn.conf.py app:app
+
+import gc
+import os
+
+import torch
+
+bind = os.environ.get("SAM_BIND", "0.0.0.0:5000")
+# On GPU hosts the weights cannot be shared, so every worker would load its
+# own copy of the model into GPU memory; default to one there and let
+# SAM_WORKERS override it.
+workers = int(os.environ.get("SAM_WORKERS", "1" if torch.cuda.is_available() else "2"))
+
+# Each worker runs requests on a pool of threads, so that requests beyond the
+# ones running inference reach app.py's admission control (which queues them by
+# priority, or turns them away with 429/503 and Retry-After) instead of waiting
+# unseen in the listen backlog, and health probes are answered during a long
+# encode. The models themselves are still used by one request at a time, under
+# each LoadedModel's lock. The pool has room for every admitted and queued
+# request plus a few probes; SAM_THREADS overrides it.
+worker_class = "gthread"
+threads = int(os.environ.get(
+    "SAM_THREADS",
+    int(os.environ.get("SAM_MAX_IN_FLIGHT", "1")) + int(os.environ.get("SAM_MAX_QUEUE", "8")) + 4,
+))
+
+# Encoding a large image on CPU can take a while.
+timeout = int(os.environ.get("SAM_WORKER_TIMEOUT", "300"))
+
+# SAM_PRELOAD=1 loads the model in the master before forking, so the workers
+# share its pages copy-on-write even for checkpoints that cannot be
+# memory-mapped (legacy .pth files, or torch<2.1). Gunicorn loads a preloaded
+# app before it binds the port, so nothing answers, not even /healthz, until
+# the model is loaded. A CUDA context cannot survive a fork, so on GPU hosts
+# each worker always loads the model itself.
+preload_app = os.environ.get("SAM_PRELOAD", "0") == "1" and not torch.cuda.is_available()
+
+if preload_app:
+    # Tells app.py to load the model synchronously at import rather than on a
+    # background thread, since threads do not survive the fork.
+    os.environ["SAM_PREFORK"] = "1"
+    # This file is read before the app is imported. Keep the collector from
+    # touching objects while the model loads; its bookkeeping writes would
+    # otherwise dirty pages we want to share.
+    gc.disable()
+
+
+def pre_fork(server, worker):
+    # Move everything allocated so far (modules, parameters, tensor wrappers)
+    # into the permanent generation. The collector never visits those objects
+    # in the workers, so their pages stay shared. The tensor data itself lives
+    # in separate mmap'd/malloc'd storage that refcount updates never write to.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    # Split the cores between workers rather than letting every worker start
+    # a full-size intra-op thread pool.
+    threads = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+    torch.set_num_threads(threads)
+
+    if preload_app:
+        # The master only loaded the weights; warming up runs inference, which
+        # must happen in the worker, after the fork.
+        import app
+
+        app.start_model_initialization()
@@ -0,0 +1,303 @@
+import importlib.util
+import io
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from model_registry import resolve_checkpoint
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import batched_mask_to_box
+
+# The PlantDis disease classifier, an EfficientNetB2 trained on leaf photos. The
+# published Keras model is fetched into the model store when no file is given
+DEFAULT_CLASSIFIER = 'pdorft_efficientnetb2_3.h5'
+
+
+def classifier_module():
+    """
+    Imports mlhub's classifier.py, which holds the PlantDis classes in the order
+    of the model's outputs, its input size and the code running Keras and TFLite
+    (also quantized) models, so the server runs the classifier the same way the
+    mlhub commands do. The module is imported from the path if it is there, e.g.
+    copied next to app.py, and otherwise from the repository's mlhub directory.
+    """
+    try:
+        import classifier
+        return classifier
+    except ImportError:
+        pass
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mlhub', 'classifier.py')
+    if not os.path.exists(path):
+        raise ImportError("Leaf diagnosis needs mlhub/classifier.py; copy it next to app.py")
+    spec = importlib.util.spec_from_file_location('classifier', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LeafClassifier:
+    """
+    The PlantDis classifier, loaded from a Keras (.h5) or TFLite (.tflite) file
+    with mlhub's classifier code. TensorFlow (or, for TFLite, one of the lighter
+    TFLite runtimes) is only imported here, so the server does not need it unless
+    leaves are diagnosed. Calls are serialized, since neither kind of model may be
+    run from several threads at once.
+
+    Leaves are classified in batches of a fixed size, padded like mlhub's
+    predict_batches, so the model always sees the same input shape however many
+    leaves a photo has: Keras does not retrace its graph and the TFLite
+    interpreter allocates its tensors once.
+    """
+
+    def __init__(self, model_path=DEFAULT_CLASSIFIER, threads=None, batch_size=16):
+        """
+        :param model_path: The model file, e.g. one converted by mlhub's convert_tflite.
+            The published model is downloaded into the model store if not found
+        :param threads: Threads used for inference (default: all cores)
+        :param batch_size: Leaves per model call; photos with more leaves take
+            several calls
+        """
+        classifier = classifier_module()
+        self.model_path = resolve_checkpoint(model_path)
+        self.classes = classifier.diseases
+        self.input_size = classifier.img_size
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.model = classifier.load_model(self.model_path, threads)
+
+    def __call__(self, images):
+        """
+        :param images: Leaf images of shape (n, input_size, input_size, 3), uint8 RGB
+        :return: Class probabilities of shape (n, len(classes))
+        """
+        n = len(images)
+        if n == 0:
+            return np.zeros((0, len(self.classes)), np.float32)
+        padded = np.zeros((-(-n // self.batch_size) * self.batch_size,) + np.shape(images)[1:], np.float32)
+        padded[:n] = images
+        with self.lock:
+            probs = [np.asarray(self.model.predict_on_batch(batch))
+                     for batch in np.split(padded, len(padded) // self.batch_size)]
+        return np.concatenate(probs)[:n]
+
+
+def decode_full_image(data):
+    """
+    Decodes an uploaded image at its original resolution, the same way (and so in
+    the same orientation) as the predictor's transform.decode_image does at the
+    encoder's input size.
+
+    :param data: The encoded image file contents
+    :return: HWC uint8 RGB image
+    """
+    return np.array(Image.open(io.BytesIO(data)).convert('RGB'))
+
+
+@contextmanager
+def masks_at_image_size(predictor, image):
+    """
+    Makes the predictor return masks at the resolution of the given image rather
+    than at the size of the photo its embedding may have been computed for, e.g.
+    for an image decoded at the encoder's input size. Prompts are then given in
+    the image's coordinates too.
+
+    :param predictor: A SamPredictor holding the image's embedding
+    :param image: The HWC image
+    """
+    saved_size = predictor.original_size
+    predictor.original_size = image.shape[:2]
+    try:
+        yield
+    finally:
+        predictor.original_size = saved_size
+
+
+def select_leaves(masks, min_fraction=0.01, max_fraction=0.9, containment_thresh=0.9):
+    """
+    Picks the masks of whole leaves out of the automatic mask generator's output,
+    which also segments the background and parts of leaves (lesions, veins,
+    halves). Masks covering too little or too much of the image are dropped, and
+    so is any mask lying mostly inside a larger selected mask.
+
+    :param masks: Boolean masks of shape (n, H, W)
+    :param min_fraction: Smallest leaf, as a fraction of the image area
+    :param max_fraction: Largest leaf, as a fraction of the image area; larger
+        masks are taken to be background
+    :param containment_thresh: A mask with more than this fraction of its area
+        inside a larger leaf is taken to be part of it
+    :return: Indices of the selected masks, largest first
+    """
+    n = len(masks)
+    if n == 0:
+        return []
+    flat = torch.from_numpy(masks).reshape(n, -1)
+    areas = flat.sum(dim=1).numpy()
+    total = flat.shape[1]
+    candidates = np.flatnonzero((areas >= min_fraction * total) & (areas <= max_fraction * total))
+    candidates = candidates[np.argsort(-areas[candidates], kind='stable')]
+    if len(candidates) == 0:
+        return []
+
+    # Pairwise overlaps from one matrix product, on masks subsampled to about
+    # 256 pixels along the longer side
+    step = max(1, max(masks.shape[1:]) // 256)
+    small = torch.from_numpy(masks[candidates, ::step, ::step]).reshape(len(candidates), -1).float()
+    overlap = small @ small.T
+    inside = (overlap / overlap.diagonal().clamp(min=1)[:, None]).numpy()
+
+    selected = []
+    for i in range(len(candidates)):
+        if selected and inside[i, selected].max() > containment_thresh:
+            continue
+        selected.append(i)
+    return candidates[selected].tolist()
+
+
+def crop_boxes(image, boxes, size, margin=0.05):
+    """
+    Crops boxes out of an image, each widened by a margin and resized to the
+    classifier's input size.
+
+    :param image: HWC uint8 image
+    :param boxes: Array of shape (n, 4) with XYXY boxes in image coordinates
+    :param size: Side of the square crops
+    :param margin: Fraction of the box size added on every side
+    :return: Crops of shape (n, size, size, 3)
+    """
+    h, w = image.shape[:2]
+    crops = np.empty((len(boxes), size, size, image.shape[2]), dtype=image.dtype)
+    for i, (x0, y0, x1, y1) in enumerate(np.asarray(boxes, dtype=np.float64)):
+        dx, dy = (x1 - x0) * margin, (y1 - y0) * margin
+        x0, y0 = int(max(0, np.floor(x0 - dx))), int(max(0, np.floor(y0 - dy)))
+        x1, y1 = int(min(w, np.ceil(x1 + dx) + 1)), int(min(h, np.ceil(y1 + dy) + 1))
+        crops[i] = cv2.resize(image[y0:y1, x0:x1], (size, size))
+    return crops
+
+
+class LeafDiagnoser:
+    """
+    Finds the leaves in a photo with SAM and diagnoses each with the classifier.
+
+    The image is encoded once and its embedding is used for every leaf, whether
+    leaves are found by the automatic mask generator or given as box prompts.
+    The leaves' bounding boxes are then cropped, from the full-resolution photo
+    if given, and classified together, so a photo of many leaves costs one
+    encoder pass, one batched run of the mask decoder per batch of grid points
+    and one classifier call per batch of leaves.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        classifier,
+        points_per_side=16,
+        pred_iou_thresh=0.88,
+        stability_score_thresh=0.92,
+        min_leaf_fraction=0.01,
+        max_leaf_fraction=0.9,
+        containment_thresh=0.9,
+        crop_margin=0.05,
+        top_k=3,
+    ):
+        """
+        :param predictor: The SamPredictor to run, e.g. LoadedModel.predictor
+        :param classifier: A LeafClassifier, or anything mapping leaf crops to class
+            probabilities with its classes and input_size
+        :param points_per_side: Grid of the automatic mask generator; leaves are
+            large, so a coarser grid than the generator's default is enough
+        :param top_k: How many of the most likely classes to report per leaf
+        """
+        self.predictor = predictor
+        self.classifier = classifier
+        self.mask_generator = SamAutomaticMaskGenerator(
+            predictor.model,
+            points_per_side=points_per_side,
+            pred_iou_thresh=pred_iou_thresh,
+            stability_score_thresh=stability_score_thresh,
+            predictor=predictor,
+        )
+        self.min_leaf_fraction = min_leaf_fraction
+        self.max_leaf_fraction = max_leaf_fraction
+        self.containment_thresh = containment_thresh
+        self.crop_margin = crop_margin
+        self.top_k = top_k
+
+    @torch.no_grad()
+    def diagnose(self, image, boxes=None, image_is_set=False, original_size=None, full_image=None):
+        """
+        Segments and diagnoses the leaves in an image.
+
+        :param image: HWC uint8 RGB image. Masks are computed at its resolution, so
+            pass the image decoded at the encoder's input size rather than the
+            full-resolution photo
+        :param boxes: Optional array of shape (n, 4) with XYXY boxes around leaves, in
+            the coordinates of the original photo; leaves are found automatically if None
+        :param image_is_set: True if the predictor already holds the embedding of this
+            image, e.g. from the embedding store
+        :param original_size: (H, W) of the photo the image was downscaled from; boxes
+            and areas are given in its coordinates. Defaults to the image size
+        :param full_image: The photo at its original resolution, e.g. from
+            decode_full_image. Leaves are cropped from it for the classifier, so that
+            small leaves are not upsampled from a few pixels of the downscaled image
+        :return: One dict per leaf with its 'bbox' (XYWH), 'area' and SAM 'score', the
+            'segmentation' (boolean mask at the image's resolution), the most likely
+            'plant' and 'disease' with their 'probability', and the 'top_k' classes
+        """
+        h, w = image.shape[:2]
+        oh, ow = original_size if original_size is not None else (h, w)
+        scale = np.array([ow / w, oh / h, ow / w, oh / h])
+
+        predictor = self.predictor
+        if not image_is_set:
+            predictor.set_image(image)
+
+        with masks_at_image_size(predictor, image):
+            if boxes is None:
+                records = self.mask_generator.generate(image, image_is_set=True)
+                masks = np.stack([r['segmentation'] for r in records]) if records else np.zeros(
+                    (0,) + image.shape[:2], dtype=bool)
+                scores = np.array([r['predicted_iou'] for r in records], dtype=np.float32)
+                leaves = select_leaves(masks, self.min_leaf_fraction, self.max_leaf_fraction,
+                                       self.containment_thresh)
+                masks, scores = masks[leaves], scores[leaves]
+            else:
+                masks, scores, _ = predictor.predict_batch(
+                    boxes=np.asarray(boxes, dtype=np.float32).reshape(-1, 4) / scale,
+                    multimask_output=False)
+                masks, scores = masks[:, 0], scores[:, 0]
+
+        if len(masks) == 0:
+            return []
+        mask_boxes = batched_mask_to_box(torch.from_numpy(masks)).numpy()
+        size = self.classifier.input_size
+        if full_image is not None:
+            fh, fw = full_image.shape[:2]
+            crops = crop_boxes(full_image, mask_boxes * np.array([fw / w, fh / h, fw / w, fh / h]), size,
+                               self.crop_margin)
+        else:
+            crops = crop_boxes(image, mask_boxes, size, self.crop_margin)
+        probs = self.classifier(crops)
+
+        areas = masks.reshape(len(masks), -1).sum(axis=1) * (ow / w) * (oh / h)
+        ranked = np.argsort(-probs, axis=1)[:, :self.top_k]
+
+        results = []
+        for i in range(len(masks)):
+            x0, y0, x1, y1 = mask_boxes[i] * scale
+            top = [(self.classifier.classes[c].split('___'), float(probs[i, c])) for c in ranked[i]]
+            results.append({
+                'bbox': [float(x0), float(y0), float(x1 - x0), float(y1 - y0)],
+                'area': int(round(areas[i])),
+                'score': float(scores[i]),
+                'segmentation': masks[i],
+                'plant': top[0][0][0],
+                'disease': top[0][0][1],
+                'probability': top[0][1],
+                'top_k': [{'plant': p, 'disease': d, 'probability': prob} for (p, d), prob in top],
+            })
+        return results
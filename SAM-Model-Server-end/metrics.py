@@ -0,0 +1,222 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+# Latency buckets in seconds, from a mask decoder pass to a vit_h encode on CPU
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, such as a number of requests.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that can go up and down. Either set explicitly, or read from a
+    function each time the metrics are scraped.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            value = self.function()
+            if value is None:
+                return []
+            self.set(value)
+        return super().render()
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (e.g. latencies in seconds) into cumulative buckets,
+    along with their sum and count.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the wall time spent in the with block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = (('le', _format_value(bound)),)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The metrics of this process, rendered in the Prometheus text format for
+    the /metrics endpoint. Under gunicorn every worker keeps its own metrics.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self._add(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def _synchronize(device):
+    # GPU kernels run asynchronously; wait for them so a stage is charged
+    # with its own work rather than with whatever ran before it
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def instrument_model(sam, histogram, **labels):
+    """
+    Times the stages of a SAM model into a histogram with a 'stage' label:
+    preprocess, image_encoder, prompt_encoder, mask_decoder and
+    postprocess_masks. Submodules are timed with forward hooks; the pre- and
+    postprocessing methods are wrapped on this instance only.
+
+    :param sam: The Sam model
+    :param histogram: Histogram with labels ('stage',) plus the keys of labels
+    :param labels: Further label values, e.g. model='vit_h'
+    """
+    local = threading.local()
+
+    def pre_hook(module, args):
+        _synchronize(sam.device)
+        starts = getattr(local, 'starts', None)
+        if starts is None:
+            starts = local.starts = {}
+        starts[id(module)] = time.perf_counter()
+
+    def make_hook(stage):
+        def hook(module, args, output):
+            _synchronize(sam.device)
+            start = local.starts.pop(id(module), None)
+            if start is not None:
+                histogram.observe(time.perf_counter() - start, stage=stage, **labels)
+        return hook
+
+    for stage in ('image_encoder', 'prompt_encoder', 'mask_decoder'):
+        module = getattr(sam, stage)
+        module.register_forward_pre_hook(pre_hook)
+        module.register_forward_hook(make_hook(stage))
+
+    def wrap(method_name, stage):
+        method = getattr(sam, method_name)
+
+        def timed(*args, **kwargs):
+            _synchronize(sam.device)
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            _synchronize(sam.device)
+            histogram.observe(time.perf_counter() - start, stage=stage, **labels)
+            return result
+
+        setattr(sam, method_name, timed)
+
+    wrap('preprocess_images', 'preprocess')
+    wrap('postprocess_masks', 'postprocess_masks')
+    wrap('postprocess_masks_roi', 'postprocess_masks')
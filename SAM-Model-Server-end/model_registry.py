@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+
+from artifacts import ARTIFACTS, ArtifactStore
+from segment_anything import sam_model_registry, SamPredictor
+
+# Relative mask quality of the SAM backbones, best last. When a request gives a
+# latency budget, the best model expected to answer within it is used.
+MODEL_QUALITY_RANK = {"vit_b": 0, "vit_l": 1, "vit_h": 2, "default": 2}
+
+
+def resolve_checkpoint(checkpoint):
+    """
+    Returns the path to load a checkpoint from. A file that exists is used as
+    is. Otherwise a published SAM checkpoint is looked up by its file name in
+    the model store, which downloads it once for the host and verifies it
+    (see artifacts.py).
+    """
+    name = os.path.basename(checkpoint)
+    if os.path.exists(checkpoint) or name not in ARTIFACTS:
+        return checkpoint
+    return ArtifactStore().fetch(name)
+
+
+class LoadedModel:
+    """
+    One SAM variant held by the server: the model, its predictor, a lock
+    serializing access to the predictor's image state, and a running estimate
+    of how long an encode + predict takes on this host.
+    """
+
+    # Weight of the newest measurement in the latency estimate
+    latency_smoothing = 0.2
+
+    def __init__(self, model_type, checkpoint):
+        if model_type not in sam_model_registry:
+            raise ValueError(f"Unknown model type {model_type}, expected one of {list(sam_model_registry)}")
+        self.name = model_type
+        self.checkpoint = checkpoint
+        self.sam = None
+        self.predictor = None
+        self.lock = threading.Lock()
+        self.latency_ms = None
+
+    @property
+    def model_id(self):
+        """
+        Identifies the weights of this model, e.g. to key stored embeddings.
+        """
+        return f"{self.name}:{os.path.basename(self.checkpoint)}"
+
+    @property
+    def quality_rank(self):
+        return MODEL_QUALITY_RANK.get(self.name, 0)
+
+    def load(self, device):
+        """
+        Loads the model onto the given device and creates its predictor.
+        Does nothing if the model has already been loaded.
+        """
+        if self.predictor is not None:
+            return
+        self.checkpoint = resolve_checkpoint(self.checkpoint)
+        self.sam = sam_model_registry[self.name](checkpoint=self.checkpoint)
+        self.sam.to(device=device)
+        self.predictor = SamPredictor(self.sam)
+        print(f"Loaded {self.name} model from {self.checkpoint}")
+
+    def warmup(self):
+        """
+        Runs a dummy image and box through the image encoder and mask decoder so
+        their buffers are allocated before the first request arrives. The run
+        also gives the first latency measurement for this model.
+        """
+        size = self.sam.image_encoder.img_size
+        with self.lock:
+            start = time.perf_counter()
+            self.predictor.set_image(np.zeros((size, size, 3), dtype=np.uint8))
+            self.predictor.predict(box=np.array([0, 0, size // 2, size // 2]), multimask_output=False)
+            self.record_latency((time.perf_counter() - start) * 1000)
+            self.predictor.reset_image()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        print(f"Warmed up {self.name} model ({self.latency_ms:.0f} ms).")
+
+    def record_latency(self, latency_ms):
+        """
+        Folds a measured encode + predict time into the latency estimate.
+        """
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms += self.latency_smoothing * (latency_ms - self.latency_ms)
+
+
+class ModelRegistry:
+    """
+    The set of SAM variants served by this process.
+
+    Models are configured with a spec such as
+    "vit_b=./sam_vit_b_01ec64.pth,vit_h=./sam_vit_h_4b8939.pth". Requests can
+    ask for a model by name, or give a latency budget and get the best model
+    expected to meet it. Otherwise the default model is used, which is the
+    fastest configured model unless set explicitly.
+    """
+
+    def __init__(self, spec, device, default=None):
+        self.device = device
+        self.models = {}
+        for entry in spec.split(','):
+            model_type, _, checkpoint = entry.strip().partition('=')
+            if not checkpoint:
+                raise ValueError(f"Model entry '{entry}' must have the form <model_type>=<checkpoint>")
+            self.models[model_type] = LoadedModel(model_type, checkpoint)
+        if default is None:
+            default = min(self.models.values(), key=lambda m: m.quality_rank).name
+        if default not in self.models:
+            raise ValueError(f"Default model {default} is not one of the configured models {list(self.models)}")
+        self.default = default
+
+    @property
+    def names(self):
+        return list(self.models)
+
+    def load(self):
+        for model in self.models.values():
+            model.load(self.device)
+
+    def warmup(self):
+        for model in self.models.values():
+            model.warmup()
+
+    def select(self, name=None, latency_budget_ms=None):
+        """
+        Picks the model for a request.
+
+        :param name: Explicitly requested model type, if any
+        :param latency_budget_ms: Latency budget of the request in milliseconds, if any
+        :return: The LoadedModel to use
+        :raises KeyError: If the requested model is not configured
+        """
+        if name:
+            if name not in self.models:
+                raise KeyError(name)
+            return self.models[name]
+        if latency_budget_ms is None:
+            return self.models[self.default]
+
+        # Models without a measurement yet are assumed to fit, since warmup
+        # normally measures every model before the server reports ready.
+        fitting = [
+            m for m in self.models.values() if m.latency_ms is None or m.latency_ms <= latency_budget_ms
+        ]
+        if fitting:
+            return max(fitting, key=lambda m: m.quality_rank)
+        return min(self.models.values(), key=lambda m: m.latency_ms)
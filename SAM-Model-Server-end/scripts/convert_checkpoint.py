@@ -0,0 +1,45 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import os
+
+from segment_anything.utils.checkpoint import convert_checkpoint
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Converts a SAM checkpoint (e.g. sam_vit_h_4b8939.pth) to a format whose weights "
+        "can be memory-mapped at load time, so the server starts faster and never holds "
+        "two copies of the model in memory."
+    )
+)
+
+parser.add_argument(
+    "--checkpoint", type=str, required=True, help="The path to the SAM checkpoint to convert."
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    required=True,
+    help=(
+        "The filename to save the converted checkpoint to. A '.safetensors' suffix writes "
+        "safetensors (requires the safetensors package), anything else writes a zip-format "
+        "torch checkpoint."
+    ),
+)
+
+
+def main(args: argparse.Namespace) -> None:
+    print(f"Converting {args.checkpoint}...")
+    convert_checkpoint(args.checkpoint, args.output)
+    size_mb = os.path.getsize(args.output) / 1e6
+    print(f"Wrote {args.output} ({size_mb:.1f} MB).")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
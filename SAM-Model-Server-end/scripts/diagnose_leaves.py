@@ -0,0 +1,178 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+from leaf_pipeline import DEFAULT_CLASSIFIER, LeafClassifier, LeafDiagnoser, decode_full_image
+from model_registry import LoadedModel
+from scripts.precompute_embeddings import find_images
+from severity import SeverityEstimator, leaf_reports
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Finds the leaves in photos of several leaves with SAM and diagnoses each leaf "
+        "with the PlantDis classifier. Each photo is encoded once, and all of its leaves "
+        "are classified in one batch. Writes one JSON line per photo."
+    )
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    required=True,
+    help="Path to either a single input image or folder of images.",
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    default=None,
+    help="The JSON lines file to write. Defaults to standard output.",
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="The path to the SAM checkpoint to use for mask generation.",
+)
+
+parser.add_argument(
+    "--classifier",
+    type=str,
+    default=DEFAULT_CLASSIFIER,
+    help=(
+        "The PlantDis model, as a Keras .h5 or TFLite .tflite file. The published model "
+        "is downloaded into the model store if not found."
+    ),
+)
+
+parser.add_argument("--device", type=str, default="cuda", help="The device to run generation on.")
+
+parser.add_argument(
+    "--points-per-side",
+    type=int,
+    default=16,
+    help="Grid of points sampled to find leaves. Leaves are large, so a coarse grid is enough.",
+)
+
+parser.add_argument(
+    "--min-leaf-fraction",
+    type=float,
+    default=0.01,
+    help="Smallest leaf, as a fraction of the image area.",
+)
+
+parser.add_argument(
+    "--max-leaf-fraction",
+    type=float,
+    default=0.9,
+    help="Largest leaf, as a fraction of the image area. Larger masks are taken to be background.",
+)
+
+parser.add_argument(
+    "--top-k", type=int, default=3, help="How many of the most likely classes to report per leaf."
+)
+
+parser.add_argument(
+    "--severity",
+    action="store_true",
+    help=(
+        "Also segment the lesions on each leaf and report their coverage, count and size "
+        "histogram (see severity.py)."
+    ),
+)
+
+
+def write_image(
+    path: str, original_size: Any, leaves: List[Dict[str, Any]], severity: Any, out: Any
+) -> None:
+    record = {
+        "file": path,
+        "height": original_size[0],
+        "width": original_size[1],
+        "leaves": [
+            {k: v for k, v in leaf.items() if k != "segmentation"} for leaf in leaves
+        ],
+    }
+    if severity is not None:
+        record["lesion_bin_edges"] = severity["bin_edges"].tolist()
+    out.write(json.dumps(record) + "\n")
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Loading models...", file=sys.stderr)
+    model = LoadedModel(args.model_type, args.checkpoint)
+    model.load(args.device)
+    diagnoser = LeafDiagnoser(
+        model.predictor,
+        LeafClassifier(args.classifier),
+        points_per_side=args.points_per_side,
+        min_leaf_fraction=args.min_leaf_fraction,
+        max_leaf_fraction=args.max_leaf_fraction,
+        top_k=args.top_k,
+    )
+    estimator = SeverityEstimator(model.predictor) if args.severity else None
+    transform = model.predictor.transform
+
+    if os.path.isdir(args.input):
+        paths = find_images(args.input)
+    else:
+        paths = [args.input]
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    n_leaves = 0
+    try:
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                image, original_size = transform.decode_image(data)
+                full_image = decode_full_image(data)
+            except (OSError, ValueError):
+                print(f"Could not read {path}, skipping...", file=sys.stderr)
+                continue
+            leaves = diagnoser.diagnose(image, original_size=original_size, full_image=full_image)
+            severity = None
+            if estimator is not None:
+                # The predictor still holds this image's embedding
+                severity = estimator.estimate(
+                    image,
+                    leaf_masks=[leaf["segmentation"] for leaf in leaves],
+                    image_is_set=True,
+                    original_size=original_size,
+                )
+                for leaf, report in zip(leaves, leaf_reports(severity)):
+                    leaf["severity"] = report
+            n_leaves += len(leaves)
+            write_image(path, original_size, leaves, severity, out)
+    finally:
+        if args.output:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Done! Diagnosed {n_leaves} leaves in {len(paths)} images in {elapsed:.1f}s.",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,200 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from model_registry import LoadedModel
+from segment_anything.utils.embedding_store import EmbeddingStore
+from segment_anything.utils.transforms import ResizeLongestSide
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Runs the SAM image encoder over every image in a directory and writes the "
+        "embeddings to an embedding store. A server started with SAM_EMBEDDING_STORE "
+        "pointing at the same directory then only runs the mask decoder for these images. "
+        "Images already in the store are skipped, so an interrupted run can simply be "
+        "started again."
+    )
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    required=True,
+    help="Path to a directory of images. Subdirectories are searched too.",
+)
+
+parser.add_argument(
+    "--store",
+    type=str,
+    required=True,
+    help="The embedding store directory, as passed to the server in SAM_EMBEDDING_STORE.",
+)
+
+parser.add_argument(
+    "--store-mb",
+    type=int,
+    default=2048,
+    help=(
+        "The size limit of the store in megabytes, as in SAM_EMBEDDING_STORE_MB. Least "
+        "recently used embeddings are deleted beyond it."
+    ),
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help=(
+        "The path to the SAM checkpoint. Embeddings are stored under the model type and "
+        "checkpoint file name, which must match the server's SAM_MODELS entry."
+    ),
+)
+
+parser.add_argument("--device", type=str, default="cuda", help="The device to run generation on.")
+
+parser.add_argument(
+    "--batch-size", type=int, default=4, help="How many images to run through the encoder at once."
+)
+
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=4,
+    help="How many threads read, decode and resize images while the encoder runs.",
+)
+
+
+def find_images(root: str) -> List[str]:
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(dirpath, name))
+    return paths
+
+
+def load_image(
+    path: str,
+    store: EmbeddingStore,
+    model_id: str,
+    transform: ResizeLongestSide,
+    image_format: str,
+) -> Tuple[str, str, Optional[np.ndarray], Optional[Tuple[int, int]]]:
+    """
+    Reads an image and, unless its embedding is already stored, decodes it
+    at the encoder's input size. Runs on a loader thread.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    key = EmbeddingStore.make_key(data, model_id)
+    if key in store:
+        return path, key, None, None
+    input_image, original_size = transform.decode_image(data)
+    if image_format != "RGB":
+        input_image = input_image[..., ::-1]
+    return path, key, input_image, original_size
+
+
+def prefetch(executor: ThreadPoolExecutor, fn: Any, items: Iterable[Any], depth: int) -> Iterator[Any]:
+    """
+    Like executor.map, but keeps at most 'depth' items in flight so decoded
+    images do not pile up in memory ahead of the encoder.
+    """
+    pending: deque = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+@torch.no_grad()
+def encode_batch(
+    model: LoadedModel, store: EmbeddingStore, batch: List[Tuple], buffer: torch.Tensor
+) -> None:
+    images = [torch.from_numpy(np.ascontiguousarray(input_image)) for _, _, input_image, _ in batch]
+    inputs, input_sizes = model.sam.preprocess_images(images, out=buffer[: len(batch)])
+    embeddings = model.sam.image_encoder(inputs)
+    for (_, key, _, original_size), input_size, embedding in zip(batch, input_sizes, embeddings):
+        store.put(key, embedding[None], original_size, input_size)
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Loading model...")
+    model = LoadedModel(args.model_type, args.checkpoint)
+    model.load(args.device)
+    transform = ResizeLongestSide(model.sam.image_encoder.img_size)
+    store = EmbeddingStore(args.store, max_bytes=args.store_mb * 1024 * 1024)
+    size = model.sam.image_encoder.img_size
+    buffer = torch.empty((args.batch_size, 3, size, size), device=model.sam.device)
+
+    paths = find_images(args.input)
+    print(f"Found {len(paths)} images in {args.input}.")
+
+    def load(path: str) -> Tuple:
+        # A corrupt file should not end an overnight run
+        try:
+            return load_image(path, store, model.model_id, transform, model.sam.image_format)
+        except (OSError, ValueError):
+            return path, None, None, None
+
+    start = time.perf_counter()
+    encoded = skipped = failed = 0
+    batch: List[Tuple] = []
+    with ThreadPoolExecutor(args.workers) as executor:
+        results = prefetch(executor, load, paths, args.workers * 2 + args.batch_size)
+        for path, key, input_image, original_size in results:
+            if key is None:
+                print(f"Could not read {path}, skipping...")
+                failed += 1
+                continue
+            if input_image is None:
+                skipped += 1
+                continue
+            batch.append((path, key, input_image, original_size))
+            if len(batch) == args.batch_size:
+                encode_batch(model, store, batch, buffer)
+                encoded += len(batch)
+                batch = []
+                elapsed = time.perf_counter() - start
+                print(
+                    f"Encoded {encoded} images ({skipped} already stored), "
+                    f"{encoded / elapsed:.2f} images/sec."
+                )
+        if batch:
+            encode_batch(model, store, batch, buffer)
+            encoded += len(batch)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Done! Encoded {encoded} images in {elapsed:.1f}s ({encoded / max(elapsed, 1e-9):.2f} "
+        f"images/sec), {skipped} already stored, {failed} unreadable."
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -49,6 +49,7 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        predictor: Optional[SamPredictor] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +94,9 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          predictor (SamPredictor or None): A predictor for the model to run
+            prompts with, e.g. one shared with other uses of the same image
+            embedding. A new one is created if None.
         """
 
         assert (points_per_side is None) != (
@@ -120,7 +124,7 @@ class SamAutomaticMaskGenerator:
         if min_mask_region_area > 0:
             import cv2  # type: ignore # noqa: F401
 
-        self.predictor = SamPredictor(model)
+        self.predictor = predictor if predictor is not None else SamPredictor(model)
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
@@ -134,12 +138,24 @@ class SamAutomaticMaskGenerator:
         self.output_mode = output_mode
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self,
+        image: np.ndarray,
+        image_is_set: bool = False,
+        point_grids: Optional[List[np.ndarray]] = None,
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          image_is_set (bool): If True, the predictor already holds the embedding
+            of this image, with an original size equal to the image's size. It is
+            used for the uncropped layer instead of encoding the image again, and
+            left set afterwards unless crop layers replace it.
+          point_grids (list(np.ndarray) or None): Grids to sample points from
+            for this image instead of the generator's own, in the same format,
+            e.g. only the points inside a region of interest.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -160,7 +176,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, image_is_set, point_grids)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -194,7 +210,12 @@ class SamAutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self,
+        image: np.ndarray,
+        image_is_set: bool = False,
+        point_grids: Optional[List[np.ndarray]] = None,
+    ) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
@@ -203,7 +224,14 @@ class SamAutomaticMaskGenerator:
         # Iterate over image crops
         data = MaskData()
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
+            crop_data = self._process_crop(
+                image,
+                crop_box,
+                layer_idx,
+                orig_size,
+                reuse_embedding=image_is_set and layer_idx == 0,
+                point_grids=point_grids,
+            )
             data.cat(crop_data)
 
         # Remove duplicate masks between crops
@@ -228,16 +256,22 @@ class SamAutomaticMaskGenerator:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        reuse_embedding: bool = False,
+        point_grids: Optional[List[np.ndarray]] = None,
     ) -> MaskData:
-        # Crop the image and calculate embeddings
+        # Crop the image and calculate embeddings, unless the uncropped image
+        # is already set
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if not reuse_embedding:
+            self.predictor.set_image(cropped_im)
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+        if point_grids is None:
+            point_grids = self.point_grids
+        points_for_image = point_grids[crop_layer_idx] * points_scale
 
         # Generate masks for this crop in batches
         data = MaskData()
@@ -245,7 +279,8 @@ class SamAutomaticMaskGenerator:
             batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_image()
+        if not reuse_embedding:
+            self.predictor.reset_image()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -9,6 +9,7 @@ import torch
 from functools import partial
 
 from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
+from .utils.checkpoint import init_context, load_state_dict, supports_meta_init
 
 
 def build_sam_vit_h(checkpoint=None):
@@ -63,8 +64,12 @@ def _build_sam(
     image_size = 1024
     vit_patch_size = 16
     image_embedding_size = image_size // vit_patch_size
-    sam = Sam(
-        image_encoder=ImageEncoderViT(
+    # When weights come from a checkpoint, build the submodules on the meta
+    # device so no memory is allocated or randomly initialized for them; the
+    # loaded (memory-mapped) tensors are then adopted as the parameters.
+    skip_init = checkpoint is not None and supports_meta_init()
+    with init_context(skip_init):
+        image_encoder = ImageEncoderViT(
             depth=encoder_depth,
             embed_dim=encoder_embed_dim,
             img_size=image_size,
@@ -77,14 +82,14 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
-        ),
-        prompt_encoder=PromptEncoder(
+        )
+        prompt_encoder = PromptEncoder(
             embed_dim=prompt_embed_dim,
             image_embedding_size=(image_embedding_size, image_embedding_size),
             input_image_size=(image_size, image_size),
             mask_in_chans=16,
-        ),
-        mask_decoder=MaskDecoder(
+        )
+        mask_decoder = MaskDecoder(
             num_multimask_outputs=3,
             transformer=TwoWayTransformer(
                 depth=2,
@@ -95,13 +100,19 @@ def _build_sam(
             transformer_dim=prompt_embed_dim,
             iou_head_depth=3,
             iou_head_hidden_dim=256,
-        ),
+        )
+    sam = Sam(
+        image_encoder=image_encoder,
+        prompt_encoder=prompt_encoder,
+        mask_decoder=mask_decoder,
         pixel_mean=[123.675, 116.28, 103.53],
         pixel_std=[58.395, 57.12, 57.375],
     )
     sam.eval()
     if checkpoint is not None:
-        with open(checkpoint, "rb") as f:
-            state_dict = torch.load(f)
-        sam.load_state_dict(state_dict)
+        state_dict = load_state_dict(checkpoint)
+        if skip_init:
+            sam.load_state_dict(state_dict, assign=True)
+        else:
+            sam.load_state_dict(state_dict)
     return sam
@@ -122,19 +122,34 @@ class MaskDecoder(nn.Module):
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
-        src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
-        b, c, h, w = src.shape
+        # Combine the image and dense prompt embeddings. A single image
+        # embedding (and the positional encoding) is broadcast across the
+        # prompts instead of being copied once per prompt: the transformer's
+        # attention broadcasts over the batch dimension, so image-side work
+        # that doesn't depend on the prompts is computed only once.
+        b = tokens.shape[0]
+        if image_embeddings.shape[0] not in (1, b):
+            # Several images with a group of prompts each: expand per-image
+            # data in batch direction to be per-mask.
+            image_embeddings = torch.repeat_interleave(
+                image_embeddings, b // image_embeddings.shape[0], dim=0
+            )
+        if dense_prompt_embeddings.shape[0] > 1 and dense_prompt_embeddings.stride(0) == 0:
+            # Dense embeddings that are the same for every prompt (no mask
+            # input) are an expanded view; add them once and keep broadcasting.
+            dense_prompt_embeddings = dense_prompt_embeddings[:1]
+        src = image_embeddings + dense_prompt_embeddings
+        pos_src = image_pe
+        _, c, h, w = src.shape
 
         # Run the transformer
         hs, src = self.transformer(src, pos_src, tokens)
         iou_token_out = hs[:, 0, :]
         mask_tokens_out = hs[:, 1 : (1 + self.num_mask_tokens), :]
 
-        # Upscale mask embeddings and predict masks using the mask tokens
-        src = src.transpose(1, 2).view(b, c, h, w)
+        # Upscale mask embeddings and predict masks using the mask tokens.
+        # After the first image-to-token attention the image side is per-prompt.
+        src = src.expand(b, -1, -1).transpose(1, 2).reshape(b, c, h, w)
         upscaled_embedding = self.output_upscaling(src)
         hyper_in_list: List[torch.Tensor] = []
         for i in range(self.num_mask_tokens):
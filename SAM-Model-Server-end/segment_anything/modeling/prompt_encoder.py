@@ -8,7 +8,7 @@ import numpy as np
 import torch
 from torch import nn
 
-from typing import Any, Optional, Tuple, Type
+from typing import Any, Callable, Dict, Optional, Tuple, Type
 
 from .common import LayerNorm2d
 
@@ -59,16 +59,66 @@ class PromptEncoder(nn.Module):
         )
         self.no_mask_embed = nn.Embedding(1, embed_dim)
 
+        # Prompt-independent tensors reused across calls, with the key of the
+        # weights they were computed from. See _get_cached.
+        self._cache: Dict[str, Tuple[Tuple[Any, ...], torch.Tensor]] = {}
+
+    def _apply(self, *args, **kwargs):
+        # Moving or casting the module (.to(), .cuda(), .half(), ...) makes
+        # cached tensors stale; drop them rather than keep them alive.
+        self._cache.clear()
+        return super()._apply(*args, **kwargs)
+
+    def _get_cached(
+        self, name: str, source: torch.Tensor, compute: Callable[[], torch.Tensor]
+    ) -> torch.Tensor:
+        """
+        Returns compute(), reusing the previous result as long as the source
+        tensor it was derived from is unchanged. The key covers the device and
+        dtype as well as the storage and version counter, so loading new
+        weights, in place or by assignment, also invalidates the entry.
+        """
+        key = (source.device, source.dtype, source.data_ptr(), source._version)
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        value = compute()
+        self._cache[name] = (key, value)
+        return value
+
     def get_dense_pe(self) -> torch.Tensor:
         """
         Returns the positional encoding used to encode point prompts,
         applied to a dense set of points the shape of the image encoding.
+        The encoding is constant for fixed weights and is computed only once.
 
         Returns:
           torch.Tensor: Positional encoding with shape
             1x(embed_dim)x(embedding_h)x(embedding_w)
         """
-        return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        return self._get_cached(
+            "dense_pe",
+            self.pe_layer.positional_encoding_gaussian_matrix,
+            lambda: self.pe_layer(self.image_embedding_size).unsqueeze(0),
+        )
+
+    def _get_no_mask_dense_embedding(self, bs: int) -> torch.Tensor:
+        """
+        Returns the dense embedding used when no mask is input, as a view
+        broadcast to the batch size.
+        """
+
+        def compute() -> torch.Tensor:
+            return self.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
+                1, -1, self.image_embedding_size[0], self.image_embedding_size[1]
+            )
+
+        if torch.is_grad_enabled() and self.no_mask_embed.weight.requires_grad:
+            # Don't hold on to a tensor that is part of an autograd graph.
+            dense_embedding = compute()
+        else:
+            dense_embedding = self._get_cached("no_mask", self.no_mask_embed.weight, compute)
+        return dense_embedding.expand(bs, -1, -1, -1)
 
     def _embed_points(
         self,
@@ -161,9 +211,7 @@ class PromptEncoder(nn.Module):
         if masks is not None:
             dense_embeddings = self._embed_masks(masks)
         else:
-            dense_embeddings = self.no_mask_embed.weight.reshape(1, -1, 1, 1).expand(
-                bs, -1, self.image_embedding_size[0], self.image_embedding_size[1]
-            )
+            dense_embeddings = self._get_no_mask_dense_embedding(bs)
 
         return sparse_embeddings, dense_embeddings
 
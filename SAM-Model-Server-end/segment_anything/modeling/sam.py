@@ -8,8 +8,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+from ..utils.transforms import ResizeLongestSide
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
 from .prompt_encoder import PromptEncoder
@@ -59,7 +60,9 @@ class Sam(nn.Module):
         """
         Predicts masks end-to-end from provided images and prompts.
         If prompts are not known in advance, using SamPredictor is
-        recommended over calling the model directly.
+        recommended over calling the model directly. Images are encoded
+        together, and images with the same kinds of prompts are decoded
+        together in one call to the prompt encoder and mask decoder.
 
         Arguments:
           batched_input (list(dict)): A list over input images, each a
@@ -97,38 +100,98 @@ class Sam(nn.Module):
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
         image_embeddings = self.image_encoder(input_images)
 
-        outputs = []
-        for image_record, curr_embedding in zip(batched_input, image_embeddings):
-            if "point_coords" in image_record:
-                points = (image_record["point_coords"], image_record["point_labels"])
-            else:
-                points = None
-            sparse_embeddings, dense_embeddings = self.prompt_encoder(
-                points=points,
-                boxes=image_record.get("boxes", None),
-                masks=image_record.get("mask_inputs", None),
-            )
-            low_res_masks, iou_predictions = self.mask_decoder(
-                image_embeddings=curr_embedding.unsqueeze(0),
-                image_pe=self.prompt_encoder.get_dense_pe(),
-                sparse_prompt_embeddings=sparse_embeddings,
-                dense_prompt_embeddings=dense_embeddings,
-                multimask_output=multimask_output,
-            )
+        # Images whose prompts have the same kinds of input (and number of
+        # points) are decoded together, with each image's prompts padded to
+        # the largest prompt count in the group.
+        groups: Dict[Tuple[Any, ...], List[int]] = {}
+        for i, image_record in enumerate(batched_input):
+            groups.setdefault(self._prompt_signature(image_record), []).append(i)
+
+        outputs: List[Dict[str, torch.Tensor]] = [{} for _ in batched_input]
+        for indices in groups.values():
+            self._forward_group(batched_input, image_embeddings, indices, multimask_output, outputs)
+        return outputs
+
+    @staticmethod
+    def _prompt_signature(image_record: Dict[str, Any]) -> Tuple[Any, ...]:
+        """The kinds of prompts given for an image, and the number of points."""
+        return (
+            image_record["point_coords"].shape[1] if "point_coords" in image_record else None,
+            "boxes" in image_record,
+            "mask_inputs" in image_record,
+        )
+
+    @staticmethod
+    def _num_prompts(image_record: Dict[str, Any]) -> int:
+        for key in ("point_coords", "boxes", "mask_inputs"):
+            if key in image_record:
+                return image_record[key].shape[0]
+        return 1
+
+    def _forward_group(
+        self,
+        batched_input: List[Dict[str, Any]],
+        image_embeddings: torch.Tensor,
+        indices: List[int],
+        multimask_output: bool,
+        outputs: List[Dict[str, torch.Tensor]],
+    ) -> None:
+        """
+        Runs the prompt encoder and mask decoder once for a group of images
+        with prompts of the same signature, then postprocesses the masks of
+        images that share input and original sizes together. Fills in the
+        entries of 'outputs' at the given indices.
+        """
+        records = [batched_input[i] for i in indices]
+        num_prompts = [self._num_prompts(r) for r in records]
+        p = max(num_prompts)
+
+        def gather(key: str) -> Optional[torch.Tensor]:
+            if key not in records[0]:
+                return None
+            return torch.cat([_pad_prompts(r[key], p) for r in records], dim=0)
+
+        point_coords = gather("point_coords")
+        points = (point_coords, gather("point_labels")) if point_coords is not None else None
+        sparse_embeddings, dense_embeddings = self.prompt_encoder(
+            points=points,
+            boxes=gather("boxes"),
+            masks=gather("mask_inputs"),
+        )
+        if sparse_embeddings.shape[0] != len(records) * p:
+            # Images without prompts get a single prompt-free embedding each
+            sparse_embeddings = sparse_embeddings.expand(len(records) * p, -1, -1)
+            dense_embeddings = dense_embeddings.expand(len(records) * p, -1, -1, -1)
+
+        low_res_masks, iou_predictions = self.mask_decoder(
+            image_embeddings=image_embeddings[indices],
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+        )
+        low_res_masks = low_res_masks.view(len(records), p, *low_res_masks.shape[1:])
+        iou_predictions = iou_predictions.view(len(records), p, -1)
+
+        # Upscale masks of images with the same input and original sizes at once
+        size_groups: Dict[Tuple[Any, ...], List[int]] = {}
+        for j, record in enumerate(records):
+            key = (tuple(record["image"].shape[-2:]), tuple(record["original_size"]))
+            size_groups.setdefault(key, []).append(j)
+        for (input_size, original_size), members in size_groups.items():
             masks = self.postprocess_masks(
-                low_res_masks,
-                input_size=image_record["image"].shape[-2:],
-                original_size=image_record["original_size"],
+                low_res_masks[members].flatten(0, 1),
+                input_size=input_size,
+                original_size=original_size,
             )
-            masks = masks > self.mask_threshold
-            outputs.append(
-                {
-                    "masks": masks,
-                    "iou_predictions": iou_predictions,
-                    "low_res_logits": low_res_masks,
+            masks = masks.view(len(members), p, *masks.shape[1:]) > self.mask_threshold
+            for k, j in enumerate(members):
+                n = num_prompts[j]
+                outputs[indices[j]] = {
+                    "masks": masks[k, :n],
+                    "iou_predictions": iou_predictions[j, :n],
+                    "low_res_logits": low_res_masks[j, :n],
                 }
-            )
-        return outputs
 
     def postprocess_masks(
         self,
@@ -161,6 +224,54 @@ class Sam(nn.Module):
         masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
         return masks
 
+    def postprocess_masks_roi(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+        roi: Tuple[int, int, int, int],
+    ) -> torch.Tensor:
+        """
+        Upscale masks to the original image size like postprocess_masks, but
+        only within a region of interest, sampling the low resolution masks
+        directly in a single interpolation. Time and memory scale with the
+        area of the region instead of the whole image. Values can differ
+        slightly from the same crop of postprocess_masks, since that chains
+        two bilinear interpolations.
+
+        Arguments:
+          masks (torch.Tensor): Batched masks from the mask_decoder,
+            in BxCxHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format. Used to remove padding.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+          roi (tuple(int, int, int, int)): The region to upscale, as pixel
+            bounds (x0, y0, x1, y1) in the original image, where x1 and y1
+            are exclusive.
+
+        Returns:
+          (torch.Tensor): Batched masks in BxCxHxW format, where (H, W) is
+            (y1 - y0, x1 - x0).
+        """
+        x0, y0, x1, y1 = roi
+        img_size = self.image_encoder.img_size
+        # Centers of the output pixels, mapped through the resize to the model
+        # input and normalized to the [-1, 1] extent of the padded input frame
+        xs = torch.arange(x0, x1, device=masks.device, dtype=masks.dtype) + 0.5
+        ys = torch.arange(y0, y1, device=masks.device, dtype=masks.dtype) + 0.5
+        xs = xs * (2 * input_size[1] / (original_size[1] * img_size)) - 1
+        ys = ys * (2 * input_size[0] / (original_size[0] * img_size)) - 1
+        h, w = ys.shape[0], xs.shape[0]
+        grid = torch.stack([xs[None, :].expand(h, w), ys[:, None].expand(h, w)], dim=-1)
+        return F.grid_sample(
+            masks,
+            grid.unsqueeze(0).expand(masks.shape[0], -1, -1, -1),
+            mode="bilinear",
+            padding_mode="border",
+            align_corners=False,
+        )
+
     def preprocess(self, x: torch.Tensor) -> torch.Tensor:
         """Normalize pixel values and pad to a square input."""
         # Normalize colors
@@ -172,3 +283,77 @@ class Sam(nn.Module):
         padw = self.image_encoder.img_size - w
         x = F.pad(x, (0, padw, 0, padh))
         return x
+
+    @torch.no_grad()
+    def preprocess_images(
+        self,
+        images: Sequence[torch.Tensor],
+        out: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, List[Tuple[int, int]]]:
+        """
+        Turns a batch of uint8 images into the normalized, padded input of the
+        image encoder in one pass per image, writing straight into the output
+        tensor. Images whose longest side is not img_size are first resized
+        with antialiased bilinear interpolation.
+
+        Arguments:
+          images (list(torch.Tensor)): Images in HxWx3 uint8 format, e.g.
+            torch.as_tensor of a numpy image. They may differ in size.
+          out (torch.Tensor or None): A float tensor of shape
+            Bx3ximg_sizeximg_size on the model's device to write into, so
+            that callers can reuse one buffer across calls. Allocated if None.
+
+        Returns:
+          (torch.Tensor): The encoder input, with shape Bx3ximg_sizeximg_size.
+            This is 'out' if given.
+          (list(tuple(int, int))): The size of each image after resizing and
+            before padding, in (H, W) format.
+        """
+        size = self.image_encoder.img_size
+        if out is None:
+            out = torch.empty(
+                (len(images), 3, size, size), device=self.device, dtype=self.pixel_mean.dtype
+            )
+        assert out.shape == (len(images), 3, size, size), (
+            f"out must have shape {(len(images), 3, size, size)}, got {tuple(out.shape)}."
+        )
+
+        input_sizes = []
+        for image, x in zip(images, out):
+            image = image.permute(2, 0, 1)
+            h, w = image.shape[-2:]
+            if max(h, w) != size:
+                h, w = ResizeLongestSide.get_preprocess_shape(h, w, size)
+                image = self._resize_image(image, (h, w), x.dtype)
+            image = image.to(self.device)
+            # Normalize in place in the output, then zero the padding
+            x[:, :h, :w].copy_(image).sub_(self.pixel_mean).div_(self.pixel_std)
+            x[:, h:, :].zero_()
+            x[:, :h, w:].zero_()
+            input_sizes.append((h, w))
+        return out, input_sizes
+
+    def _resize_image(
+        self, image: torch.Tensor, size: Tuple[int, int], dtype: torch.dtype
+    ) -> torch.Tensor:
+        # On CPU, resize the uint8 image directly: recent PyTorch has a fast
+        # antialiased kernel for it, and the full-size image is never
+        # converted to float. Otherwise resize in float on the model's device.
+        if image.device.type == "cpu" and self.device.type == "cpu":
+            try:
+                return F.interpolate(
+                    image[None], size, mode="bilinear", align_corners=False, antialias=True
+                )[0]
+            except RuntimeError:
+                pass
+        image = image.to(self.device, dtype)
+        return F.interpolate(
+            image[None], size, mode="bilinear", align_corners=False, antialias=True
+        )[0]
+
+
+def _pad_prompts(x: torch.Tensor, n: int) -> torch.Tensor:
+    """Pads a batch of prompt tensors with zeros to n entries."""
+    if x.shape[0] == n:
+        return x
+    return torch.cat([x, x.new_zeros((n - x.shape[0], *x.shape[1:]))], dim=0)
@@ -215,6 +215,32 @@ class Attention(nn.Module):
         x = x.transpose(1, 2)
         return x.reshape(b, n_tokens, n_heads * c_per_head)  # B x N_tokens x C
 
+    def _attend(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+        _, _, _, c_per_head = q.shape
+        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
+        attn = attn / math.sqrt(c_per_head)
+        attn = torch.softmax(attn, dim=-1)
+        return attn @ v
+
+    def _attend_shared_keys(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+        """Attends a batch of queries to a single set of keys and values."""
+        b, n_heads, n_tokens, c_per_head = q.shape
+        q = q.transpose(0, 1).reshape(1, n_heads, b * n_tokens, c_per_head)
+        out = self._attend(q, k, v)
+        return out.reshape(n_heads, b, n_tokens, c_per_head).transpose(0, 1)
+
+    def _attend_shared_queries(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
+        """Attends a single set of queries to a batch of keys and values."""
+        _, n_heads, n_tokens, c_per_head = q.shape
+        b, _, n_keys, _ = k.shape
+        k = k.transpose(0, 1).reshape(1, n_heads, b * n_keys, c_per_head)
+        attn = q @ k.permute(0, 1, 3, 2)  # 1 x N_heads x N_tokens x (B * N_keys)
+        attn = attn / math.sqrt(c_per_head)
+        attn = attn.view(n_heads, n_tokens, b, n_keys)
+        attn = torch.softmax(attn, dim=-1)
+        attn = attn.permute(2, 0, 1, 3)  # B x N_heads x N_tokens x N_keys
+        return attn @ v
+
     def forward(self, q: Tensor, k: Tensor, v: Tensor) -> Tensor:
         # Input projections
         q = self.q_proj(q)
@@ -226,14 +252,18 @@ class Attention(nn.Module):
         k = self._separate_heads(k, self.num_heads)
         v = self._separate_heads(v, self.num_heads)
 
-        # Attention
-        _, _, _, c_per_head = q.shape
-        attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
-        attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        # Attention. When one side is shared by the whole batch (a single
+        # image attended to by many prompts, or vice versa), fold the batch
+        # into the token dimension instead of letting matmul broadcasting
+        # copy the shared image tokens once per batch element.
+        if q.shape[0] > 1 and k.shape[0] == 1:
+            out = self._attend_shared_keys(q, k, v)
+        elif q.shape[0] == 1 and k.shape[0] > 1:
+            out = self._attend_shared_queries(q, k, v)
+        else:
+            out = self._attend(q, k, v)
 
         # Get output
-        out = attn @ v
         out = self._recombine_heads(out)
         out = self.out_proj(out)
 
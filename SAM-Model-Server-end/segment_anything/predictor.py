@@ -29,12 +29,15 @@ class SamPredictor:
         super().__init__()
         self.model = sam_model
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
+        self._input_buffer: Optional[torch.Tensor] = None
         self.reset_image()
 
+    @torch.no_grad()
     def set_image(
         self,
         image: np.ndarray,
         image_format: str = "RGB",
+        original_image_size: Optional[Tuple[int, ...]] = None,
     ) -> None:
         """
         Calculates the image embeddings for the provided image, allowing
@@ -44,20 +47,41 @@ class SamPredictor:
           image (np.ndarray): The image for calculating masks. Expects an
             image in HWC uint8 format, with pixel values in [0, 255].
           image_format (str): The color format of the image, in ['RGB', 'BGR'].
+          original_image_size (tuple(int, int) or None): If given, the image
+            has already been resized to the model's input size (e.g. by
+            ResizeLongestSide.decode_image) from an image of this size, in
+            (H, W) format. Prompts and masks then refer to the original size.
         """
         assert image_format in [
             "RGB",
             "BGR",
         ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        image_torch = torch.from_numpy(np.ascontiguousarray(image))
         if image_format != self.model.image_format:
-            image = image[..., ::-1]
+            image_torch = image_torch.flip(-1)
+        if original_image_size is None:
+            original_image_size = image.shape[:2]
 
-        # Transform the image to the form expected by the model
-        input_image = self.transform.apply_image(image)
-        input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+        # Resize, normalize and pad the image in one pass into the input buffer
+        input_image, input_sizes = self.model.preprocess_images(
+            [image_torch], out=self._get_input_buffer()
+        )
 
-        self.set_torch_image(input_image_torch, image.shape[:2])
+        self.reset_image()
+        self.original_size = tuple(original_image_size)
+        self.input_size = input_sizes[0]
+        self.features = self.model.image_encoder(input_image)
+        self.is_image_set = True
+
+    def _get_input_buffer(self) -> torch.Tensor:
+        # The encoder input is reused across images rather than reallocated
+        # (12 MB for a 1024x1024 input). Every element is rewritten per image.
+        size = self.model.image_encoder.img_size
+        buffer = self._input_buffer
+        if buffer is None or buffer.device != self.device:
+            buffer = torch.empty((1, 3, size, size), device=self.device)
+            self._input_buffer = buffer
+        return buffer
 
     @torch.no_grad()
     def set_torch_image(
@@ -89,6 +113,35 @@ class SamPredictor:
         self.features = self.model.image_encoder(input_image)
         self.is_image_set = True
 
+    def set_embedding(
+        self,
+        embedding: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets a previously computed image embedding, allowing masks to be
+        predicted with the 'predict' method without running the image
+        encoder. The embedding may come from get_image_embedding() or from
+        an EmbeddingStore.
+
+        Arguments:
+          embedding (torch.Tensor): The image embedding, with shape 1xCxHxW.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+          input_size (tuple(int, int)): The size of the transformed image
+            input to the encoder, in (H, W) format.
+        """
+        assert (
+            len(embedding.shape) == 4 and embedding.shape[0] == 1
+        ), f"set_embedding input must have shape 1xCxHxW, got {tuple(embedding.shape)}."
+        self.reset_image()
+
+        self.original_size = tuple(original_image_size)
+        self.input_size = tuple(input_size)
+        self.features = embedding.to(self.device)
+        self.is_image_set = True
+
     def predict(
         self,
         point_coords: Optional[np.ndarray] = None,
@@ -130,6 +183,61 @@ class SamPredictor:
             of masks and H=W=256. These low resolution logits can be passed to
             a subsequent iteration as mask input.
         """
+        masks, iou_predictions, low_res_masks = self.predict_batch(
+            point_coords=point_coords[None, :, :] if point_coords is not None else None,
+            point_labels=point_labels[None, :] if point_labels is not None else None,
+            boxes=np.asarray(box).reshape(1, 4) if box is not None else None,
+            mask_input=mask_input[None, :, :, :] if mask_input is not None else None,
+            multimask_output=multimask_output,
+            return_logits=return_logits,
+        )
+        return masks[0], iou_predictions[0], low_res_masks[0]
+
+    def predict_batch(
+        self,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        boxes: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        roi: Optional[Tuple[int, int, int, int]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for a batch of B prompts on the currently set image,
+        using a single call to the prompt encoder and mask decoder. Each
+        prompt may combine points, a box and a mask input, but all prompts
+        in the batch must use the same kinds of input and the same number
+        of points.
+
+        Arguments:
+          point_coords (np.ndarray or None): A BxNx2 array of point prompts to
+            the model. Each point is in (X,Y) in pixels.
+          point_labels (np.ndarray or None): A BxN array of labels for the
+            point prompts. 1 indicates a foreground point and 0 indicates a
+            background point.
+          boxes (np.ndarray or None): A Bx4 array of box prompts to the model,
+            in XYXY format.
+          mask_input (np.ndarray): A batch of low resolution mask inputs to the
+            model, typically coming from a previous prediction iteration. Has
+            form Bx1xHxW, where for SAM, H=W=256.
+          multimask_output (bool): If true, the model will return three masks
+            per prompt. See 'predict' for details.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of a binary mask.
+          roi (tuple(int, int, int, int) or None): If given, masks are only
+            computed within this region of the original image, given as pixel
+            bounds (x0, y0, x1, y1) with x1 and y1 exclusive.
+
+        Returns:
+          (np.ndarray): The output masks in BxCxHxW format, where C is the
+            number of masks per prompt, and (H, W) is the original image size,
+            or the size of the roi if one is given.
+          (np.ndarray): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): An array of shape BxCxHxW, where H=W=256. These low
+            resolution logits can be passed to a subsequent iteration as mask input.
+        """
         if not self.is_image_set:
             raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
 
@@ -142,14 +250,11 @@ class SamPredictor:
             point_coords = self.transform.apply_coords(point_coords, self.original_size)
             coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
             labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
-            coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
-        if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
-            box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
-            box_torch = box_torch[None, :]
+        if boxes is not None:
+            boxes = self.transform.apply_boxes(boxes, self.original_size)
+            box_torch = torch.as_tensor(boxes, dtype=torch.float, device=self.device)
         if mask_input is not None:
             mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
-            mask_input_torch = mask_input_torch[None, :, :, :]
 
         masks, iou_predictions, low_res_masks = self.predict_torch(
             coords_torch,
@@ -158,13 +263,71 @@ class SamPredictor:
             mask_input_torch,
             multimask_output,
             return_logits=return_logits,
+            roi=roi,
         )
 
-        masks_np = masks[0].detach().cpu().numpy()
-        iou_predictions_np = iou_predictions[0].detach().cpu().numpy()
-        low_res_masks_np = low_res_masks[0].detach().cpu().numpy()
+        masks_np = masks.detach().cpu().numpy()
+        iou_predictions_np = iou_predictions.detach().cpu().numpy()
+        low_res_masks_np = low_res_masks.detach().cpu().numpy()
         return masks_np, iou_predictions_np, low_res_masks_np
 
+    def predict_in_box(
+        self,
+        box: np.ndarray,
+        margin: int = 16,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Tuple[int, int]]:
+        """
+        Predict masks for a box prompt like 'predict', but only upsample the
+        masks within the box grown by a margin, so the cost of producing the
+        output scales with the size of the box rather than the whole image.
+        The box must have a positive area.
+
+        Arguments:
+          box (np.ndarray): A length 4 array given a box prompt to the
+            model, in XYXY format.
+          margin (int): The number of pixels around the box to include
+            in the output masks.
+          point_coords, point_labels, mask_input, multimask_output,
+          return_logits: See 'predict'.
+
+        Returns:
+          (np.ndarray): The output masks in CxHxW format, where C is the
+            number of masks, and (H, W) is the size of the region.
+          (np.ndarray): An array of length C containing the model's
+            predictions for the quality of each mask.
+          (np.ndarray): An array of shape CxHxW, where C is the number
+            of masks and H=W=256, as for 'predict'.
+          (tuple(int, int)): The (x, y) position of the region's top left
+            corner in the original image.
+        """
+        if not self.is_image_set:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        h, w = self.original_size
+        x0, y0, x1, y1 = np.asarray(box, dtype=float).reshape(4)
+        if not (x0 < x1 and y0 < y1):
+            raise ValueError(f"The box must have x1 > x0 and y1 > y0, got {box}.")
+        roi = (
+            int(np.clip(np.floor(x0) - margin, 0, w - 1)),
+            int(np.clip(np.floor(y0) - margin, 0, h - 1)),
+            int(np.clip(np.ceil(x1) + margin + 1, 1, w)),
+            int(np.clip(np.ceil(y1) + margin + 1, 1, h)),
+        )
+        masks, iou_predictions, low_res_masks = self.predict_batch(
+            point_coords=point_coords[None, :, :] if point_coords is not None else None,
+            point_labels=point_labels[None, :] if point_labels is not None else None,
+            boxes=np.asarray(box).reshape(1, 4),
+            mask_input=mask_input[None, :, :, :] if mask_input is not None else None,
+            multimask_output=multimask_output,
+            return_logits=return_logits,
+            roi=roi,
+        )
+        return masks[0], iou_predictions[0], low_res_masks[0], roi[:2]
+
     @torch.no_grad()
     def predict_torch(
         self,
@@ -174,6 +337,7 @@ class SamPredictor:
         mask_input: Optional[torch.Tensor] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
+        roi: Optional[Tuple[int, int, int, int]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
         Predict masks for the given input prompts, using the currently set image.
@@ -200,10 +364,14 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          roi (tuple(int, int, int, int) or None): If given, masks are only
+            upsampled within this region of the original image, given as pixel
+            bounds (x0, y0, x1, y1) with x1 and y1 exclusive.
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
-            number of masks, and (H, W) is the original image size.
+            number of masks, and (H, W) is the original image size, or the
+            size of the roi if one is given.
           (torch.Tensor): An array of shape BxC containing the model's
             predictions for the quality of each mask.
           (torch.Tensor): An array of shape BxCxHxW, where C is the number
@@ -235,7 +403,12 @@ class SamPredictor:
         )
 
         # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        if roi is not None:
+            masks = self.model.postprocess_masks_roi(
+                low_res_masks, self.input_size, self.original_size, roi
+            )
+        else:
+            masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
 
         if not return_logits:
             masks = masks > self.model.mask_threshold
@@ -0,0 +1,80 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+import inspect
+import pickle
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict
+
+
+def supports_meta_init() -> bool:
+    """
+    Whether this torch build can construct modules on the meta device and
+    later adopt loaded tensors as parameters (load_state_dict(assign=True)).
+    """
+    return "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def init_context(skip_init: bool) -> ContextManager[Any]:
+    """
+    Returns a context in which modules are constructed without allocating or
+    randomly initializing their weights if skip_init is set. Only use this
+    when supports_meta_init() is true.
+    """
+    if skip_init:
+        return torch.device("meta")
+    return nullcontext()
+
+
+def load_state_dict(checkpoint: str) -> Dict[str, torch.Tensor]:
+    """
+    Loads a SAM state dict onto the CPU. Weights are memory-mapped from the
+    file rather than read into memory where the format allows it: always for
+    '.safetensors' files, and for zip-format torch checkpoints on torch>=2.1.
+    Safetensors files require the safetensors package.
+    """
+    if checkpoint.endswith(".safetensors"):
+        from safetensors.torch import load_file  # type: ignore
+
+        return load_file(checkpoint, device="cpu")
+
+    if "mmap" in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+        except (RuntimeError, pickle.UnpicklingError):
+            # Legacy (non-zip) checkpoints cannot be memory-mapped, and
+            # checkpoints holding more than tensors are rejected by the
+            # weights_only unpickler; both are loaded the regular way.
+            pass
+    with open(checkpoint, "rb") as f:
+        try:
+            return torch.load(f, map_location="cpu")
+        except pickle.UnpicklingError as e:
+            # torch>=2.6 loads weights_only by default and refuses to
+            # unpickle arbitrary objects, which could run code.
+            raise RuntimeError(
+                f"{checkpoint} holds objects other than tensors and cannot be "
+                "loaded safely; save a plain state dict instead with "
+                "torch.save(model.state_dict(), path)"
+            ) from e
+
+
+def convert_checkpoint(src: str, dst: str) -> None:
+    """
+    Rewrites a checkpoint in a format that load_state_dict can memory-map.
+    Writes safetensors if dst ends in '.safetensors', otherwise a zip-format
+    torch checkpoint.
+    """
+    state_dict = load_state_dict(src)
+    state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+    if dst.endswith(".safetensors"):
+        from safetensors.torch import save_file  # type: ignore
+
+        save_file(state_dict, dst)
+    else:
+        torch.save(state_dict, dst, _use_new_zipfile_serialization=True)
@@ -0,0 +1,216 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+class EmbeddingStore:
+    """
+    A content-addressed on-disk store of image embeddings, so that an image
+    seen before (e.g. after a restart) only costs a disk read instead of an
+    image encoder pass. Embeddings are keyed by a hash of the encoded image
+    bytes and the model that produced them; see make_key.
+
+    Each entry is a single flat file: an 8 byte magic, a little-endian uint32
+    header length, a JSON header (dtype, shape, original_size, input_size)
+    padded to a 64 byte boundary, then the raw C-ordered array. Reads map the
+    array with np.memmap and wrap it as a torch tensor without copying.
+
+    The total size of the store is bounded; when it is exceeded, the least
+    recently used entries are deleted. Recency is tracked through the files'
+    modification times, so it survives restarts and is shared (approximately)
+    by several processes using the same directory.
+    """
+
+    magic = b"SAMEMB01"
+    alignment = 64
+
+    def __init__(self, root: str, max_bytes: int = 2 * 1024**3) -> None:
+        """
+        Arguments:
+          root (str): The directory holding the store. Created if missing.
+          max_bytes (int): The maximum total size of the stored entries.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> file size, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(data: bytes, model_id: str) -> str:
+        """
+        Returns the key for an image, given the bytes of the encoded image
+        file and an identifier of the model (e.g. its type and checkpoint).
+        """
+        h = hashlib.sha256()
+        h.update(model_id.encode("utf-8"))
+        h.update(b"\0")
+        h.update(data)
+        return h.hexdigest()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key in self._index:
+                return True
+        # Another process sharing the directory may have written it
+        return os.path.exists(self._path(key))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def get(
+        self, key: str
+    ) -> Optional[Tuple[torch.Tensor, Tuple[int, ...], Tuple[int, ...]]]:
+        """
+        Looks up an embedding.
+
+        Returns:
+          (tuple or None): None if the key is not stored. Otherwise the
+            embedding as a CPU tensor backed by the memory-mapped file, the
+            original image size and the model input size, both as (H, W).
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header, offset = self._read_header(f)
+            data = np.memmap(
+                path,
+                dtype=np.dtype(header["dtype"]),
+                mode="c",
+                offset=offset,
+                shape=tuple(header["shape"]),
+            )
+        except (OSError, ValueError):
+            # Missing, evicted concurrently, or a partial/corrupt file
+            with self._lock:
+                self._forget(key)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            else:
+                self._add(key, os.path.getsize(path))
+        return (
+            torch.from_numpy(data),
+            tuple(header["original_size"]),
+            tuple(header["input_size"]),
+        )
+
+    def put(
+        self,
+        key: str,
+        embedding: torch.Tensor,
+        original_size: Tuple[int, ...],
+        input_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Stores an embedding, evicting least recently used entries if the
+        store grows beyond its size limit. The file is written atomically.
+
+        Arguments:
+          key (str): The key, from make_key.
+          embedding (torch.Tensor): The image embedding, e.g. from
+            SamPredictor.get_image_embedding().
+          original_size (tuple(int, int)): The size of the image before
+            transformation, in (H, W) format.
+          input_size (tuple(int, int)): The size of the transformed image
+            input to the model, in (H, W) format.
+        """
+        array = np.ascontiguousarray(embedding.detach().cpu().numpy())
+        header = json.dumps(
+            {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+                "original_size": [int(x) for x in original_size],
+                "input_size": [int(x) for x in input_size],
+            }
+        ).encode("utf-8")
+        prefix_len = len(self.magic) + 4
+        header += b" " * (-(prefix_len + len(header)) % self.alignment)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.magic)
+                f.write(struct.pack("<I", len(header)))
+                f.write(header)
+                f.write(array.tobytes())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._forget(key)
+            self._add(key, os.path.getsize(path))
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".emb")
+
+    def _read_header(self, f) -> Tuple[dict, int]:
+        prefix = f.read(len(self.magic) + 4)
+        if len(prefix) != len(self.magic) + 4 or prefix[: len(self.magic)] != self.magic:
+            raise ValueError("Not an embedding store entry.")
+        (header_len,) = struct.unpack("<I", prefix[len(self.magic) :])
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        return header, len(prefix) + header_len
+
+    def _load_index(self) -> None:
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith(".emb"):
+                    stat = os.stat(os.path.join(dirpath, name))
+                    entries.append((stat.st_mtime, name[: -len(".emb")], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._add(key, size)
+        with self._lock:
+            self._evict()
+
+    def _add(self, key: str, size: int) -> None:
+        self._index[key] = size
+        self._total_bytes += size
+
+    def _forget(self, key: str) -> None:
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def _evict(self) -> None:
+        # Always keep the most recent entry, even if it alone is over the limit
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
@@ -6,9 +6,11 @@
 
 import numpy as np
 import torch
+from PIL import Image
 from torch.nn import functional as F
 from torchvision.transforms.functional import resize, to_pil_image  # type: ignore
 
+import io
 from copy import deepcopy
 from typing import Tuple
 
@@ -30,6 +32,27 @@ class ResizeLongestSide:
         target_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
         return np.array(resize(to_pil_image(image), target_size))
 
+    def decode_image(self, data: bytes) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Decodes an encoded image file straight to the size apply_image would
+        produce, without materializing the full-resolution image. JPEGs are
+        decoded at a reduced scale (1/2, 1/4 or 1/8, done in the DCT) that is
+        still at least the target size, and the rest is a single resize.
+        Returns the image in HWC uint8 RGB format and the original image size
+        in (H, W) format, which is needed to map coordinates.
+        """
+        image = Image.open(io.BytesIO(data))
+        original_size = (image.height, image.width)
+        target_h, target_w = self.get_preprocess_shape(
+            original_size[0], original_size[1], self.target_length
+        )
+        # A no-op for formats other than JPEG
+        image.draft("RGB", (target_w, target_h))
+        image = image.convert("RGB")
+        if image.size != (target_w, target_h):
+            image = image.resize((target_w, target_h), Image.BILINEAR)
+        return np.array(image), original_size
+
     def apply_coords(self, coords: np.ndarray, original_size: Tuple[int, ...]) -> np.ndarray:
         """
         Expects a numpy array of length 2 in the final dimension. Requires the
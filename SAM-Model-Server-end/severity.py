@@ -0,0 +1,261 @@
+import cv2
+import numpy as np
+import torch
+
+from leaf_pipeline import masks_at_image_size
+from segment_anything import SamAutomaticMaskGenerator
+from segment_anything.utils.amg import build_point_grid
+
+# Lesion sizes are binned by their fraction of the leaf's area, so histograms
+# compare across photos of any resolution
+DEFAULT_BIN_EDGES = (0.0, 0.001, 0.005, 0.01, 0.05, 0.1, 1.0)
+
+
+def mask_pixels(masks, size=None):
+    """
+    Lists the pixels of many masks at once, without decoding them one by one.
+
+    :param masks: Boolean masks of shape (n, H, W) (a numpy array or tensor, or a
+        list of HW masks), uncompressed RLEs as made by mask_to_rle_pytorch, or
+        SamAutomaticMaskGenerator records holding either
+    :param size: (H, W) of the masks; only needed if the list is empty
+    :return: (H, W), the index of the mask each pixel belongs to and the pixel's
+        row-major flat index into the image
+    """
+    if isinstance(masks, torch.Tensor):
+        masks = masks.cpu().numpy()
+    masks = [m['segmentation'] if isinstance(m, dict) and 'segmentation' in m else m for m in masks]
+    empty = np.zeros(0, dtype=np.int64)
+    if len(masks) == 0:
+        return tuple(size), empty, empty
+
+    if not isinstance(masks[0], dict):
+        masks = np.asarray(masks, dtype=bool)
+        h, w = masks.shape[1:]
+        owner, y, x = np.nonzero(masks)
+        return (h, w), owner, y * w + x
+
+    # Uncompressed RLEs count alternating runs of 0s and 1s in column-major
+    # order, starting with 0s. All masks' runs are expanded together
+    h, w = masks[0]['size']
+    counts = [np.asarray(m['counts'], dtype=np.int64) for m in masks]
+    lengths = np.array([len(c) for c in counts])
+    runs = np.concatenate(counts)
+    first_run = np.cumsum(lengths) - lengths
+    run_end = np.cumsum(runs)
+    run_end -= np.repeat(np.concatenate([[0], run_end])[first_run], lengths)
+    ones = ((np.arange(len(runs)) - np.repeat(first_run, lengths)) % 2 == 1) & (runs > 0)
+    run_owner = np.repeat(np.arange(len(masks)), lengths)[ones]
+    run_len, run_start = runs[ones], (run_end - runs)[ones]
+    offsets = np.arange(run_len.sum()) - np.repeat(np.cumsum(run_len) - run_len, run_len)
+    index = np.repeat(run_start, run_len) + offsets
+    return (h, w), np.repeat(run_owner, run_len), (index % h) * w + index // h
+
+
+def lesion_severity(
+    leaf_masks,
+    lesion_masks,
+    size=None,
+    scale=1.0,
+    containment_thresh=0.8,
+    max_lesion_fraction=0.5,
+    min_lesion_area=0,
+    bin_edges=DEFAULT_BIN_EDGES,
+):
+    """
+    Measures the lesions on each leaf: the fraction of the leaf they cover, how
+    many there are and a histogram of their sizes.
+
+    Each lesion mask is assigned to the leaf that holds most of it. Masks mostly
+    outside every leaf, and masks too large to be a lesion (e.g. the leaf itself,
+    which the mask generator also finds) are ignored. Overlapping lesion masks
+    are merged, and the lesions are the connected regions of what remains, so a
+    lesion found by several masks is counted once. Pixels in several leaf masks
+    belong to the smallest of them, usually the leaf in front.
+
+    All of this is done with whole-image array operations on the masks' pixel
+    lists, so the cost grows with the image and mask areas, not with the number
+    of leaves or lesions.
+
+    :param leaf_masks: Masks of the leaves, in any format taken by mask_pixels
+    :param lesion_masks: Candidate lesion masks at the same resolution, e.g. the
+        records of SamAutomaticMaskGenerator
+    :param size: (H, W) of the masks; only needed if there are no leaves
+    :param scale: Area of one mask pixel in the original photo, e.g. when the masks
+        are at the encoder's input size; reported areas are multiplied by it
+    :param containment_thresh: Least fraction of a lesion mask inside its leaf
+    :param max_lesion_fraction: Largest lesion mask, as a fraction of its leaf
+    :param min_lesion_area: Smallest lesion, in pixels of the original photo
+    :param bin_edges: Edges of the size histogram, as fractions of the leaf area
+    :return: Dict of arrays over leaves, in the order given: 'leaf_area',
+        'lesion_area', 'coverage' (lesion area over leaf area), 'lesion_count' and
+        'histogram' (leaves by bins); over lesions: 'lesion_leaf' (the leaf index)
+        and 'lesion_sizes'; and the 'bin_edges'
+    """
+    (h, w), leaf_owner, leaf_index = mask_pixels(leaf_masks, size)
+    n = len(leaf_masks)
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    n_bins = len(bin_edges) - 1
+
+    # Label image: 1 + the index of the leaf at each pixel, 0 for background.
+    # Leaves are painted largest first, so smaller leaves win overlaps
+    leaf_pixels = np.bincount(leaf_owner, minlength=n)
+    order = np.argsort(-leaf_pixels, kind='stable')
+    rank = np.empty(n, dtype=np.int32)
+    rank[order] = np.arange(1, n + 1)
+    painted = np.zeros(h * w, dtype=np.int32)
+    np.maximum.at(painted, leaf_index, rank[leaf_owner])
+    label = np.concatenate([[0], order + 1]).astype(np.int32)[painted]
+    leaf_area = np.bincount(label, minlength=n + 1)[1:]
+
+    # Overlap of every lesion mask with every leaf, from one bincount
+    _, lesion_owner, lesion_index = mask_pixels(lesion_masks, (h, w))
+    m = len(lesion_masks)
+    on_leaf = label[lesion_index]
+    overlap = np.bincount(lesion_owner * (n + 1) + on_leaf, minlength=m * (n + 1)).reshape(m, n + 1)
+    if n > 0 and m > 0:
+        area = overlap.sum(axis=1)
+        leaf_of = overlap[:, 1:].argmax(axis=1) + 1
+        inside = overlap[np.arange(m), leaf_of]
+        keep = (area > 0) & (inside >= containment_thresh * area) \
+            & (inside <= max_lesion_fraction * leaf_area[leaf_of - 1])
+        selected = keep[lesion_owner] & (on_leaf == leaf_of[lesion_owner])
+    else:
+        selected = np.zeros(len(lesion_index), dtype=bool)
+    lesion = np.zeros(h * w, dtype=bool)
+    lesion[lesion_index[selected]] = True
+
+    # Lesions are the connected regions of the merged lesion pixels, split where
+    # they cross from one leaf to another
+    _, regions = cv2.connectedComponents(lesion.reshape(h, w).view(np.uint8), connectivity=8)
+    lesion_pixels = np.flatnonzero(lesion)
+    region_leaf, lesion_sizes = np.unique(
+        regions.ravel()[lesion_pixels].astype(np.int64) * (n + 1) + label[lesion_pixels],
+        return_counts=True,
+    )
+    lesion_leaf = region_leaf % (n + 1) - 1
+    lesion_sizes = lesion_sizes * scale
+    big_enough = lesion_sizes >= min_lesion_area
+    lesion_leaf, lesion_sizes = lesion_leaf[big_enough], lesion_sizes[big_enough]
+
+    leaf_area = leaf_area * scale
+    lesion_area = np.bincount(lesion_leaf, weights=lesion_sizes, minlength=n).astype(np.float64)
+    coverage = lesion_area / np.maximum(leaf_area, 1e-9)
+    fraction = lesion_sizes / np.maximum(leaf_area[lesion_leaf], 1e-9)
+    bins = np.clip(np.searchsorted(bin_edges, fraction, side='right') - 1, 0, n_bins - 1)
+    histogram = np.bincount(lesion_leaf * n_bins + bins, minlength=n * n_bins).reshape(n, n_bins)
+
+    return {
+        'leaf_area': leaf_area,
+        'lesion_area': lesion_area,
+        'coverage': coverage,
+        'lesion_count': np.bincount(lesion_leaf, minlength=n),
+        'histogram': histogram,
+        'lesion_leaf': lesion_leaf,
+        'lesion_sizes': lesion_sizes,
+        'bin_edges': bin_edges,
+    }
+
+
+class SeverityEstimator:
+    """
+    Estimates the disease severity of leaves with SAM: the leaves come from
+    prompts (or from LeafDiagnoser), the lesions from the automatic mask
+    generator, and lesion_severity measures them.
+
+    The mask generator only samples grid points that fall on a leaf and reuses
+    the embedding already set for the leaves, so finding lesions costs mask
+    decoder runs in proportion to the leaf area, and no extra encoder pass.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        points_per_side=32,
+        pred_iou_thresh=0.8,
+        stability_score_thresh=0.9,
+        **severity_options,
+    ):
+        """
+        :param predictor: The SamPredictor to run, e.g. LoadedModel.predictor
+        :param points_per_side: Grid of the mask generator; lesions smaller than its
+            spacing may be missed
+        :param severity_options: Passed on to lesion_severity, e.g. min_lesion_area
+        """
+        self.predictor = predictor
+        self.mask_generator = SamAutomaticMaskGenerator(
+            predictor.model,
+            points_per_side=points_per_side,
+            pred_iou_thresh=pred_iou_thresh,
+            stability_score_thresh=stability_score_thresh,
+            output_mode='uncompressed_rle',
+            predictor=predictor,
+        )
+        self.grid = build_point_grid(points_per_side)
+        self.severity_options = severity_options
+
+    @torch.no_grad()
+    def estimate(self, image, leaf_masks=None, boxes=None, image_is_set=False, original_size=None):
+        """
+        :param image: HWC uint8 RGB image, e.g. decoded at the encoder's input size
+        :param leaf_masks: Masks of the leaves at the image's resolution, in any
+            format taken by mask_pixels, e.g. the 'segmentation' of LeafDiagnoser
+            results
+        :param boxes: Array of shape (n, 4) with XYXY boxes around leaves in the
+            coordinates of the original photo, used if leaf_masks is None
+        :param image_is_set: True if the predictor already holds the embedding of this
+            image
+        :param original_size: (H, W) of the photo the image was downscaled from, in
+            which areas are reported. Defaults to the image size
+        :return: The result of lesion_severity, over the leaves in the order given
+        """
+        h, w = image.shape[:2]
+        oh, ow = original_size if original_size is not None else (h, w)
+        if not image_is_set:
+            self.predictor.set_image(image)
+
+        with masks_at_image_size(self.predictor, image):
+            if leaf_masks is None:
+                leaf_masks, _, _ = self.predictor.predict_batch(
+                    boxes=np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+                    / np.array([ow / w, oh / h, ow / w, oh / h]),
+                    multimask_output=False,
+                )
+                leaf_masks = leaf_masks[:, 0]
+
+            # Grid points on a leaf
+            _, _, leaf_index = mask_pixels(leaf_masks, (h, w))
+            on_leaf = np.zeros(h * w, dtype=bool)
+            on_leaf[leaf_index] = True
+            x = np.minimum((self.grid[:, 0] * w).astype(np.int64), w - 1)
+            y = np.minimum((self.grid[:, 1] * h).astype(np.int64), h - 1)
+            points = self.grid[on_leaf[y * w + x]]
+
+            lesion_masks = []
+            if len(points) > 0:
+                lesion_masks = self.mask_generator.generate(image, image_is_set=True, point_grids=[points])
+
+        return lesion_severity(
+            leaf_masks, lesion_masks, size=(h, w), scale=(oh / h) * (ow / w), **self.severity_options
+        )
+
+
+def leaf_reports(severity):
+    """
+    Splits the result of lesion_severity into one JSON-friendly dict per leaf.
+
+    :param severity: The result of lesion_severity
+    :return: List over leaves of dicts with the 'coverage', 'lesion_area',
+        'lesion_count' and the lesion size 'histogram' over severity['bin_edges']
+    """
+    return [
+        {
+            'coverage': float(coverage),
+            'lesion_area': float(lesion_area),
+            'lesion_count': int(count),
+            'histogram': histogram.tolist(),
+        }
+        for coverage, lesion_area, count, histogram in zip(
+            severity['coverage'], severity['lesion_area'], severity['lesion_count'], severity['histogram']
+        )
+    ]
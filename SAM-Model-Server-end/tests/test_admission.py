@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from admission import PRIORITY_DECODER_ONLY, PRIORITY_ENCODE, AdmissionController, Rejected
+
+
+def wait_until(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.001)
+
+
+class Holder:
+    """
+    Takes a slot on a background thread and keeps it until released.
+    """
+
+    def __init__(self, controller, priority=PRIORITY_ENCODE, on_admit=None):
+        self.release = threading.Event()
+        self.error = None
+
+        def run():
+            try:
+                with controller.admit(priority):
+                    if on_admit is not None:
+                        on_admit()
+                    self.release.wait(5)
+            except Rejected as e:
+                self.error = e
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def done(self):
+        self.release.set()
+        self.thread.join(5)
+
+
+def test_full_queue_is_rejected_with_429():
+    controller = AdmissionController(max_in_flight=1, max_queue=1)
+    running = Holder(controller)
+    wait_until(lambda: controller.in_flight == 1)
+    queued = Holder(controller)
+    wait_until(lambda: controller.queued == 1)
+
+    with pytest.raises(Rejected) as e:
+        with controller.admit():
+            pass
+    assert e.value.status == 429
+    assert e.value.retry_after >= 1
+
+    running.done()
+    queued.done()
+    assert queued.error is None
+    assert controller.in_flight == 0 and controller.queued == 0
+
+
+def test_expired_deadline_is_rejected_with_503():
+    controller = AdmissionController(max_in_flight=1, max_queue=4)
+
+    # A deadline that has already passed, with a slot free
+    with pytest.raises(Rejected) as e:
+        with controller.admit(deadline=time.monotonic() - 1):
+            pass
+    assert e.value.status == 503
+
+    # A deadline that passes while queued
+    running = Holder(controller)
+    wait_until(lambda: controller.in_flight == 1)
+    with pytest.raises(Rejected) as e:
+        with controller.admit(deadline=time.monotonic() + 0.05):
+            pass
+    assert e.value.status == 503
+    assert controller.queued == 0
+    running.done()
+    assert controller.in_flight == 0
+
+
+def test_decoder_only_requests_go_first():
+    controller = AdmissionController(max_in_flight=1, max_queue=4)
+    order = []
+    running = Holder(controller)
+    wait_until(lambda: controller.in_flight == 1)
+
+    waiting = []
+    for name, priority in [('encode 1', PRIORITY_ENCODE), ('encode 2', PRIORITY_ENCODE),
+                           ('decoder only', PRIORITY_DECODER_ONLY)]:
+        waiting.append(Holder(controller, priority, on_admit=lambda name=name: order.append(name)))
+        wait_until(lambda n=len(waiting): controller.queued == n)
+    for holder in waiting:
+        holder.release.set()
+    running.done()
+    for holder in waiting:
+        holder.thread.join(5)
+
+    assert order == ['decoder only', 'encode 1', 'encode 2']
+
+
+def test_slot_is_released_when_the_request_fails():
+    controller = AdmissionController(max_in_flight=1, max_queue=0)
+    with pytest.raises(RuntimeError):
+        with controller.admit():
+            raise RuntimeError("out of memory")
+    assert controller.in_flight == 0
+
+    # The freed slot is usable, rather than the queue (of size 0) being full
+    with controller.admit():
+        assert controller.in_flight == 1
+    assert controller.in_flight == 0
@@ -0,0 +1,90 @@
+import os
+
+import torch
+
+from segment_anything.utils.embedding_store import EmbeddingStore
+
+
+def embedding(seed):
+    torch.manual_seed(seed)
+    return torch.randn(1, 4, 8, 8)
+
+
+def entry_size(tmp_path):
+    store = EmbeddingStore(str(tmp_path / "probe"))
+    store.put("probe", embedding(0), (30, 40), (48, 64))
+    return store.total_bytes
+
+
+def test_put_get_round_trip(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    key = EmbeddingStore.make_key(b"image bytes", "vit_b")
+    assert key not in store
+    assert store.get(key) is None
+
+    store.put(key, embedding(1), (480, 640), (768, 1024))
+    assert key in store
+    tensor, original_size, input_size = store.get(key)
+    assert tensor.dtype == torch.float32
+    torch.testing.assert_close(tensor, embedding(1), rtol=0, atol=0)
+    assert original_size == (480, 640)
+    assert input_size == (768, 1024)
+    assert len(store) == 1
+    assert store.total_bytes == os.path.getsize(store._path(key))
+
+
+def test_keys_depend_on_model():
+    assert EmbeddingStore.make_key(b"x", "vit_b") != EmbeddingStore.make_key(b"x", "vit_h")
+
+
+def test_overwrite_keeps_size_accounting(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.put("a", embedding(1), (30, 40), (48, 64))
+    size = store.total_bytes
+    store.put("a", embedding(2), (30, 40), (48, 64))
+    assert len(store) == 1
+    assert store.total_bytes == size
+    torch.testing.assert_close(store.get("a")[0], embedding(2), rtol=0, atol=0)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    size = entry_size(tmp_path)
+    store = EmbeddingStore(str(tmp_path / "store"), max_bytes=2 * size)
+    store.put("a", embedding(1), (30, 40), (48, 64))
+    store.put("b", embedding(2), (30, 40), (48, 64))
+    # Reading "a" makes "b" the least recently used entry
+    assert store.get("a") is not None
+    store.put("c", embedding(3), (30, 40), (48, 64))
+
+    assert store.get("b") is None
+    assert not os.path.exists(store._path("b"))
+    assert store.get("a") is not None
+    assert store.get("c") is not None
+    assert len(store) == 2
+    assert store.total_bytes == 2 * size
+
+
+def test_index_survives_restart(tmp_path):
+    size = entry_size(tmp_path)
+    root = str(tmp_path / "store")
+    store = EmbeddingStore(root)
+    store.put("a", embedding(1), (30, 40), (48, 64))
+    store.put("b", embedding(2), (30, 40), (48, 64))
+    # Make "a" the oldest entry on disk
+    os.utime(store._path("a"), (1, 1))
+
+    reopened = EmbeddingStore(root, max_bytes=size)
+    assert len(reopened) == 1
+    assert reopened.total_bytes == size
+    assert reopened.get("a") is None
+    torch.testing.assert_close(reopened.get("b")[0], embedding(2), rtol=0, atol=0)
+
+
+def test_corrupt_entry_is_dropped(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.put("a", embedding(1), (30, 40), (48, 64))
+    with open(store._path("a"), "wb") as f:
+        f.write(b"not an embedding")
+    assert store.get("a") is None
+    assert len(store) == 0
+    assert store.total_bytes == 0
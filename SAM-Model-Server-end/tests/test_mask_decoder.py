@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from segment_anything.modeling import MaskDecoder, TwoWayTransformer
+from segment_anything.modeling.transformer import Attention
+
+# The shared-key and shared-query paths fold the batch into the token
+# dimension; they must agree with plain attention on the expanded batch,
+# which is how the decoder ran before the image embedding was broadcast.
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+@pytest.mark.parametrize("downsample_rate", [1, 2])
+def test_attention_shared_keys_matches_expanded(downsample_rate):
+    attn = Attention(32, num_heads=4, downsample_rate=downsample_rate).eval()
+    q = torch.randn(5, 7, 32)
+    k = torch.randn(1, 64, 32)
+    v = torch.randn(1, 64, 32)
+    with torch.no_grad():
+        shared = attn(q, k, v)
+        expanded = attn(q, k.expand(5, -1, -1).contiguous(), v.expand(5, -1, -1).contiguous())
+    assert shared.shape == (5, 7, 32)
+    torch.testing.assert_close(shared, expanded, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("downsample_rate", [1, 2])
+def test_attention_shared_queries_matches_expanded(downsample_rate):
+    attn = Attention(32, num_heads=4, downsample_rate=downsample_rate).eval()
+    q = torch.randn(1, 64, 32)
+    k = torch.randn(5, 7, 32)
+    v = torch.randn(5, 7, 32)
+    with torch.no_grad():
+        shared = attn(q, k, v)
+        expanded = attn(q.expand(5, -1, -1).contiguous(), k, v)
+    assert shared.shape == (5, 64, 32)
+    torch.testing.assert_close(shared, expanded, rtol=1e-5, atol=1e-5)
+
+
+def small_decoder():
+    transformer = TwoWayTransformer(depth=2, embedding_dim=32, num_heads=4, mlp_dim=64)
+    return MaskDecoder(transformer_dim=32, transformer=transformer, iou_head_hidden_dim=32).eval()
+
+
+def test_decoder_broadcast_matches_repeated_embedding():
+    decoder = small_decoder()
+    n_prompts = 4
+    image_embeddings = torch.randn(1, 32, 8, 8)
+    image_pe = torch.randn(1, 32, 8, 8)
+    sparse = torch.randn(n_prompts, 3, 32)
+    # Without a mask input the dense embeddings are an expanded view
+    dense = torch.randn(1, 32, 8, 8).expand(n_prompts, -1, -1, -1)
+    with torch.no_grad():
+        masks, iou = decoder(image_embeddings, image_pe, sparse, dense, multimask_output=True)
+        # The previous formulation: one materialized copy per prompt
+        ref_masks, ref_iou = decoder(
+            image_embeddings.repeat(n_prompts, 1, 1, 1),
+            image_pe.repeat(n_prompts, 1, 1, 1),
+            sparse,
+            dense.contiguous(),
+            multimask_output=True,
+        )
+    assert masks.shape == (n_prompts, 3, 32, 32)
+    torch.testing.assert_close(masks, ref_masks, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(iou, ref_iou, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,128 @@
+import pytest
+import torch
+
+from segment_anything.modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
+
+IMG_SIZE = 64
+EMBED_DIM = 32
+
+
+@pytest.fixture
+def sam():
+    torch.manual_seed(0)
+    image_encoder = ImageEncoderViT(
+        img_size=IMG_SIZE, patch_size=16, embed_dim=32, depth=1, num_heads=2, out_chans=EMBED_DIM
+    )
+    prompt_encoder = PromptEncoder(
+        embed_dim=EMBED_DIM,
+        image_embedding_size=(IMG_SIZE // 16, IMG_SIZE // 16),
+        input_image_size=(IMG_SIZE, IMG_SIZE),
+        mask_in_chans=4,
+    )
+    mask_decoder = MaskDecoder(
+        transformer_dim=EMBED_DIM,
+        transformer=TwoWayTransformer(depth=2, embedding_dim=EMBED_DIM, num_heads=4, mlp_dim=64),
+        iou_head_hidden_dim=32,
+    )
+    return Sam(image_encoder, prompt_encoder, mask_decoder).eval()
+
+
+def per_image_forward(sam, batched_input, multimask_output):
+    """Sam.forward as it was before images were decoded together."""
+    input_images = torch.stack([sam.preprocess(x["image"]) for x in batched_input], dim=0)
+    image_embeddings = sam.image_encoder(input_images)
+    outputs = []
+    for image_record, curr_embedding in zip(batched_input, image_embeddings):
+        if "point_coords" in image_record:
+            points = (image_record["point_coords"], image_record["point_labels"])
+        else:
+            points = None
+        sparse_embeddings, dense_embeddings = sam.prompt_encoder(
+            points=points,
+            boxes=image_record.get("boxes", None),
+            masks=image_record.get("mask_inputs", None),
+        )
+        low_res_masks, iou_predictions = sam.mask_decoder(
+            image_embeddings=curr_embedding.unsqueeze(0),
+            image_pe=sam.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=multimask_output,
+        )
+        masks = sam.postprocess_masks(
+            low_res_masks,
+            input_size=image_record["image"].shape[-2:],
+            original_size=image_record["original_size"],
+        )
+        outputs.append(
+            {
+                "masks": masks > sam.mask_threshold,
+                "iou_predictions": iou_predictions,
+                "low_res_logits": low_res_masks,
+            }
+        )
+    return outputs
+
+
+def random_boxes(n, h, w):
+    xy = torch.rand(n, 2) * torch.tensor([w / 2, h / 2])
+    return torch.cat([xy, xy + torch.tensor([w / 2, h / 2])], dim=1)
+
+
+def make_batch():
+    torch.manual_seed(1)
+
+    def image(h, w):
+        return torch.randint(0, 256, (3, h, w)).float()
+
+    return [
+        # Box prompts, with different prompt counts in the same group
+        {"image": image(64, 48), "original_size": (128, 96), "boxes": random_boxes(3, 64, 48)},
+        {"image": image(64, 48), "original_size": (128, 96), "boxes": random_boxes(1, 64, 48)},
+        # Same prompt kinds, different sizes
+        {"image": image(48, 64), "original_size": (96, 128), "boxes": random_boxes(2, 48, 64)},
+        # Two points per prompt
+        {
+            "image": image(64, 64),
+            "original_size": (64, 64),
+            "point_coords": torch.rand(2, 2, 2) * 64,
+            "point_labels": torch.tensor([[1, 0], [1, 1]]),
+        },
+        # A box and a point per prompt, with a mask input
+        {
+            "image": image(64, 48),
+            "original_size": (128, 96),
+            "point_coords": torch.rand(2, 1, 2) * 48,
+            "point_labels": torch.ones(2, 1, dtype=torch.int),
+            "boxes": random_boxes(2, 64, 48),
+            "mask_inputs": torch.randn(2, 1, 4 * IMG_SIZE // 16, 4 * IMG_SIZE // 16),
+        },
+    ]
+
+
+@pytest.mark.parametrize("multimask_output", [True, False])
+def test_batched_forward_matches_per_image(sam, multimask_output):
+    batched_input = make_batch()
+    outputs = sam(batched_input, multimask_output=multimask_output)
+    expected = per_image_forward(sam, batched_input, multimask_output)
+
+    assert len(outputs) == len(batched_input)
+    for record, output, ref in zip(batched_input, outputs, expected):
+        n = Sam._num_prompts(record)
+        c = 3 if multimask_output else 1
+        # Padded prompts are dropped from the outputs
+        assert output["masks"].shape == (n, c, *record["original_size"])
+        assert output["iou_predictions"].shape == (n, c)
+        assert output["low_res_logits"].shape == ref["low_res_logits"].shape
+        torch.testing.assert_close(output["low_res_logits"], ref["low_res_logits"], rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(output["iou_predictions"], ref["iou_predictions"], rtol=1e-4, atol=1e-4)
+        # Thresholded masks may only differ where the logits are at the threshold
+        assert (output["masks"] != ref["masks"]).float().mean() < 1e-3
+
+
+def test_prompt_signature_groups_images(sam):
+    batched_input = make_batch()
+    signatures = [Sam._prompt_signature(record) for record in batched_input]
+    assert signatures[0] == signatures[1] == signatures[2] == (None, True, False)
+    assert signatures[3] == (2, False, False)
+    assert signatures[4] == (1, True, True)
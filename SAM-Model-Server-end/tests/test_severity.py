@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+
+from segment_anything.utils.amg import mask_to_rle_pytorch
+from severity import leaf_reports, lesion_severity, mask_pixels
+
+H, W = 20, 30
+
+
+def mask(y0, y1, x0, x1):
+    m = np.zeros((H, W), dtype=bool)
+    m[y0:y1, x0:x1] = True
+    return m
+
+
+def rles(masks):
+    return mask_to_rle_pytorch(torch.from_numpy(np.stack(masks)))
+
+
+@pytest.fixture
+def leaves():
+    # A 10x15 leaf on the left and a 20x15 leaf on the right; the bottom left
+    # is background
+    return [mask(0, 10, 0, 15), mask(0, 20, 15, 30)]
+
+
+@pytest.fixture
+def lesions():
+    return [
+        mask(2, 4, 2, 4),  # 4 pixels on leaf 0
+        mask(5, 8, 8, 11),  # 9 pixels on leaf 0 ...
+        mask(6, 9, 9, 12),  # ... overlapping the previous one, 14 pixels together
+        mask(12, 13, 20, 24),  # 4 pixels on leaf 1
+        mask(0, 10, 0, 15),  # the whole of leaf 0, too large to be a lesion
+        mask(9, 14, 2, 4),  # mostly on the background
+    ]
+
+
+def test_mask_pixels_rle_matches_dense(lesions):
+    size, owner, index = mask_pixels(np.stack(lesions))
+    rle_size, rle_owner, rle_index = mask_pixels(rles(lesions))
+    assert size == rle_size == (H, W)
+    dense = sorted(zip(owner.tolist(), index.tolist()))
+    assert dense == sorted(zip(rle_owner.tolist(), rle_index.tolist()))
+
+
+def test_mask_pixels_empty():
+    size, owner, index = mask_pixels([], size=(H, W))
+    assert size == (H, W)
+    assert len(owner) == len(index) == 0
+
+
+def test_lesion_severity(leaves, lesions):
+    result = lesion_severity(leaves, lesions)
+    np.testing.assert_array_equal(result['leaf_area'], [150, 300])
+    np.testing.assert_array_equal(result['lesion_count'], [2, 1])
+    np.testing.assert_array_equal(result['lesion_area'], [18, 4])
+    np.testing.assert_allclose(result['coverage'], [18 / 150, 4 / 300])
+    assert sorted(zip(result['lesion_leaf'].tolist(), result['lesion_sizes'].tolist())) == [
+        (0, 4),
+        (0, 14),
+        (1, 4),
+    ]
+    # 4/150 and 14/150 fall in [0.01, 0.05) and [0.05, 0.1), 4/300 in [0.01, 0.05)
+    np.testing.assert_array_equal(result['histogram'], [[0, 0, 0, 1, 1, 0], [0, 0, 0, 1, 0, 0]])
+
+
+def test_lesion_severity_takes_rles(leaves, lesions):
+    dense = lesion_severity(leaves, lesions)
+    records = [{'segmentation': rle} for rle in rles(lesions)]
+    result = lesion_severity(rles(leaves), records)
+    for key in ('leaf_area', 'lesion_area', 'lesion_count', 'histogram'):
+        np.testing.assert_array_equal(result[key], dense[key])
+
+
+def test_lesion_severity_scale_and_min_area(leaves, lesions):
+    result = lesion_severity(leaves, lesions, scale=4.0, min_lesion_area=20)
+    np.testing.assert_array_equal(result['leaf_area'], [600, 1200])
+    # The 4 pixel lesions are 16 pixels of the photo, below the minimum
+    np.testing.assert_array_equal(result['lesion_count'], [1, 0])
+    np.testing.assert_array_equal(result['lesion_area'], [56, 0])
+    np.testing.assert_allclose(result['coverage'], [56 / 600, 0])
+
+
+def test_smaller_leaf_wins_overlap():
+    big = mask(0, 20, 0, 30)
+    small = mask(5, 15, 5, 15)
+    result = lesion_severity([big, small], [mask(8, 10, 8, 10)])
+    np.testing.assert_array_equal(result['leaf_area'], [600 - 100, 100])
+    np.testing.assert_array_equal(result['lesion_count'], [0, 1])
+
+
+def test_no_leaves_or_lesions(leaves):
+    empty = lesion_severity([], [], size=(H, W))
+    assert len(empty['coverage']) == 0
+    assert empty['histogram'].shape == (0, 6)
+
+    result = lesion_severity(leaves, [])
+    np.testing.assert_array_equal(result['lesion_count'], [0, 0])
+    np.testing.assert_array_equal(result['coverage'], [0, 0])
+
+
+def test_leaf_reports(leaves, lesions):
+    reports = leaf_reports(lesion_severity(leaves, lesions))
+    assert reports[1] == {
+        'coverage': pytest.approx(4 / 300),
+        'lesion_area': 4.0,
+        'lesion_count': 1,
+        'histogram': [0, 0, 0, 1, 0, 0],
+    }
+    assert isinstance(reports[0]['lesion_count'], int)
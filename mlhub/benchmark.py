@@ -0,0 +1,317 @@
+# Benchmarking the classifier
+#
+# Runs every image of a labelled corpus (by default the test/ images shipped
+# with the package) through a model and reports its accuracy and confusion
+# matrix along with the time to load the model, images/s, per batch latency
+# percentiles and peak memory. The report can be saved as JSON and compared
+# with an earlier one, e.g. to check a quantized or converted model (see
+# convert_tflite) before deploying it.
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+from mlhub.pkg import get_cmd_cwd
+
+parser = argparse.ArgumentParser(description='Benchmark the accuracy and speed of the PlantDis model'
+                                 )
+parser.add_argument('file_path', nargs='*',
+                    help='images, directories or glob patterns (default: test/)'
+                    )
+parser.add_argument('-l', '--labels',
+                    help='CSV file with file,class rows giving the class of each image (default: from the file names)'
+                    )
+parser.add_argument('-m', '--model', default=None,
+                    help='Keras (.h5) or TFLite (.tflite) model to benchmark (default: the model in the model store for --backend)'
+                    )
+parser.add_argument('--backend', choices=['auto', 'keras', 'tflite'],
+                    default='auto',
+                    help='model from the model store to benchmark when --model is not given'
+                    )
+parser.add_argument('-b', '--batch-size', type=int, default=32)
+parser.add_argument('-t', '--threads', type=int, default=None,
+                    help='threads used for inference (default: all cores)'
+                    )
+parser.add_argument('-w', '--workers', type=int, default=None,
+                    help='threads reading images (default: all cores)')
+parser.add_argument('-r', '--repeat', type=int, default=3,
+                    help='times the corpus is classified for the timings')
+parser.add_argument('-o', '--output',
+                    help='write the report to this .json file')
+parser.add_argument('--baseline',
+                    help='earlier report to compare with')
+args = parser.parse_args()
+
+if args.batch_size < 1 or args.repeat < 1:
+    parser.error('--batch-size and --repeat must be at least 1')
+
+from classifier import diseases, find_images, find_model, load_model, \
+    predict_outputs, split_class, iter_batches
+
+# the test images shipped with the package are looked up before changing
+# to the user's directory
+
+test_dir = os.path.abspath('test')
+os.chdir(get_cmd_cwd())
+paths = find_images(args.file_path or [test_dir])
+if not paths:
+    parser.error('no images found')
+
+import numpy as np
+
+
+def name_key(name):
+
+    # reducing a file or class name to lower case letters, dropping
+    # numbers and a plant name repeated in the disease name, so that
+    # AppleScab1.JPG and Apple___Apple_scab give the same key
+
+    words = re.findall('[a-z]+', name.lower())
+    words = [w for (i, w) in enumerate(words) if i == 0 or w
+             != words[i - 1]]
+    return ''.join(words)
+
+
+# test images are named after their class, e.g. TomatoEarlyBlight3.JPG;
+# the names that do not reduce to the key of their class are listed here
+
+class_keys = dict((name_key(name), i) for (i, name) in
+                  enumerate(diseases))
+class_keys.update({
+    'applecedarrust': diseases.index('Apple___Cedar_apple_rust'),
+    'tomatoyellowleafcurlvirus': diseases.index('Tomato___Yellow_Curl_Virus'
+            ),
+    'tomatohealth': diseases.index('Tomato___healthy'),
+    'tamatohealthy': diseases.index('Tomato___healthy'),
+    })
+
+
+def read_labels(labels_path):
+
+    # reading file,class rows, where the class is a class name, its index
+    # or a name such as AppleScab
+
+    import csv
+    labels = {}
+    with open(labels_path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0] == 'file':
+                continue
+            label = row[1].strip()
+            if label.isdigit():
+                labels[os.path.abspath(row[0])] = int(label)
+            elif name_key(label) in class_keys:
+                labels[os.path.abspath(row[0])] = class_keys[name_key(label)]
+            else:
+                raise ValueError('Unknown class %s for %s' % (label,
+                                 row[0]))
+    return labels
+
+
+if args.labels:
+    given = read_labels(args.labels)
+    labels = [given.get(os.path.abspath(p)) for p in paths]
+else:
+    labels = [class_keys.get(name_key(os.path.splitext(os.path.basename(p))[0]))
+              for p in paths]
+
+
+def peak_rss_mb():
+
+    # the peak resident memory of this process so far, which is reported
+    # in kilobytes on Linux and in bytes on macOS
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def percentile(values, q):
+    return (round(float(np.percentile(values, q)) * 1000, 2) if values else None)
+
+
+# loading the model, timed from before TensorFlow or the interpreter is
+# imported
+
+model_path = args.model or find_model(args.backend)
+print ('Benchmarking %s on %d images..' % (model_path, len(paths)),
+       file=sys.stderr)
+start = time.perf_counter()
+model = load_model(model_path, args.threads)
+load_seconds = time.perf_counter() - start
+load_rss_mb = peak_rss_mb()
+
+# reading all images once, so the timed runs only measure the model
+
+start = time.perf_counter()
+batches = []
+failed = []
+for (batch_paths, _, images, done, _) in iter_batches(paths,
+        args.batch_size, args.workers):
+    failed += [(path, str(error) or 'could not read image') for (path,
+               _, error) in done]
+    if batch_paths:
+        batches.append((batch_paths, images))
+read_seconds = time.perf_counter() - start
+n_images = sum(len(batch_paths) for (batch_paths, _) in batches)
+if not n_images:
+    parser.error('none of the images could be read')
+
+
+def classify(images):
+
+    # padding the last batch like predict_batches, so the model always
+    # sees the same input shape
+
+    n = len(images)
+    if n < args.batch_size:
+        padding = np.zeros((args.batch_size - n, ) + images.shape[1:],
+                           images.dtype)
+        images = np.concatenate([images, padding])
+    return predict_outputs(model, images)['probs'][:n]
+
+
+# the first batch is timed on its own, as it includes building the graph
+# or allocating the interpreter's tensors
+
+start = time.perf_counter()
+classify(batches[0][1])
+first_batch_seconds = time.perf_counter() - start
+
+latencies = []
+predictions = {}
+start = time.perf_counter()
+for _ in range(args.repeat):
+    for (batch_paths, images) in batches:
+        batch_start = time.perf_counter()
+        probs = classify(images)
+        latencies.append(time.perf_counter() - batch_start)
+        for (path, p) in zip(batch_paths, probs):
+            predictions[path] = p
+classify_seconds = time.perf_counter() - start
+
+# accuracy over the images whose class is known; the rest (e.g. plants
+# the model was not trained on) only count for the timings
+
+confusion = np.zeros((len(diseases), len(diseases)), np.int64)
+results = []
+unlabelled = []
+for (path, label) in zip(paths, labels):
+    if path not in predictions:
+        continue
+    probs = predictions[path]
+    predicted = int(np.argmax(probs))
+    results.append({
+        'file': os.path.basename(path),
+        'label': (diseases[label] if label is not None else None),
+        'predicted': diseases[predicted],
+        'probability': round(float(probs[predicted]), 6),
+        })
+    if label is None:
+        unlabelled.append(os.path.basename(path))
+    else:
+        confusion[label, predicted] += 1
+
+n_labelled = int(confusion.sum())
+accuracy = (float(np.trace(confusion)) / n_labelled if n_labelled else None)
+report = {
+    'model': os.path.abspath(model_path),
+    'model_bytes': os.path.getsize(model_path),
+    'backend': ('tflite' if model_path.endswith('.tflite') else 'keras'),
+    'batch_size': args.batch_size,
+    'threads': args.threads,
+    'repeat': args.repeat,
+    'images': n_images,
+    'labelled': n_labelled,
+    'accuracy': (round(accuracy, 4) if accuracy is not None else None),
+    'load_seconds': round(load_seconds, 3),
+    'first_batch_seconds': round(first_batch_seconds, 3),
+    'read_images_per_sec': round(n_images / max(read_seconds, 1e-9), 1),
+    'images_per_sec': round(n_images * args.repeat
+                            / max(classify_seconds, 1e-9), 1),
+    'batch_latency_ms': {'p50': percentile(latencies, 50),
+                         'p95': percentile(latencies, 95),
+                         'max': percentile(latencies, 100)},
+    'load_rss_mb': load_rss_mb,
+    'peak_rss_mb': peak_rss_mb(),
+    'classes': diseases,
+    'confusion_matrix': confusion.tolist(),
+    'unlabelled': unlabelled,
+    'failed': [{'file': path, 'error': error} for (path, error) in
+               failed],
+    'predictions': results,
+    'host': {'platform': platform.platform(),
+             'python': platform.python_version(),
+             'cpus': os.cpu_count()},
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+        f.write('\n')
+
+# printing the summary
+
+print ('Model            %s (%.1f MB, %s)' % (report['model'],
+       report['model_bytes'] / 1e6, report['backend']))
+if accuracy is not None:
+    print ('Accuracy         %.1f%% of %d labelled images' % (accuracy
+           * 100, n_labelled))
+print ('Load time        %.2f s (first batch %.2f s)' % (load_seconds,
+       first_batch_seconds))
+print ('Throughput       %.1f images/s (batch size %d)'
+       % (report['images_per_sec'], args.batch_size))
+print ('Batch latency    p50 %.1f ms, p95 %.1f ms'
+       % (report['batch_latency_ms']['p50'], report['batch_latency_ms'
+       ]['p95']))
+if report['peak_rss_mb'] is not None:
+    print ('Peak memory      %.0f MB (%.0f MB after loading)'
+           % (report['peak_rss_mb'], load_rss_mb))
+
+misclassified = [r for r in results if r['label'] is not None
+                 and r['label'] != r['predicted']]
+if misclassified:
+    print ('')
+    print ('Misclassified:')
+    for r in misclassified:
+        print ('  %-44s %s -> %s' % (r['file'], '/'.join(split_class(diseases.index(r['label'
+               ]))), '/'.join(split_class(diseases.index(r['predicted'])))))
+if unlabelled:
+    print ('')
+    print ('Not in the model classes, timed only: ' + ', '.join(unlabelled))
+if failed:
+    print ('')
+    print ('Could not read: ' + ', '.join(path for (path, _) in failed))
+
+# comparing with an earlier report
+
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    print ('')
+    print ('Compared with ' + args.baseline + ':')
+    rows = [('accuracy', baseline.get('accuracy'), report['accuracy'
+            ]), ('images/s', baseline.get('images_per_sec'),
+            report['images_per_sec']), ('p95 latency ms',
+            baseline.get('batch_latency_ms', {}).get('p95'),
+            report['batch_latency_ms']['p95']), ('load seconds',
+            baseline.get('load_seconds'), report['load_seconds']),
+            ('peak memory MB', baseline.get('peak_rss_mb'),
+            report['peak_rss_mb'])]
+    for (name, old, new) in rows:
+        if old is not None and new is not None:
+            change = ((new - old) * 100.0 / old if old else 0.0)
+            print ('  %-16s %10s -> %-10s (%+.1f%%)' % (name, old, new,
+                   change))
@@ -0,0 +1,448 @@
+# Shared code for classifying leaf images, used by diagnose and demo
+
+import glob
+import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+model_name = 'pdorft_efficientnetb2_3.h5'
+
+# input shape of efficientb2 as used for training
+
+img_size = 260
+
+# regular expression for proper image name with extension
+
+image_pattern = '[^\\s]+(.*?)\\.(jpg|jpeg|png|gif)$'
+image_extensions = ('.jpg', '.jpeg', '.png', '.gif')
+
+# all the disease classes
+
+diseases = [
+    'Apple___Apple_scab',
+    'Apple___Black_rot',
+    'Apple___Cedar_apple_rust',
+    'Apple___healthy',
+    'Corn___Gray_leaf_spot',
+    'Corn___Common_rust',
+    'Corn___Northern_Leaf_Blight',
+    'Corn___healthy',
+    'Orange___Citrus_greening',
+    'Potato___Early_blight',
+    'Potato___Late_blight',
+    'Potato___healthy',
+    'Tomato___Bacterial_spot',
+    'Tomato___Early_blight',
+    'Tomato___Late_blight',
+    'Tomato___Leaf_Mold',
+    'Tomato___Septoria_leaf_spot',
+    'Tomato___Spider_mites Two-spotted_spider_mite',
+    'Tomato___Target_Spot',
+    'Tomato___Yellow_Curl_Virus',
+    'Tomato___Tomato_mosaic_virus',
+    'Tomato___healthy',
+    ]
+
+
+def split_class(index):
+
+    # Splitting the predicted class to plant and disease name.
+
+    (plant, dis) = diseases[index].split('___')
+    return (plant, dis)
+
+
+def find_images(inputs, list_file=None):
+
+    # Expanding directories (recursively), glob patterns and an optional
+    # file with one path per line into a list of image paths.
+
+    inputs = list(inputs)
+    if list_file is not None:
+        with open(list_file) as f:
+            inputs += [line.strip() for line in f if line.strip()]
+
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for (dirpath, dirnames, filenames) in os.walk(item):
+                dirnames.sort()
+                paths += [os.path.join(dirpath, name) for name in
+                          sorted(filenames)
+                          if name.lower().endswith(image_extensions)]
+        elif glob.has_magic(item):
+            paths += sorted(p for p in glob.glob(item, recursive=True)
+                            if p.lower().endswith(image_extensions))
+        else:
+            paths.append(item)
+    return paths
+
+
+def decode_image(data):
+
+    # Decoding the bytes of an image file to RGB. OpenCV releases the GIL
+    # while decoding, so several images can be decoded in parallel threads.
+    # It cannot read GIFs, for which matplotlib is used as before.
+    # OpenCV is imported here, as diagnose does not need it when the
+    # daemon reads the images.
+
+    import cv2
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is not None:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    import io
+    import matplotlib.image as mpimg
+    img = mpimg.imread(io.BytesIO(data))
+    if img.dtype != np.uint8:
+        img = (img * 255).round().astype(np.uint8)
+    if img.ndim == 2:
+        img = np.stack([img] * 3, axis=-1)
+    return img[..., :3]
+
+
+def fit_image(img):
+
+    # bringing the image to format used for model training
+    # resizing to match input shape of efficientb2
+
+    import cv2
+    return cv2.resize(img, (img_size, img_size))
+
+
+def load_image(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return fit_image(decode_image(data))
+
+
+tflite_name = 'pdorft_efficientnetb2_3.tflite'
+
+
+def tflite_interpreter():
+
+    # finding a TFLite interpreter, preferring the standalone runtimes,
+    # which load in a fraction of the time and memory of full TensorFlow
+
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+    except ImportError:
+        return None
+
+
+# outputs the models can return for each image: the class probabilities,
+# the raw logits before the softmax and the embedding the final layer
+# classifies (the output of the penultimate layer)
+
+output_names = ('probs', 'logits', 'features')
+
+
+def extend_model(model):
+
+    # Adding the logits and the embedding as outputs of the Keras model,
+    # so they come from the same forward pass as the probabilities. The
+    # logits are the final Dense layer without its softmax.
+
+    import tensorflow as tf
+    head = model.layers[-1]
+    features = head.input
+    linear = tf.keras.layers.Dense(head.units, name='logits')
+    logits = linear(features)
+    linear.set_weights(head.get_weights())
+    return tf.keras.Model(model.inputs, {'probs': model.output,
+                          'logits': logits, 'features': features})
+
+
+class KerasModel:
+
+    # Running the Keras model. The extended model is only built when the
+    # logits or the embedding are asked for; it shares the weights.
+
+    def __init__(self, model):
+        self.model = model
+        self.extended = None
+
+    def predict_on_batch(self, images):
+        return self.predict_outputs(images)['probs']
+
+    def predict_outputs(self, images, outputs=('probs', )):
+        if set(outputs) == set(['probs']):
+            return {'probs': np.asarray(self.model.predict_on_batch(images))}
+        if self.extended is None:
+            self.extended = extend_model(self.model)
+        results = self.extended.predict_on_batch(images)
+        return dict((name, np.asarray(results[name])) for name in outputs)
+
+
+class TFLiteModel:
+
+    # Running a converted model (see convert_tflite.py) with the TFLite
+    # interpreter, with the same predict_on_batch as a Keras model.
+    # Quantized inputs and outputs are converted from and to float.
+    # The interpreter is not thread safe; callers serialize predictions.
+
+    def __init__(self, model_path, threads=None):
+        Interpreter = tflite_interpreter()
+        if Interpreter is None:
+            raise ImportError('No TFLite interpreter found, install ai-edge-litert, tflite-runtime or tensorflow'
+                              )
+        self.interpreter = Interpreter(model_path=model_path,
+                                       num_threads=threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.batch_size = None
+
+        # models converted with the logits and embedding name their outputs
+        # in the signature, older ones only return the probabilities
+
+        self.outputs = {'probs': self.interpreter.get_output_details()[0]}
+        signatures = self.interpreter.get_signature_list()
+        if signatures:
+            runner = \
+                self.interpreter.get_signature_runner(next(iter(signatures)))
+            details = runner.get_output_details()
+            if 'probs' in details:
+                self.outputs = details
+
+    def predict_on_batch(self, images):
+        return self.predict_outputs(images)['probs']
+
+    def predict_outputs(self, images, outputs=('probs', )):
+        missing = [name for name in outputs if name not in self.outputs]
+        if missing:
+            raise ValueError('The TFLite model has no %s output, convert it again with convert_tflite'
+                              % ', '.join(missing))
+
+        n = len(images)
+        if n != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input['index'], [n,
+                    img_size, img_size, 3])
+            self.interpreter.allocate_tensors()
+            self.batch_size = n
+
+        (scale, zero_point) = self.input['quantization']
+        if np.issubdtype(self.input['dtype'], np.integer) and scale:
+            info = np.iinfo(self.input['dtype'])
+            images = np.clip(np.round(np.asarray(images, np.float32)
+                             / scale) + zero_point, info.min, info.max)
+        self.interpreter.set_tensor(self.input['index'],
+                                    np.asarray(images,
+                                    self.input['dtype']))
+        self.interpreter.invoke()
+
+        results = {}
+        for name in outputs:
+            details = self.outputs[name]
+            values = self.interpreter.get_tensor(details['index'])
+            (scale, zero_point) = details['quantization']
+            if np.issubdtype(details['dtype'], np.integer) and scale:
+                values = (values.astype(np.float32) - zero_point) * scale
+            results[name] = values
+        return results
+
+
+def find_model(backend='auto', before_download=None):
+
+    # Returning the path of the model for a backend ('auto', 'keras' or
+    # 'tflite') in the model store, which keeps it in one place for all
+    # working directories. The Keras model is downloaded if the store has
+    # no good copy; a copy that an older version downloaded next to the
+    # package or into the current directory is taken over instead.
+    # before_download is called with 'missing' or 'corrupt' before a
+    # download. auto uses the converted TFLite model if there is one and
+    # a TFLite interpreter is installed.
+
+    try:
+        from artifacts import ArtifactStore
+    except ImportError:
+
+        # in a checkout of the repository the module is only kept with the
+        # SAM server; MLHUB.yaml installs it next to this file
+
+        sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'SAM-Model-Server-end'))
+        from artifacts import ArtifactStore
+    store = ArtifactStore()
+    tflite_path = store.path(tflite_name)
+    if backend == 'tflite':
+        assert os.path.isfile(tflite_path), \
+            'The TFLite model could not be found, run convert_tflite first, ' \
+            + tflite_path
+        return tflite_path
+
+    # auto only takes the TFLite model if an interpreter can run it, and
+    # otherwise the Keras model next to it
+
+    if backend == 'auto' and os.path.isfile(tflite_path) \
+        and tflite_interpreter() is not None:
+        return tflite_path
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return store.fetch(model_name, [os.path.join(package_dir, model_name),
+                       os.path.abspath(model_name)], before_download)
+
+
+def load_model(model_path=model_name, threads=None):
+
+    # loading a Keras (.h5) or TFLite (.tflite) model, optionally limiting
+    # the number of threads used for inference
+
+    if model_path.endswith('.tflite'):
+        return TFLiteModel(model_path, threads)
+
+    import tensorflow as tf
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    return KerasModel(tf.keras.models.load_model(model_path))
+
+
+def predict(model, images):
+
+    # using the model to predict the class probabilities of a batch of
+    # images with shape [n, 260, 260, 3]
+
+    return np.asarray(model.predict_on_batch(images))
+
+
+def predict_outputs(model, images, outputs=('probs', )):
+
+    # predicting several outputs (see output_names) of a batch of images
+    # in one forward pass, as a dict of arrays with one row per image
+
+    return model.predict_outputs(images, outputs)
+
+
+def top_k(probs, k):
+
+    # the k most likely classes as (index, probability), most likely first
+
+    indices = np.argsort(-probs)[:k]
+    return [(int(i), float(probs[i])) for i in indices]
+
+
+def iter_batches(paths, batch_size=32, workers=None, cache=None,
+                 outputs=('probs', )):
+
+    # Reading and resizing images on a pool of threads while the model runs,
+    # and grouping them into batches. Yields (paths, keys, images, done,
+    # order) where images has one row per path in paths, keys are their
+    # cache keys and done lists (path, results, error) for the images that
+    # were found in the cache or could not be read. order tells how the two
+    # interleave in the input: one entry per image of the group, True for
+    # the next row of images and False for the next item of done. The cache
+    # is consulted before an image is decoded.
+
+    workers = workers or os.cpu_count() or 1
+
+    def load(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            key = None
+            if cache is not None:
+                key = cache.make_key(data)
+                results = cache.get(key, outputs)
+                if results is not None:
+                    return (path, key, None, results, None)
+            return (path, key, fit_image(decode_image(data)), None, None)
+        except Exception as e:
+            return (path, None, None, None, e)
+
+    batch_paths = []
+    batch_keys = []
+    batch_images = []
+    done = []
+    order = []
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        it = iter(paths)
+        while True:
+
+            # keeping a bounded number of images in flight ahead of the model
+
+            while len(pending) < workers + batch_size:
+                path = next(it, None)
+                if path is None:
+                    break
+                pending.append(executor.submit(load, path))
+            if not pending:
+                break
+            (path, key, img, results, error) = pending.popleft().result()
+            if results is not None:
+                done.append((path, results, None))
+            elif error is not None or img is None:
+                done.append((path, None, error))
+            else:
+                batch_paths.append(path)
+                batch_keys.append(key)
+                batch_images.append(img)
+            order.append(img is not None and results is None)
+            if len(batch_paths) == batch_size:
+                yield (batch_paths, batch_keys, np.stack(batch_images), done,
+                       order)
+                batch_paths = []
+                batch_keys = []
+                batch_images = []
+                done = []
+                order = []
+    if batch_paths or done:
+        images = (np.stack(batch_images) if batch_images else
+                  np.zeros((0, img_size, img_size, 3), np.uint8))
+        yield (batch_paths, batch_keys, images, done, order)
+
+
+def predict_batches(model, paths, batch_size=32, workers=None, lock=None,
+                    outputs=('probs', ), cache=None):
+
+    # Classifying images in fixed-size batches. The last batch is padded
+    # so the model always sees the same input shape and is not retraced.
+    # Yields (path, results, error) in the order of paths, where results
+    # is a dict with a row of each of the outputs asked for; images found
+    # in the cache or that could not be read wait for the images before
+    # them to be classified.
+    # If a lock is given, it is held while the model runs. With a
+    # ResultCache, images seen before are not run again and new results
+    # are added to it.
+
+    for (batch_paths, keys, images, done, order) in iter_batches(paths,
+            batch_size, workers, cache, outputs):
+        if not batch_paths:
+            for item in done:
+                yield item
+            continue
+        n = len(images)
+        if n < batch_size:
+            padding = np.zeros((batch_size - n, ) + images.shape[1:],
+                               images.dtype)
+            images = np.concatenate([images, padding])
+        if lock is None:
+            results = predict_outputs(model, images, outputs)
+        else:
+            with lock:
+                results = predict_outputs(model, images, outputs)
+        rows = [dict((name, values[i]) for (name, values) in
+                results.items()) for i in range(n)]
+        if cache is not None:
+            cache.put(zip(keys, rows))
+        classified = iter(zip(batch_paths, rows))
+        done = iter(done)
+        for from_batch in order:
+            if from_batch:
+                (path, row) = next(classified)
+                yield (path, row, None)
+            else:
+                yield next(done)
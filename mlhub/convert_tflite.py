@@ -0,0 +1,92 @@
+# Converting the Keras model to TFLite
+#
+# The TFLite model runs with the lightweight TFLite interpreter
+# (ai-edge-litert or tflite-runtime), which starts much faster and uses far
+# less memory than TensorFlow. diagnose and demo use it when the converted
+# file is present (see --backend). Converting needs TensorFlow.
+
+import argparse
+import os
+import random
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+from mlhub.pkg import get_cmd_cwd
+
+parser = argparse.ArgumentParser(description='Convert the PlantDis model to TFLite'
+                                 )
+parser.add_argument('-m', '--model', default=None,
+                    help='Keras model to convert (default: the model in the model store)'
+                    )
+parser.add_argument('-o', '--output', default=None,
+                    help='TFLite file to write (default: next to the model)'
+                    )
+parser.add_argument('-q', '--quantize', choices=['none', 'float16',
+                    'int8'], default='none',
+                    help='int8 quantizes weights and activations, calibrated on --calibration images'
+                    )
+parser.add_argument('-c', '--calibration', nargs='*', default=None,
+                    help='images, directories or glob patterns used to calibrate int8 (default: test/)'
+                    )
+parser.add_argument('-n', '--num-calibration', type=int, default=100,
+                    help='maximum number of calibration images')
+args = parser.parse_args()
+
+from classifier import tflite_name, extend_model, find_model, find_images, \
+    load_image
+
+# the calibration images default to the test images shipped with the
+# package, so they are looked up before changing to the user's directory
+
+test_dir = os.path.abspath('test')
+calibration = args.calibration or ([test_dir] if os.path.isdir(test_dir)
+                                   else [])
+os.chdir(get_cmd_cwd())
+calibration = find_images(calibration)
+
+import numpy as np
+import tensorflow as tf
+
+# the model and the converted file are kept in the model store by default
+
+model_path = args.model or find_model('keras')
+output = args.output or os.path.join(os.path.dirname(model_path),
+                                     tflite_name)
+
+print ('Loading ' + model_path + '..')
+model = tf.keras.models.load_model(model_path)
+
+# converting the model with the logits and the embedding as named outputs
+# next to the probabilities, for diagnose --logits and --embeddings
+
+converter = tf.lite.TFLiteConverter.from_keras_model(extend_model(model))
+
+if args.quantize == 'float16':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+elif args.quantize == 'int8':
+    if not calibration:
+        parser.error('int8 quantization needs calibration images')
+    random.seed(0)
+    calibration = random.sample(calibration, min(len(calibration),
+                                args.num_calibration))
+
+    def representative_dataset():
+        for image_path in calibration:
+            yield [load_image(image_path)[np.newaxis].astype(np.float32)]
+
+    # the model keeps float inputs and outputs, so it is a drop-in
+    # replacement for the float model
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    print ('Calibrating on %d images..' % len(calibration))
+
+tflite_model = converter.convert()
+
+# writing to a temporary file first, so diagnose never sees a partial model
+
+with open(output + '.partial', 'wb') as f:
+    f.write(tflite_model)
+os.replace(output + '.partial', output)
+print ('Wrote %s (%.1f MB)' % (output, len(tflite_model) / 1e6))
@@ -0,0 +1,291 @@
+# Classifier daemon: keeps the model loaded between diagnose calls
+#
+# Loading TensorFlow and the model takes seconds, far longer than classifying
+# an image. The daemon does it once and then classifies images for diagnose
+# over HTTP on localhost. diagnose starts it when it is not running, and it
+# exits by itself after a while without requests.
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+host = '127.0.0.1'
+default_port = int(os.environ.get('PLANTDIS_PORT', '8765'))
+
+# paths sent to the daemon per request in batch mode
+
+chunk_size = 1024
+
+# version of the /classify requests and results, reported by /health so
+# diagnose can tell an out of date daemon still running from before
+
+protocol = 3
+
+
+def _url(port, route):
+    return 'http://%s:%d%s' % (host, port, route)
+
+
+def log_path(port):
+    return os.path.join(tempfile.gettempdir(), 'plantdis-daemon-%d.log'
+                        % port)
+
+
+# ---------------------------------------------------------------------------
+# client side, used by diagnose
+# ---------------------------------------------------------------------------
+
+def status(port=default_port):
+
+    # returning the daemon's status, or None if it is not running
+
+    try:
+        with urllib.request.urlopen(_url(port, '/health'), timeout=2) as r:
+            return json.load(r)
+    except (OSError, ValueError):
+        return None
+
+
+def start(model_path, port=default_port, threads=None, cache=None,
+          cache_mb=None, batch_size=None, timeout=300):
+
+    # starting the daemon in the background and waiting until the model
+    # is loaded. If another diagnose started one at the same time, the
+    # second daemon cannot bind the port and exits, and both use the first.
+
+    log = open(log_path(port), 'a')
+    kwargs = {}
+    if os.name == 'posix':
+        kwargs['start_new_session'] = True
+    else:
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS \
+            | subprocess.CREATE_NEW_PROCESS_GROUP
+    command = [sys.executable, os.path.abspath(__file__), '--model',
+               os.path.abspath(model_path), '--port', str(port)]
+    if threads:
+        command += ['--threads', str(threads)]
+    if cache:
+        command += ['--cache', os.path.abspath(cache)]
+    if cache_mb:
+        command += ['--cache-mb', str(cache_mb)]
+    if batch_size:
+        command += ['--batch-size', str(batch_size)]
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log,
+                            stderr=log, **kwargs)
+    log.close()
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = status(port)
+        if info is not None:
+            return info
+        if proc.poll() is not None and status(port) is None:
+            raise RuntimeError('The classifier daemon exited, see '
+                               + log_path(port))
+        time.sleep(0.2)
+    raise RuntimeError('The classifier daemon did not start in time, see '
+                       + log_path(port))
+
+
+def classify(paths, port=default_port, outputs=('probs', ),
+             use_cache=True):
+
+    # classifying images with the daemon, in its batch size. Yields (path,
+    # results, error) like classifier.predict_batches. Raises OSError if
+    # the daemon cannot be reached, e.g. after it exited when idle.
+
+    import numpy as np
+
+    for i in range(0, len(paths), chunk_size):
+        chunk = paths[i:i + chunk_size]
+
+        # the daemon runs in another directory, so it gets absolute paths;
+        # results carry the position of their path in the request and are
+        # mapped back to the paths as given, also when a file is listed
+        # twice
+
+        body = json.dumps({'paths': [os.path.abspath(p) for p in chunk],
+                          'outputs': list(outputs),
+                          'cache': use_cache}).encode('utf-8')
+        req = urllib.request.Request(_url(port, '/classify'), data=body,
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req) as r:
+                results = json.load(r)['results']
+        except urllib.error.HTTPError as e:
+            raise RuntimeError('The classifier daemon failed: '
+                               + json.load(e).get('error', str(e)))
+        for res in results:
+            values = res.get('outputs')
+            if values is not None:
+                values = dict((name, np.frombuffer(base64.b64decode(data),
+                              np.float32)) for (name, data) in
+                              values.items())
+            yield (chunk[res['index']], values, res.get('error'))
+
+
+# ---------------------------------------------------------------------------
+# server side
+# ---------------------------------------------------------------------------
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': 'not found'})
+        from classifier import output_names
+        cache = self.server.cache
+        self._send(200, {'status': 'ok', 'model': self.server.model_path,
+                   'pid': os.getpid(), 'outputs': list(output_names),
+                   'protocol': protocol,
+                   'batch_size': self.server.batch_size,
+                   'cache': (None if cache is None else cache.path)})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            return self._send(404, {'error': 'not found'})
+        self.server.touch()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            paths = request['paths']
+            outputs = tuple(request.get('outputs', ['probs']))
+            use_cache = bool(request.get('cache', True))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send(400, {'error': 'bad request: %s' % e})
+
+        import numpy as np
+        from classifier import output_names, predict_batches
+
+        if not outputs or not set(outputs) <= set(output_names):
+            return self._send(400, {'error': 'bad request: outputs must be in %s'
+                               % ', '.join(output_names)})
+
+        # the outputs are sent as base64 float32, as the embeddings are
+        # too large for JSON lists. Results are returned in request order
+        # with the index of their path, a path listed twice getting one
+        # result per listing. Every batch has the daemon's batch size,
+        # padded if needed, so the model always sees the same input shape
+        # whatever the number of images in a request.
+
+        positions = {}
+        for (i, path) in enumerate(paths):
+            positions.setdefault(path, []).append(i)
+        for indices in positions.values():
+            indices.reverse()
+        results = [None] * len(paths)
+        try:
+            for (path, values, error) in \
+                predict_batches(self.server.model, paths,
+                                self.server.batch_size, lock=self.server.model_lock,
+                                outputs=outputs, cache=(self.server.cache
+                                if use_cache else None)):
+                if values is not None:
+                    values = dict((name, base64.b64encode(np.asarray(v,
+                                  np.float32).tobytes()).decode('ascii'))
+                                  for (name, v) in values.items())
+                i = positions[path].pop()
+                results[i] = {'index': i, 'file': path, 'outputs': values,
+                              'error': (None if error is None else str(error)
+                              or 'could not read image')}
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        self.server.touch()
+        self._send(200, {'results': results})
+
+    def _send(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        # keeping the log to startup and errors
+
+        pass
+
+
+class Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port, model_path, model, cache=None, batch_size=32):
+        super().__init__((host, port), Handler)
+        self.model_path = model_path
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+
+        # images are read on the request threads, the model runs one batch
+        # at a time
+
+        self.model_lock = threading.Lock()
+        self.last_request = time.monotonic()
+
+    def touch(self):
+        self.last_request = time.monotonic()
+
+
+def serve(model_path, port=default_port, idle_timeout=1800, threads=None,
+          cache_path=None, cache_mb=None, batch_size=32):
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from classifier import load_model
+
+    # binding first, so that a second daemon exits before loading the model
+
+    server = Server(port, model_path, None, batch_size=batch_size)
+    print('Loading %s...' % model_path, flush=True)
+    server.model = load_model(model_path, threads)
+    if cache_path:
+        from result_cache import ResultCache, default_mb, model_id
+        server.cache = ResultCache(cache_path, model_id(model_path),
+                                   (cache_mb or default_mb) * 1024 * 1024)
+
+    def watchdog():
+        while True:
+            time.sleep(min(60, max(1, idle_timeout / 10)))
+            if time.monotonic() - server.last_request > idle_timeout:
+                print('Idle for %ds, exiting.' % idle_timeout, flush=True)
+                server.shutdown()
+                return
+
+    if idle_timeout > 0:
+        threading.Thread(target=watchdog, daemon=True).start()
+    print('Serving on %s:%d' % (host, port), flush=True)
+    server.serve_forever()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PlantDis classifier daemon'
+                                     )
+    parser.add_argument('--model', required=True)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--idle-timeout', type=int, default=1800,
+                        help='seconds without requests before exiting, 0 to never exit'
+                        )
+    parser.add_argument('--threads', type=int, default=None,
+                        help='threads used for inference (default: all cores)'
+                        )
+    parser.add_argument('--cache', default=None,
+                        help='result cache file shared with diagnose (default: no cache)'
+                        )
+    parser.add_argument('--cache-mb', type=int, default=None,
+                        help='size limit of the result cache in megabytes')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='images per model call, the same for every request')
+    args = parser.parse_args()
+    serve(args.model, args.port, args.idle_timeout, args.threads,
+          args.cache, args.cache_mb, max(1, args.batch_size))
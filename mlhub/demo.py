@@ -1,99 +1,70 @@
 # Demo file
 
 import warnings
+import argparse
 import os
-import tensorflow as tf
 
-import cv2
-import numpy as np
+from mlhub.pkg import mlask, mlcat
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', choices=['auto', 'keras', 'tflite'],
+                    default='auto',
+                    help='tflite runs the converted model (see convert_tflite) without TensorFlow; auto uses it if present'
+                    )
+parser.add_argument('-t', '--threads', type=int, default=None,
+                    help='threads used for inference (default: all cores)'
+                    )
+args = parser.parse_args()
 
-import requests
-import gdown
+# showing the banner before the slower imports and loading the model
+
+mlcat('PlantDis',
+      """\
+    PlantDis is a mlhub package for detecting plant disease from image of a leaf.
+
+    This library is based on pretrained-model which itself is based on EfficientNetB2.
+
+    For Details you can visit:-
+
+    
+https://github.com/spsaswat/plantdis/blob/main/ipynb/
+
+    """)
+
+import numpy as np
 
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 
 import random
 
-from tensorflow import keras
 from pathlib import Path
 
-from mlhub.pkg import mlask, mlcat
-
 # for ignoring the warnings
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 warnings.filterwarnings('ignore')
 
-model_name = 'pdorft_efficientnetb2_3.h5'
-path = Path(model_name)
+from classifier import find_model, split_class, load_image, load_model, \
+    predict
 
-mlcat('PlantDis',
-      """\
-    PlantDis is a mlhub package for detecting plant disease from image of a leaf.
+# getting the model from the model store, which downloads it once for all
+# working directories (gdown is only imported for a download)
 
-    This library is based on pretrained-model which itself is based on EfficientNetB2.
 
-    For Details you can visit:-
+def before_download(status):
+    if status == 'corrupt':
+        mlask(end='\n',
+              prompt='Model file may be corrupted. Press Enter to download the model(130 MB)'
+              )
+    else:
+        mlask(end='\n',
+              prompt='Model Not Found. Press Enter to download the model(130 MB)'
+              )
 
-    
-https://github.com/spsaswat/plantdis/blob/main/ipynb/
 
-    """)
+model_path = find_model(args.backend, before_download)
 
-# rechecking if the file was successfully downloaded
-
-if not path.is_file():
-    mlask(end='\n',
-          prompt='Model Not Found. Press Enter to download the model(130 MB)'
-          )
-    url = \
-        'https://drive.google.com/uc?id=1mAxgMNJZ2c_5c16YdAaQWZ5H06BuBAF9'
-    r = requests.get(url, allow_redirects=True)
-    output = model_name
-    gdown.download(url, output, quiet=False)
-elif os.path.getsize(path) / 1000 < 10000:
-
-# if file size is less than 10MB then it means
-# the file is corrupted, so download again
-
-    mlask(end='\n',
-          prompt='Model file may be corrupted. Press Enter to download the model(130 MB)'
-          )
-    url = \
-        'https://drive.google.com/uc?id=1mAxgMNJZ2c_5c16YdAaQWZ5H06BuBAF9'
-    r = requests.get(url, allow_redirects=True)
-    output = model_name
-    gdown.download(url, output, quiet=False)
-
-# all the disease classes
-
-diseases = [
-    'Apple___Apple_scab',
-    'Apple___Black_rot',
-    'Apple___Cedar_apple_rust',
-    'Apple___healthy',
-    'Corn___Gray_leaf_spot',
-    'Corn___Common_rust',
-    'Corn___Northern_Leaf_Blight',
-    'Corn___healthy',
-    'Orange___Citrus_greening',
-    'Potato___Early_blight',
-    'Potato___Late_blight',
-    'Potato___healthy',
-    'Tomato___Bacterial_spot',
-    'Tomato___Early_blight',
-    'Tomato___Late_blight',
-    'Tomato___Leaf_Mold',
-    'Tomato___Septoria_leaf_spot',
-    'Tomato___Spider_mites Two-spotted_spider_mite',
-    'Tomato___Target_Spot',
-    'Tomato___Yellow_Curl_Virus',
-    'Tomato___Tomato_mosaic_virus',
-    'Tomato___healthy',
-    ]
-
-model = keras.models.load_model(model_name)
+model = load_model(model_path, args.threads)
 
 # collecting names of images in the test folder
 
@@ -112,14 +83,9 @@ r_n = random.sample(range(0, 32), n)
 
 for i in range(n):
 
-  # Read Image
+  # Read Image, bringing it to format used for model training
 
-    img = mpimg.imread('test/' + t_img_names[r_n[i]])
-
-  # bringing the image to format used for model training
-  # resizing to match input shape of efficientb2
-
-    img3 = cv2.resize(img, (260, 260))
+    img3 = load_image('test/' + t_img_names[r_n[i]])
 
   # expanding dimension
 
@@ -127,7 +93,7 @@ for i in range(n):
 
   # using the model to predict disease
 
-    disease = np.argmax(model.predict(img4), axis=1)
+    disease = np.argmax(predict(model, img4), axis=1)
 
   # disease is a list and at 0th index is the disease with highest probability
 
@@ -135,12 +101,9 @@ for i in range(n):
 
   # Splitting the predicted class to plant and disease name.
 
-    (plant, dis) = diseases[disease[0]].split('___')
+    (plant, dis) = split_class(disease[0])
     actual = 'Actual:- ' + (t_img_names[r_n[i]])[:-4]
 
-  # Splitting the predicted class to plant and disease name.
-
-    (plant, dis) = diseases[disease[0]].split('___')
     if dis.lower() == 'healthy':
         finalAnnot = actual + '\n' + 'Predicted plant is ' + plant \
             + ' & it is ' + dis
@@ -1,12 +1,30 @@
 # Diagnose file
 
+import time
+
+# timing the stages of startup for --profile-startup, which shows where
+# the time of a cold start goes
+
+stages = []
+stage_start = time.perf_counter()
+
+
+def stage_done(name):
+    global stage_start
+    now = time.perf_counter()
+    stages.append((name, now - stage_start))
+    stage_start = now
+
+
 import warnings
 
 # taking the file path from command line
 
 import argparse
+import glob
 import re
 import os
+import sys
 
 # Ensure paths are relative to the user's cwd.
 
@@ -15,137 +33,332 @@ os.chdir(get_cmd_cwd())
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-v', '--view', action='store_true')
-parser.add_argument('file_path')
+parser.add_argument('file_path', nargs='*',
+                    help='images, directories or glob patterns')
+parser.add_argument('-l', '--list',
+                    help='file with one image path per line')
+parser.add_argument('-o', '--output',
+                    help='write results to this .csv or .jsonl file')
+parser.add_argument('-f', '--format', choices=['csv', 'jsonl'],
+                    help='output format (default: from --output, else csv)'
+                    )
+parser.add_argument('-k', '--top-k', type=int, default=0,
+                    help='add the k most likely classes with their probabilities'
+                    )
+parser.add_argument('--logits', action='store_true',
+                    help='add the raw logits of every class')
+parser.add_argument('-e', '--embeddings',
+                    help='write the penultimate layer embeddings to this .npy file, one row per output row'
+                    )
+parser.add_argument('-b', '--batch-size', type=int, default=32)
+parser.add_argument('-w', '--workers', type=int, default=None,
+                    help='threads reading images (default: all cores)')
+parser.add_argument('--backend', choices=['auto', 'keras', 'tflite'],
+                    default='auto',
+                    help='tflite runs the converted model (see convert_tflite) without TensorFlow; auto uses it if present'
+                    )
+parser.add_argument('-t', '--threads', type=int, default=None,
+                    help='threads used for inference (default: all cores)'
+                    )
+parser.add_argument('--cache', default=None,
+                    help='result cache file (default: $PLANTDIS_CACHE or ~/.cache/plantdis/results.sqlite)'
+                    )
+parser.add_argument('--cache-mb', type=int, default=None,
+                    help='size limit of the result cache in megabytes (default: $PLANTDIS_CACHE_MB or 256)'
+                    )
+parser.add_argument('--no-cache', action='store_true',
+                    help='classify every image again instead of reusing earlier results'
+                    )
+parser.add_argument('--no-daemon', action='store_true',
+                    help='load the model in this process instead of using the classifier daemon'
+                    )
+parser.add_argument('--port', type=int, default=None,
+                    help='port of the classifier daemon (default: $PLANTDIS_PORT or 8765)'
+                    )
+parser.add_argument('--profile-startup', action='store_true',
+                    help='print the time spent in each stage of startup to stderr'
+                    )
 args = parser.parse_args()
 
-# regular expression for proper image name with extension
+# validating the arguments before importing anything heavy
 
-pattern = '[^\\s]+(.*?)\\.(jpg|jpeg|png|gif)$'
+from classifier import image_pattern, diseases, find_images
 
-# storing the file path in a variable
+# a single image without batch options keeps the plain plant,disease output
 
-f_path = args.file_path
+batch_mode = len(args.file_path) != 1 or args.list or args.output \
+    or args.format or args.top_k or args.logits or args.embeddings \
+    or os.path.isdir(args.file_path[0]) \
+    or not os.path.exists(args.file_path[0]) \
+    and glob.has_magic(args.file_path[0])
 
-# checking if the image has proper extensions
+if args.top_k < 0 or args.top_k > len(diseases):
+    parser.error('--top-k must be between 0 and %d' % len(diseases))
 
-if not re.search(pattern, f_path.lower()):
-    raise Exception('Please add proper image extension')
+if batch_mode:
+    if args.view:
+        parser.error('--view only works with a single image')
+    paths = find_images(args.file_path, args.list)
+    if not paths:
+        parser.error('no images found')
+else:
 
-# checking if the file exists
+    # storing the file path in a variable
 
-assert os.path.exists(f_path), 'The file could not be found, ' \
-    + str(f_path)
+    f_path = args.file_path[0]
+    paths = [f_path]
 
-import sys
+    # checking if the image has proper extensions
 
-import tensorflow as tf
+    if not re.search(image_pattern, f_path.lower()):
+        raise Exception('Please add proper image extension')
 
-# print('the tensorflow version is', tf. __version__)
+    # checking if the file exists
 
-import cv2
-import numpy as np
+    assert os.path.exists(f_path), 'The file could not be found, ' \
+        + str(f_path)
 
-import requests
-import gdown
+stage_done('arguments')
 
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+import csv
+import json
 
-from tensorflow import keras
-from pathlib import Path
-from mlhub.pkg import mlask
+import numpy as np
 
 # for ignoring the warnings
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 warnings.filterwarnings('ignore')
 
-model_name = 'pdorft_efficientnetb2_3.h5'
-path = Path(model_name)
-
-# rechecking if the file was successfully downloaded
-
-if not path.is_file():
-    print ('Model file could not be found, Downloading again..')
-    url = \
-        'https://drive.google.com/uc?id=1mAxgMNJZ2c_5c16YdAaQWZ5H06BuBAF9'
-    r = requests.get(url, allow_redirects=True)
-    output = model_name
-    gdown.download(url, output, quiet=False)
-    print ('')
-elif os.path.getsize(path) / 1000 < 10000:
-
-# if file size is less than 10MB then it means
-# the file is corrupted, so download again
-
-    print ('Model file corrupted, Downloading again..')
-    url = \
-        'https://drive.google.com/uc?id=1mAxgMNJZ2c_5c16YdAaQWZ5H06BuBAF9'
-    r = requests.get(url, allow_redirects=True)
-    output = model_name
-    gdown.download(url, output, quiet=False)
-    print ('')
-
-# all the disease classes
-
-diseases = [
-    'Apple___Apple_scab',
-    'Apple___Black_rot',
-    'Apple___Cedar_apple_rust',
-    'Apple___healthy',
-    'Corn___Gray_leaf_spot',
-    'Corn___Common_rust',
-    'Corn___Northern_Leaf_Blight',
-    'Corn___healthy',
-    'Orange___Citrus_greening',
-    'Potato___Early_blight',
-    'Potato___Late_blight',
-    'Potato___healthy',
-    'Tomato___Bacterial_spot',
-    'Tomato___Early_blight',
-    'Tomato___Late_blight',
-    'Tomato___Leaf_Mold',
-    'Tomato___Septoria_leaf_spot',
-    'Tomato___Spider_mites Two-spotted_spider_mite',
-    'Tomato___Target_Spot',
-    'Tomato___Yellow_Curl_Virus',
-    'Tomato___Tomato_mosaic_virus',
-    'Tomato___healthy',
-    ]
-
-img = mpimg.imread(str(f_path))
-
-# bringing the image to format used for model training
-# resizing to match input shape of efficientb2
-
-img3 = cv2.resize(img, (260, 260))
-
-# expanding dimension
-
-img4 = np.reshape(img3, [1, 260, 260, 3])
-model = keras.models.load_model(model_name)
-
-# using the model to predict disease
-
-disease = np.argmax(model.predict(img4), axis=1)
-
-# disease is a list and at 0th index is the disease with highest probability
-
-# Splitting the predicted class to plant and disease name.
-
-(plant, dis) = diseases[disease[0]].split('___')
-print ((plant + ',' + dis).lower())
-
-if args.view:
-
-    # Setting up plt and showing the image used for prediction
-
-    fig = plt.figure('Leaf Diagnosed')
-    if dis.lower() == 'healthy':
-        finalAnnot = 'Predicted plant is ' + plant + ' & it is ' + dis
+from classifier import find_model, split_class, load_image, load_model, \
+    predict_batches, top_k
+import daemon
+import result_cache
+
+stage_done('imports')
+
+# getting the model from the model store, which downloads it once for all
+# working directories (gdown is only imported for a download)
+
+
+def before_download(status):
+    if status == 'corrupt':
+        print ('Model file corrupted, Downloading again..')
     else:
-        finalAnnot = 'Predicted plant is ' + plant + ' & disease is ' \
-            + dis
-    plt.title(finalAnnot)
-    plt.imshow(img3)
-    plt.show()
+        print ('Model file could not be found, Downloading..')
+
+
+model_path = find_model(args.backend, before_download)
+
+batch_size = min(args.batch_size, len(paths))
+
+# the logits and embeddings come from the same forward pass as the
+# probabilities
+
+outputs = ['probs']
+if args.logits:
+    outputs.append('logits')
+if args.embeddings:
+    outputs.append('features')
+
+
+def daemon_results():
+
+    # classifying with the daemon, which keeps the model loaded between
+    # calls, starting it if needed. Returns None if it cannot be used.
+
+    port = args.port or daemon.default_port
+    info = daemon.status(port)
+    if info is None:
+        print ('Starting the classifier daemon..', file=sys.stderr)
+        try:
+            info = daemon.start(model_path, port, args.threads, cache_path,
+                                args.cache_mb, args.batch_size)
+        except RuntimeError as e:
+            print (e, file=sys.stderr)
+            return None
+    if info.get('model') != os.path.abspath(model_path):
+        print ('The classifier daemon on port %d serves another model'
+               % port, file=sys.stderr)
+        return None
+    if info.get('protocol') != daemon.protocol:
+        print ('The classifier daemon on port %d is out of date' % port,
+               file=sys.stderr)
+        return None
+    if not args.no_cache and info.get('cache') \
+        != os.path.abspath(cache_path):
+        print ('The classifier daemon on port %d uses another result cache'
+               % port, file=sys.stderr)
+        return None
+    return with_fallback(daemon.classify(paths, port, outputs,
+                         not args.no_cache))
+
+
+def with_fallback(results):
+
+    # the daemon may exit (e.g. idle) between the status check and the
+    # request; the images it has not answered are then classified in this
+    # process. Its results come in the order of the paths.
+
+    n = 0
+    try:
+        for item in results:
+            yield item
+            n += 1
+    except OSError as e:
+        print ('The classifier daemon could not be reached (%s), classifying here..'
+                % e, file=sys.stderr)
+        for item in local_results(paths[n:]):
+            yield item
+
+
+def local_results(paths):
+
+    # classifying in this process
+
+    model = load_model(model_path, args.threads)
+    cache = None
+    if not args.no_cache:
+        cache = result_cache.ResultCache(cache_path,
+                result_cache.model_id(model_path), (args.cache_mb
+                or result_cache.default_mb) * 1024 * 1024)
+    return predict_batches(model, paths, batch_size, args.workers,
+                           outputs=outputs, cache=cache)
+
+
+# images classified before, by this model, are answered from the result
+# cache without being decoded
+
+cache_path = args.cache or result_cache.default_path
+
+results = None if args.no_daemon else daemon_results()
+if results is None:
+    results = local_results(paths)
+stage_done('model')
+
+if batch_mode:
+
+    # streaming all images through the model in fixed-size batches
+
+    fmt = args.format
+    if fmt is None:
+        fmt = ('jsonl' if args.output and args.output.lower().endswith(
+               '.jsonl') else 'csv')
+    out = (open(args.output, 'w', newline='') if args.output else
+           sys.stdout)
+    fields = ['file', 'plant', 'disease', 'error']
+    if fmt == 'csv':
+        for i in range(1, args.top_k + 1):
+            fields += ['top%d_plant' % i, 'top%d_disease' % i,
+                       'top%d_probability' % i]
+        if args.logits:
+            fields += ['logit_' + name for name in diseases]
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+
+    # the embeddings are written as they arrive, in the order of the rows;
+    # rows of images that could not be read are NaN
+
+    embeddings = None
+
+    start = time.perf_counter()
+    n_done = 0
+    for (image_path, values, error) in results:
+        row = dict.fromkeys(fields, '')
+        row['file'] = image_path
+        if error is not None:
+            row['error'] = str(error) or 'could not read image'
+        else:
+            probs = values['probs']
+            (plant, dis) = split_class(int(np.argmax(probs)))
+            row['plant'] = plant.lower()
+            row['disease'] = dis.lower()
+        if error is None and args.top_k:
+            ranked = []
+            for (i, (index, p)) in enumerate(top_k(probs, args.top_k), 1):
+                (plant, dis) = split_class(index)
+                if fmt == 'csv':
+                    row['top%d_plant' % i] = plant.lower()
+                    row['top%d_disease' % i] = dis.lower()
+                    row['top%d_probability' % i] = '%.6f' % p
+                else:
+                    ranked.append({'plant': plant.lower(),
+                                  'disease': dis.lower(),
+                                  'probability': round(p, 6)})
+            if fmt == 'jsonl':
+                row['top_k'] = ranked
+        if error is None and args.logits:
+            if fmt == 'csv':
+                for (name, logit) in zip(diseases, values['logits']):
+                    row['logit_' + name] = '%.6f' % logit
+            else:
+                row['logits'] = [round(float(v), 6) for v in
+                                 values['logits']]
+        if error is None and args.embeddings:
+            features = np.ravel(values['features'])
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(args.embeddings,
+                        mode='w+', dtype=np.float32,
+                        shape=(len(paths), features.size))
+                embeddings[:] = np.nan
+            embeddings[n_done] = features
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            out.write(json.dumps(row) + '\n')
+        n_done += 1
+
+    elapsed = time.perf_counter() - start
+    stage_done('classification')
+    if args.output:
+        out.close()
+    if embeddings is not None:
+        embeddings.flush()
+        del embeddings
+    elif args.embeddings:
+        print ('No image could be classified, %s was not written'
+               % args.embeddings, file=sys.stderr)
+    print('Classified %d images in %.1fs (%.1f images/s)' % (n_done,
+          elapsed, n_done / max(elapsed, 1e-9)), file=sys.stderr)
+else:
+
+    (_, values, error) = next(iter(results))
+    if error is not None:
+        raise Exception('The image could not be read, ' + str(f_path)
+                        + ': ' + str(error))
+    stage_done('classification')
+
+    # disease is the class with highest probability
+
+    disease = int(np.argmax(values['probs']))
+    (plant, dis) = split_class(disease)
+    print ((plant + ',' + dis).lower())
+
+    if args.view:
+
+        # Setting up plt and showing the image used for prediction
+
+        import matplotlib.pyplot as plt
+        img3 = load_image(f_path)
+        fig = plt.figure('Leaf Diagnosed')
+        if dis.lower() == 'healthy':
+            finalAnnot = 'Predicted plant is ' + plant + ' & it is ' + dis
+        else:
+            finalAnnot = 'Predicted plant is ' + plant + ' & disease is ' \
+                + dis
+        plt.title(finalAnnot)
+        plt.imshow(img3)
+        stage_done('view')
+        plt.show()
+
+# the profile excludes the time the image window is open
+
+if args.profile_startup:
+    print ('Startup profile (seconds):', file=sys.stderr)
+    for (name, seconds) in stages:
+        print ('  %-16s %7.3f' % (name, seconds), file=sys.stderr)
+    print ('  %-16s %7.3f' % ('total', sum(s for (_, s) in stages)),
+           file=sys.stderr)
+    heavy = ['tensorflow', 'cv2', 'matplotlib', 'requests', 'gdown']
+    print ('  modules loaded: ' + (', '.join(m for m in heavy if m
+           in sys.modules) or 'none'), file=sys.stderr)
@@ -0,0 +1,158 @@
+# Cache of classification results keyed by image content
+#
+# The same photo is often submitted again (retries, or one photo uploaded by
+# several users). The cache keeps the model outputs of each image under the
+# hash of its bytes and the model, so a repeated image is answered without
+# decoding it or running the model. It is an SQLite file that diagnose
+# processes and the daemon can share, and the least recently used results
+# are deleted when it grows beyond its size limit.
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+default_path = os.environ.get('PLANTDIS_CACHE',
+                              os.path.join(os.path.expanduser('~'),
+                              '.cache', 'plantdis', 'results.sqlite'))
+default_mb = int(os.environ.get('PLANTDIS_CACHE_MB', '256'))
+
+
+def model_id(model_path):
+
+    # identifying a model file by name, size and modification time, which
+    # change whenever the model is downloaded or converted again
+
+    st = os.stat(model_path)
+    return '%s:%d:%d' % (os.path.basename(model_path), st.st_size,
+                         st.st_mtime_ns)
+
+
+class ResultCache:
+
+    # After eviction the cache is brought down to this fraction of its
+    # limit, so that eviction does not run again on the next write
+
+    evict_to = 0.9
+
+    def __init__(self, path=default_path, model='', max_bytes=default_mb
+                 * 1024 * 1024):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # one connection shared by the loader threads, in autocommit mode;
+        # WAL lets other processes read while one writes
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30,
+                                  check_same_thread=False,
+                                  isolation_level=None)
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT NOT NULL, output TEXT NOT NULL, value BLOB NOT NULL, used REAL NOT NULL, PRIMARY KEY (key, output))'
+                            )
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)'
+                            )
+
+            # the total size of the values is kept in the file, so that the
+            # processes sharing the cache see each other's writes, and it is
+            # only summed over the whole table when the file is created
+
+            self.db.execute('CREATE TABLE IF NOT EXISTS size (total INTEGER NOT NULL)'
+                            )
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if self.db.execute('SELECT total FROM size'
+                                   ).fetchone() is None:
+                    self.db.execute('INSERT INTO size SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results'
+                                    )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def make_key(self, data):
+        digest = hashlib.sha256(data)
+        digest.update(b'\0' + self.model.encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key, outputs=('probs', )):
+
+        # returning the cached outputs of an image as a dict of float32
+        # arrays, or None unless all the outputs asked for are cached
+
+        with self.lock:
+            rows = dict(self.db.execute('SELECT output, value FROM results WHERE key = ?'
+                        , (key, )))
+            if not all(name in rows for name in outputs):
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE results SET used = ? WHERE key = ?',
+                            (time.time(), key))
+            self.hits += 1
+        return dict((name, np.frombuffer(rows[name], np.float32))
+                    for name in outputs)
+
+    def put(self, items):
+
+        # storing the outputs of several images, given as (key, values)
+        # pairs, in one transaction
+
+        now = time.time()
+        rows = [(key, name, np.asarray(value, np.float32).tobytes(), now)
+                for (key, values) in items for (name, value) in
+                values.items()]
+        if not rows:
+            return
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+
+                # a replaced value no longer counts towards the total
+
+                added = 0
+                for row in rows:
+                    old = self.db.execute('SELECT LENGTH(value) FROM results WHERE key = ? AND output = ?'
+                            , row[:2]).fetchone()
+                    self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)'
+                                    , row)
+                    added += len(row[2]) - (old[0] if old else 0)
+                self.db.execute('UPDATE size SET total = total + ?',
+                                (added, ))
+                self._evict()
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def _evict(self):
+
+        # the results are only scanned, oldest first along the results_used
+        # index, once the total is over the limit
+
+        (total, ) = self.db.execute('SELECT total FROM size').fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes * self.evict_to
+        doomed = []
+        freed = 0
+        for (rowid, size) in \
+            self.db.execute('SELECT rowid, LENGTH(value) FROM results ORDER BY used'
+                            ):
+            doomed.append((rowid, ))
+            freed += size
+            if freed >= excess:
+                break
+        self.db.executemany('DELETE FROM results WHERE rowid = ?', doomed)
+        self.db.execute('UPDATE size SET total = total - ?', (freed, ))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,94 @@
+# Tests of the result cache's size accounting and eviction, run with
+#
+#   python -m pytest mlhub
+
+import numpy as np
+
+from result_cache import ResultCache
+
+
+def stored_bytes(cache):
+    (total, ) = cache.db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM results'
+                                 ).fetchone()
+    return total
+
+
+def recorded_bytes(cache):
+    return cache.db.execute('SELECT total FROM size').fetchone()[0]
+
+
+def probs(n, value):
+    return {'probs': np.full(n, value, np.float32)}
+
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path / 'results.sqlite'), model='m')
+    key = cache.make_key(b'image')
+    assert cache.get(key) is None
+    cache.put([(key, {'probs': np.arange(4), 'features': np.ones(8)})])
+    result = cache.get(key, ('probs', 'features'))
+    assert np.array_equal(result['probs'], np.arange(4, dtype=np.float32))
+    assert np.array_equal(result['features'], np.ones(8, np.float32))
+    assert cache.get(key, ('probs', 'embedding')) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.close()
+
+
+def test_keys_depend_on_model(tmp_path):
+    a = ResultCache(str(tmp_path / 'results.sqlite'), model='a')
+    b = ResultCache(str(tmp_path / 'results.sqlite'), model='b')
+    assert a.make_key(b'image') != b.make_key(b'image')
+    a.close()
+    b.close()
+
+
+def test_overwrite_replaces_size(tmp_path):
+    cache = ResultCache(str(tmp_path / 'results.sqlite'))
+    cache.put([('a', probs(10, 1)), ('b', probs(10, 1))])
+    assert recorded_bytes(cache) == stored_bytes(cache) == 80
+
+    # a bigger and then a smaller value for the same key
+
+    cache.put([('a', probs(20, 2))])
+    assert recorded_bytes(cache) == stored_bytes(cache) == 120
+    cache.put([('a', probs(5, 3)), ('a', probs(5, 4))])
+    assert recorded_bytes(cache) == stored_bytes(cache) == 60
+    assert np.array_equal(cache.get('a')['probs'], np.full(5, 4,
+                          np.float32))
+    cache.close()
+
+
+def test_eviction_frees_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'results.sqlite'), max_bytes=400)
+    for (i, key) in enumerate('abcd'):
+        cache.put([(key, probs(25, i))])
+    assert recorded_bytes(cache) == stored_bytes(cache) == 400
+
+    # reading a makes b and then c the least recently used; one more result
+    # goes over the limit and the cache is brought down to evict_to of it,
+    # which takes two results
+
+    assert cache.get('a') is not None
+    cache.put([('e', probs(25, 4))])
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+    for key in 'ade':
+        assert cache.get(key) is not None
+    assert recorded_bytes(cache) == stored_bytes(cache) == 300
+
+    cache.put([('f', probs(50, 5))])
+    assert recorded_bytes(cache) == stored_bytes(cache)
+    assert recorded_bytes(cache) <= 400 * cache.evict_to
+    assert cache.get('f') is not None
+    cache.close()
+
+
+def test_size_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    first = ResultCache(path)
+    first.put([('a', probs(10, 1))])
+    second = ResultCache(path)
+    second.put([('b', probs(10, 1)), ('a', probs(20, 2))])
+    assert recorded_bytes(first) == stored_bytes(first) == 120
+    first.close()
+    second.close()